@@ -1,27 +1,365 @@
-from opcua import Client
+"""
+Recursive OPC UA address-space crawler that writes an SPSData mapping XML.
+
+The crawler walks the address space breadth-first starting at the Objects
+folder (or --root). Every level is browsed with batched Browse requests
+(many nodes per request, BrowseNext for continuation points) that are sent
+concurrently over one session, and the DataType/ValueRank/ArrayDimensions of
+all variables are resolved with batched Read requests. BrowsePaths are built
+while walking, so no per-node round trip is needed.
+
+Output:
+  --out      flat mapping XML (Mappings/Mapping with Label, NodeId, DataTypeId,
+             Count, MemoryAccessMode) in the SPSData format
+  --structured
+             additionally write the Block/section structured variant using
+             SPSData/convert_v4_to_structured.py
+  --cache    JSON cache of the crawled tree
+
+Re-crawling:
+  --incremental   reuse the cache: the hierarchy is browsed again, but
+                  attributes are only read for variables that are new, renamed
+                  or moved, or whose parent's set of children changed. A
+                  DataType changed under an otherwise unchanged parent is not
+                  noticed; re-crawl that part with --subtree or without
+                  --incremental
+  --subtree X     only re-crawl the subtree(s) below the given NodeId or
+                  BrowsePath (e.g. Block1.DB_Kommandos_1) and merge them into
+                  the cache
+
+Usage:
+  python opcua_browse_nodes.py --out SPSData/Mapping_NewPLC.xml --cache SPSData/Mapping_NewPLC.json
+  python opcua_browse_nodes.py --cache SPSData/Mapping_NewPLC.json --incremental --out SPSData/Mapping_NewPLC.xml
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from opcua import Client, ua
 
 OPCUA_SERVER_URL = "opc.tcp://localhost:4840"
-client = Client(OPCUA_SERVER_URL)
-client.connect()
-
-print("Connected to OPC UA Simulation Server.")
-
-# Print all namespaces
-ns_array = client.get_namespace_array()
-print("Namespaces:")
-for idx, ns in enumerate(ns_array):
-    print(f"  {idx}: {ns}")
-
-# Print all variable nodes under Objects
-print("\nVariables under Objects:")
-objects = client.get_objects_node()
-for child in objects.get_children():
-    print(f"Node: {child}, BrowseName: {child.get_browse_name()}, NodeId: {child.nodeid}")
-    # If the child is a variable, print its value
+BROWSE_BATCH = 200       # nodes per Browse request
+READ_BATCH = 500         # attributes per Read request
+MAX_REFERENCES = 1000    # references per node before the server hands out a continuation point
+CONCURRENCY = 4          # parallel requests in flight
+
+ATTRIBUTES = (ua.AttributeIds.DataType, ua.AttributeIds.ValueRank, ua.AttributeIds.ArrayDimensions)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Crawler:
+    def __init__(self, client, concurrency=CONCURRENCY, browse_batch=BROWSE_BATCH, read_batch=READ_BATCH,
+                 include_standard=False):
+        self.client = client
+        self.include_standard = include_standard
+        self.uaclient = client.uaclient
+        self.browse_batch = browse_batch
+        self.read_batch = read_batch
+        self.pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.requests = 0
+        self._namespace_array = None
+
+    def _browse_description(self, nodeid):
+        desc = ua.BrowseDescription()
+        desc.NodeId = nodeid
+        desc.BrowseDirection = ua.BrowseDirection.Forward
+        desc.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+        desc.IncludeSubtypes = True
+        desc.NodeClassMask = ua.NodeClass.Object | ua.NodeClass.Variable
+        desc.ResultMask = ua.BrowseResultMask.All
+        return desc
+
+    def _browse_batch(self, nodeids):
+        """Browse a batch of nodes and follow continuation points; returns {nodeid: [ReferenceDescription]}."""
+        params = ua.BrowseParameters()
+        params.RequestedMaxReferencesPerNode = MAX_REFERENCES
+        params.NodesToBrowse = [self._browse_description(n) for n in nodeids]
+        results = self.uaclient.browse(params)
+        self.requests += 1
+        refs = {n: list(r.References) for n, r in zip(nodeids, results)}
+        pending = [(n, r.ContinuationPoint) for n, r in zip(nodeids, results) if r.ContinuationPoint]
+        while pending:
+            next_params = ua.BrowseNextParameters()
+            next_params.ReleaseContinuationPoints = False
+            next_params.ContinuationPoints = [cp for _, cp in pending]
+            next_results = self.uaclient.browse_next(next_params)
+            self.requests += 1
+            still = []
+            for (n, _), r in zip(pending, next_results):
+                refs[n].extend(r.References)
+                if r.ContinuationPoint:
+                    still.append((n, r.ContinuationPoint))
+            pending = still
+        return refs
+
+    def browse_level(self, nodeids):
+        """Browse all nodes of one BFS level in concurrent batches."""
+        refs = {}
+        for part in self.pool.map(self._browse_batch, list(chunks(nodeids, self.browse_batch))):
+            refs.update(part)
+        return refs
+
+    def _read_batch(self, nodeids):
+        params = ua.ReadParameters()
+        for n in nodeids:
+            for attr in ATTRIBUTES:
+                rv = ua.ReadValueId()
+                rv.NodeId = n
+                rv.AttributeId = attr
+                params.NodesToRead.append(rv)
+        results = self.uaclient.read(params)
+        self.requests += 1
+        out = {}
+        for i, n in enumerate(nodeids):
+            dtype, rank, dims = results[i * 3:i * 3 + 3]
+            out[n] = {
+                "data_type": dtype.Value.Value.to_string() if dtype.StatusCode.is_good() and dtype.Value.Value else None,
+                "value_rank": int(rank.Value.Value) if rank.StatusCode.is_good() and rank.Value.Value is not None else None,
+                "array_dimensions": list(dims.Value.Value) if dims.StatusCode.is_good() and dims.Value.Value else None,
+            }
+        return out
+
+    def read_attributes(self, nodeids):
+        """Resolve DataType/ValueRank/ArrayDimensions of many variables in concurrent batched reads."""
+        attrs = {}
+        per_request = max(1, self.read_batch // len(ATTRIBUTES))
+        for part in self.pool.map(self._read_batch, list(chunks(nodeids, per_request))):
+            attrs.update(part)
+        return attrs
+
+    def crawl(self, roots, known=None):
+        """
+        Breadth-first crawl below roots ({nodeid_string: path}).
+        known: cached node dict; attributes of unchanged variables are reused from it.
+        Returns {nodeid_string: node_info} for all nodes below (and including) the roots.
+        """
+        known = known or {}
+        nodes = {}
+        level = []
+        for nodeid, path in roots.items():
+            nodes[nodeid] = dict(known.get(nodeid, {}), path=path, children=[])
+            level.append(ua.NodeId.from_string(nodeid))
+        visited = set(roots)
+        to_resolve = []
+        while level:
+            refs = self.browse_level(level)
+            next_level = []
+            for parent, references in refs.items():
+                parent_key = parent.to_string()
+                parent_info = nodes[parent_key]
+                # skip the Server object and other standard nodes
+                references = [ref for ref in references if ref.NodeId.NamespaceIndex != 0 or self.include_standard]
+                parent_info["children"] = [ref.NodeId.to_string() for ref in references]
+                # cached attributes are reused only while the parent has exactly its cached children
+                cached_children = known.get(parent_key, {}).get("children")
+                unchanged = cached_children is not None and set(cached_children) == set(parent_info["children"])
+                for ref, child in zip(references, parent_info["children"]):
+                    if child in visited:
+                        continue
+                    visited.add(child)
+                    name = ref.BrowseName.Name
+                    path = f"{parent_info['path']}.{name}" if parent_info["path"] else name
+                    info = {
+                        "browse_name": ref.BrowseName.to_string(),
+                        "node_class": ref.NodeClass.name,
+                        "parent": parent_key,
+                        "path": path,
+                        "children": [],
+                    }
+                    cached = known.get(child)
+                    if ref.NodeClass == ua.NodeClass.Variable:
+                        if unchanged and cached and cached.get("path") == path and "data_type" in cached:
+                            for key in ("data_type", "value_rank", "array_dimensions"):
+                                info[key] = cached.get(key)
+                        else:
+                            to_resolve.append(ref.NodeId)
+                    nodes[child] = info
+                    next_level.append(ref.NodeId)
+            level = next_level
+        if to_resolve:
+            for nodeid, attrs in self.read_attributes(to_resolve).items():
+                nodes[nodeid.to_string()].update(attrs)
+        return nodes
+
+    def resolve_paths(self, root, paths):
+        """Translate dotted BrowsePaths below root into NodeIds in one TranslateBrowsePaths request."""
+        browse_paths = []
+        for path in paths:
+            bp = ua.BrowsePath()
+            bp.StartingNode = ua.NodeId.from_string(root)
+            for name in path.split('.'):
+                el = ua.RelativePathElement()
+                el.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+                el.IncludeSubtypes = True
+                el.TargetName = ua.QualifiedName.from_string(name) if ':' in name else self._guess_name(name)
+                bp.RelativePath.Elements.append(el)
+            browse_paths.append(bp)
+        results = self.uaclient.translate_browsepaths_to_nodeids(browse_paths)
+        self.requests += 1
+        resolved = {}
+        for path, result in zip(paths, results):
+            if result.StatusCode.is_good() and result.Targets:
+                resolved[path] = result.Targets[0].TargetId.to_string()
+            else:
+                print(f"Could not resolve BrowsePath {path}: {result.StatusCode}")
+        return resolved
+
+    def namespace_array(self):
+        """The server's namespace URIs, read once per crawler."""
+        if self._namespace_array is None:
+            self._namespace_array = self.client.get_namespace_array()
+            self.requests += 1
+        return self._namespace_array
+
+    def _guess_name(self, name):
+        # BrowseNames of PLC variables live in the PLC's namespace; default to the last registered one
+        return ua.QualifiedName(name, max(0, len(self.namespace_array()) - 1))
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def data_type_id(info):
+    """SPSData DataTypeId: the built-in type number for ns=0 types, else the full NodeId string."""
+    dtype = info.get("data_type")
+    if not dtype:
+        return None
+    nodeid = ua.NodeId.from_string(dtype)
+    if nodeid.NamespaceIndex == 0 and isinstance(nodeid.Identifier, int):
+        return str(nodeid.Identifier)
+    return dtype
+
+
+def write_mapping_xml(nodes, namespace_uris, path):
+    root = ET.Element('DataMapping')
+    uris = ET.SubElement(root, 'NamespaceUris')
+    for uri in namespace_uris:
+        ET.SubElement(uris, 'Uri').text = uri
+    mappings = ET.SubElement(root, 'Mappings')
+    variables = [(info["path"], nodeid, info) for nodeid, info in nodes.items()
+                 if info.get("node_class") == "Variable" and info.get("path")]
+    for label, nodeid, info in sorted(variables):
+        el = ET.SubElement(mappings, 'Mapping')
+        el.set('Label', label)
+        el.set('NodeId', nodeid)
+        rank = info.get("value_rank")
+        dims = info.get("array_dimensions")
+        if rank is not None and rank >= 1 and dims:
+            el.set('Count', str(dims[0]))
+        dtype = data_type_id(info)
+        if dtype is not None:
+            el.set('DataTypeId', dtype)
+        if rank is not None and rank >= 1:
+            el.set('MemoryAccessMode', '1')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "SPSData"))
+    from convert_v4_to_structured import indent
+    indent(root)
+    ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+    return len(variables)
+
+
+def load_cache(path):
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return None
+
+
+def drop_subtree(nodes, nodeid):
+    """Remove nodeid and everything below it from a cached node dict."""
+    stack = [nodeid]
+    while stack:
+        info = nodes.pop(stack.pop(), None)
+        if info:
+            stack.extend(info.get("children", []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl an OPC UA address space and emit an SPSData mapping XML")
+    parser.add_argument("--url", default=os.environ.get("OPCUA_SERVER_URL", OPCUA_SERVER_URL))
+    parser.add_argument("--root", default=ua.NodeId(ua.ObjectIds.ObjectsFolder).to_string(),
+                        help="NodeId to start at; labels are BrowsePaths relative to it")
+    parser.add_argument("--out", help="mapping XML to write (flat SPSData format)")
+    parser.add_argument("--structured", help="also write the Block/section structured mapping XML")
+    parser.add_argument("--cache", help="JSON cache file (read for --incremental/--subtree, always written)")
+    parser.add_argument("--incremental", action="store_true", help="reuse cached attributes of variables whose path and parent's children are unchanged")
+    parser.add_argument("--subtree", action="append", default=[],
+                        help="re-crawl only below this NodeId or dotted BrowsePath (repeatable)")
+    parser.add_argument("--include-standard", action="store_true", help="also crawl namespace 0 nodes (Server object)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--browse-batch", type=int, default=BROWSE_BATCH)
+    parser.add_argument("--read-batch", type=int, default=READ_BATCH)
+    args = parser.parse_args()
+
+    cache = load_cache(args.cache) if (args.incremental or args.subtree) else None
+    if args.structured and not args.out:
+        parser.error("--structured needs --out")
+    if args.subtree and not cache:
+        parser.error("--subtree needs an existing --cache")
+
+    client = Client(args.url)
+    client.connect()
+    print("Connected to", args.url)
+    crawler = Crawler(client, args.concurrency, args.browse_batch, args.read_batch, args.include_standard)
+    started = time.perf_counter()
     try:
-        value = child.get_value()
-        print(f"  Value: {value}")
-    except Exception:
-        pass
+        namespace_uris = crawler.namespace_array()
+        known = cache["nodes"] if cache else {}
+        if args.subtree:
+            roots = {}
+            paths = [s for s in args.subtree if not s.startswith(('ns=', 'i=', 's=', 'g=', 'b='))]
+            resolved = crawler.resolve_paths(args.root, paths) if paths else {}
+            for s in args.subtree:
+                nodeid = resolved.get(s, s if s not in paths else None)
+                if nodeid is None:
+                    continue
+                nodeid = ua.NodeId.from_string(nodeid).to_string()
+                roots[nodeid] = known.get(nodeid, {}).get("path", s if s in paths else "")
+            nodes = dict(known)
+            for nodeid in roots:
+                old = nodes.get(nodeid, {})
+                drop_subtree(nodes, nodeid)
+                if old:
+                    # keep the subtree root attached to its parent
+                    nodes[nodeid] = {k: v for k, v in old.items() if k != "children"}
+            nodes.update(crawler.crawl(roots, known))
+        else:
+            nodes = crawler.crawl({args.root: ""}, known)
+    finally:
+        crawler.close()
+        client.disconnect()
+    elapsed = time.perf_counter() - started
+
+    variables = sum(1 for info in nodes.values() if info.get("node_class") == "Variable")
+    print(f"Crawled {len(nodes)} nodes ({variables} variables) in {elapsed:.2f}s using {crawler.requests} requests")
+
+    if args.cache:
+        with open(args.cache, 'w', encoding='utf-8') as f:
+            json.dump({
+                "endpoint": args.url,
+                "root": args.root,
+                "crawled_at": datetime.datetime.utcnow().isoformat(),
+                "namespace_uris": namespace_uris,
+                "nodes": nodes,
+            }, f, indent=1)
+        print("Cache written to", args.cache)
+    if args.out:
+        # the PLC namespaces are everything after the two standard ones
+        count = write_mapping_xml(nodes, namespace_uris[2:] or namespace_uris, args.out)
+        print(f"Mapping with {count} entries written to", args.out)
+        if args.structured:
+            from convert_v4_to_structured import convert_to_structured
+            convert_to_structured(args.out, args.structured)
+
 
-client.disconnect()
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,291 @@
-from opcua import Client
+"""
+OPC UA console monitor and multi-client load generator.
+
+Modes:
+  monitor  subscribe to all mapped nodes and print only value changes together
+           with the live notification rate and latency statistics
+  load     spawn N concurrent client sessions against VentilTesterSimServer,
+           each with its own subscription and a read/write mix, and report the
+           aggregate server throughput and per-session latency percentiles
+
+Usage:
+  python opcua_console_client.py monitor
+  python opcua_console_client.py load --sessions 8 --duration 60 --write-ratio 0.2
+
+The node list is taken from the SPSData mapping file (same file the simulation
+server loads), so the monitor and the load generator see exactly the nodes a
+backend would poll.
+"""
+import argparse
+import datetime
+import os
+import random
+import threading
 import time
+import xml.etree.ElementTree as ET
+
+from opcua import Client, ua
 
 OPCUA_SERVER_URL = "opc.tcp://localhost:4840"
-NUM_DEVICES = 10
-NUM_VALUES = 10
-
-client = Client(OPCUA_SERVER_URL)
-client.connect()
-print("Connected to OPC UA Simulation Server.")
-
-try:
-    while True:
-        print("--- OPC UA Device Values ---")
-        for d in range(NUM_DEVICES):
-            print(f"Device {d+1}:")
-            for i in range(NUM_VALUES):
-                sim_node_id = f"ns=2;s=Device{d+1}.SimValue{i+1}"
-                param_node_id = f"ns=2;s=Device{d+1}.ParamValue{i+1}"
-                sim_node = client.get_node(sim_node_id)
-                param_node = client.get_node(param_node_id)
-                sim_value = sim_node.get_value()
-                param_value = param_node.get_value()
-                print(f"  SimValue{i+1}: {sim_value}")
-                print(f"  ParamValue{i+1}: {param_value}")
-            print("")
-        print("---------------------\n")
-        time.sleep(2)
-except KeyboardInterrupt:
-    print("Exiting...")
-finally:
-    client.disconnect()
+DEFAULT_MAPPING = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SPSData", "Mapping_Ventiltester.xml")
+PUBLISH_INTERVAL_MS = 500
+STATS_INTERVAL = 5.0
+
+
+def load_mapping_nodes(path):
+    """Return (label, node_id) for every Mapping element in an SPSData mapping file."""
+    root = ET.parse(path).getroot()
+    mappings = root.find('Mappings')
+    if mappings is None:
+        return []
+    nodes = []
+    for mapping in mappings.iter('Mapping'):
+        nodeid = mapping.get('NodeId')
+        if nodeid:
+            nodes.append((mapping.get('Label') or nodeid, nodeid))
+    return nodes
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+
+def format_latency(samples):
+    """Format latency samples (seconds) as 'p50/p95/p99/max' in milliseconds."""
+    if not samples:
+        return "n/a"
+    s = sorted(samples)
+    return "p50={:.1f} p95={:.1f} p99={:.1f} max={:.1f} ms".format(
+        percentile(s, 50) * 1000, percentile(s, 95) * 1000, percentile(s, 99) * 1000, s[-1] * 1000)
+
+
+def notification_latency(data):
+    """Seconds between the value's source (or server) timestamp and its arrival here."""
+    dv = data.monitored_item.Value
+    ts = dv.SourceTimestamp or dv.ServerTimestamp
+    if ts is None:
+        return None
+    return max(0.0, (datetime.datetime.utcnow() - ts).total_seconds())
+
+
+class LatencyWindow:
+    """Thread-safe collector for notification counts and latency samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = []
+        self._count = 0
+        self.total = 0
+
+    def add(self, latency):
+        with self._lock:
+            self._count += 1
+            self.total += 1
+            if latency is not None:
+                self._samples.append(latency)
+
+    def drain(self):
+        """Return (count, samples) collected since the last drain and reset the window."""
+        with self._lock:
+            count, samples = self._count, self._samples
+            self._count, self._samples = 0, []
+        return count, samples
+
+
+class MonitorHandler:
+    """Subscription handler that prints changed values only."""
+
+    def __init__(self, labels, window):
+        self.labels = labels
+        self.window = window
+        self.last_values = {}
+
+    def datachange_notification(self, node, val, data):
+        self.window.add(notification_latency(data))
+        key = node.nodeid.to_string()
+        if key in self.last_values and self.last_values[key] == val:
+            return
+        self.last_values[key] = val
+        print(f"{datetime.datetime.now():%H:%M:%S.%f}"[:-3], f"{self.labels.get(key, key)} = {val}")
+
+    def status_change_notification(self, status):
+        print("Subscription status changed:", status)
+
+
+def run_monitor(args):
+    nodes = load_mapping_nodes(args.mapping)
+    if args.limit:
+        nodes = nodes[:args.limit]
+    labels = {ua.NodeId.from_string(nodeid).to_string(): label for label, nodeid in nodes}
+
+    client = Client(args.url)
+    client.connect()
+    print(f"Connected to {args.url}, subscribing to {len(nodes)} nodes.")
+    window = LatencyWindow()
+    try:
+        sub = client.create_subscription(args.interval, MonitorHandler(labels, window))
+        sub.subscribe_data_change([client.get_node(nodeid) for _, nodeid in nodes])
+        while True:
+            time.sleep(args.stats_interval)
+            count, samples = window.drain()
+            print(f"--- {count / args.stats_interval:.1f} notifications/s, "
+                  f"total {window.total}, latency {format_latency(samples)} ---")
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        client.disconnect()
+
+
+class LoadHandler:
+    """Subscription handler for load sessions: count and time notifications, no printing."""
+
+    def __init__(self, window):
+        self.window = window
+
+    def datachange_notification(self, node, val, data):
+        self.window.add(notification_latency(data))
+
+
+class LoadSession(threading.Thread):
+    """One client session with its own subscription and a batched read/write loop."""
+
+    def __init__(self, number, args, node_ids, start_barrier, stop_event):
+        super().__init__(daemon=True)
+        self.number = number
+        self.args = args
+        self.node_ids = node_ids
+        self.start_barrier = start_barrier
+        self.stop_event = stop_event
+        self.notifications = LatencyWindow()
+        self.read_latency = []
+        self.write_latency = []
+        self.errors = 0
+        self.error = None
+
+    def run(self):
+        client = Client(self.args.url)
+        try:
+            client.connect()
+            nodes = [client.get_node(nodeid) for nodeid in self.node_ids]
+            sub = client.create_subscription(self.args.interval, LoadHandler(self.notifications))
+            sub.subscribe_data_change(nodes)
+        except Exception as e:
+            self.error = e
+            self.start_barrier.abort()
+            return
+        try:
+            self.start_barrier.wait()
+            rng = random.Random(self.number)
+            nodeids = [node.nodeid for node in nodes]
+            while not self.stop_event.is_set():
+                batch = rng.sample(nodeids, min(self.args.batch, len(nodeids)))
+                try:
+                    t0 = time.perf_counter()
+                    results = client.uaclient.get_attributes(batch, ua.AttributeIds.Value)
+                    self.read_latency.append(time.perf_counter() - t0)
+                    if rng.random() < self.args.write_ratio:
+                        # write back what was read, keeping the variant type the server expects
+                        dvs = [ua.DataValue(r.Value) for r in results]
+                        t0 = time.perf_counter()
+                        client.uaclient.set_attributes(batch, dvs, ua.AttributeIds.Value)
+                        self.write_latency.append(time.perf_counter() - t0)
+                except Exception:
+                    self.errors += 1
+                if self.args.think_time:
+                    self.stop_event.wait(self.args.think_time)
+        except threading.BrokenBarrierError:
+            pass
+        finally:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+
+def run_load(args):
+    node_ids = [nodeid for _, nodeid in load_mapping_nodes(args.mapping)]
+    if args.limit:
+        node_ids = node_ids[:args.limit]
+    if not node_ids:
+        print("No nodes found in", args.mapping)
+        return
+
+    stop_event = threading.Event()
+    start_barrier = threading.Barrier(args.sessions + 1)
+    sessions = [LoadSession(n, args, node_ids, start_barrier, stop_event) for n in range(args.sessions)]
+    print(f"Starting {args.sessions} sessions against {args.url} ({len(node_ids)} nodes, "
+          f"batch {args.batch}, write ratio {args.write_ratio})")
+    for s in sessions:
+        s.start()
+    try:
+        start_barrier.wait()
+    except threading.BrokenBarrierError:
+        stop_event.set()
+        for s in sessions:
+            if s.error:
+                print(f"Session {s.number} failed to connect: {s.error}")
+        return
+
+    started = time.perf_counter()
+    try:
+        while time.perf_counter() - started < args.duration:
+            time.sleep(min(args.stats_interval, max(0.0, args.duration - (time.perf_counter() - started))))
+            counts = [s.notifications.drain()[0] for s in sessions]
+            elapsed = time.perf_counter() - started
+            ops = sum(len(s.read_latency) + len(s.write_latency) for s in sessions)
+            print(f"[{elapsed:6.1f}s] {ops / elapsed:8.1f} requests/s, "
+                  f"{sum(counts) / args.stats_interval:8.1f} notifications/s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        for s in sessions:
+            s.join(timeout=5)
+
+    elapsed = time.perf_counter() - started
+    reads = sum(len(s.read_latency) for s in sessions)
+    writes = sum(len(s.write_latency) for s in sessions)
+    notifications = sum(s.notifications.total for s in sessions)
+    print("\n=== Load summary ===")
+    print(f"Duration {elapsed:.1f}s, {args.sessions} sessions")
+    print(f"Server throughput: {(reads + writes) / elapsed:.1f} requests/s "
+          f"({reads * args.batch / elapsed:.0f} values read/s, {writes * args.batch / elapsed:.0f} values written/s), "
+          f"{notifications / elapsed:.1f} notifications/s")
+    for s in sessions:
+        print(f"Session {s.number:3d}: reads {len(s.read_latency):6d} [{format_latency(s.read_latency)}]  "
+              f"writes {len(s.write_latency):6d} [{format_latency(s.write_latency)}]  "
+              f"notifications {s.notifications.total:7d}  errors {s.errors}")
+    all_reads = [x for s in sessions for x in s.read_latency]
+    all_writes = [x for s in sessions for x in s.write_latency]
+    print(f"All sessions: reads [{format_latency(all_reads)}]  writes [{format_latency(all_writes)}]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OPC UA subscription monitor and load generator")
+    parser.add_argument("--url", default=os.environ.get("OPCUA_SERVER_URL", OPCUA_SERVER_URL))
+    parser.add_argument("--mapping", default=DEFAULT_MAPPING, help="SPSData mapping XML with the nodes to use")
+    parser.add_argument("--limit", type=int, default=0, help="use only the first N mapped nodes")
+    parser.add_argument("--interval", type=int, default=PUBLISH_INTERVAL_MS, help="publishing interval in ms")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL, help="seconds between stats lines")
+    sub = parser.add_subparsers(dest="mode")
+    sub.add_parser("monitor", help="print value changes and notification stats (default)")
+    load = sub.add_parser("load", help="run N concurrent client sessions")
+    load.add_argument("--sessions", type=int, default=4)
+    load.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    load.add_argument("--batch", type=int, default=50, help="nodes per read/write request")
+    load.add_argument("--write-ratio", type=float, default=0.1, help="fraction of read requests followed by a write")
+    load.add_argument("--think-time", type=float, default=0.0, help="seconds to wait between requests per session")
+    args = parser.parse_args()
+
+    if args.mode == "load":
+        run_load(args)
+    else:
+        run_monitor(args)
+
+
+if __name__ == "__main__":
+    main()
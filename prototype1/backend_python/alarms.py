@@ -0,0 +1,273 @@
+# Alarm rules evaluated on the ingest stream.
+#
+# ALARMS_FILE points to a JSON list of rules:
+#
+#   [{"id": "plc_temperature", "match": "*.TemperaturePLC", "kind": "above", "limit": 60, "hysteresis": 2,
+#     "severity": "warning", "message": "PLC temperature high"},
+#    {"id": "error_bit", "match": "*.Fehlerbit", "kind": "mask", "mask": 1, "severity": "error"},
+#    {"id": "pressure_stuck", "match": "*Druck*", "kind": "stuck", "seconds": 120, "bench": "bench1"}]
+#
+# Kinds: above / below (value against limit), rate (|change per second| above
+# limit), stuck (value unchanged for `seconds`), mask (int(value) & mask != 0).
+# `match` is a glob on "device.type" or on the NodeId; `bench` restricts a rule
+# to one test bench.
+#
+# Rules are compiled once per node: when the historian first hands in a node,
+# every matching rule becomes a binding, one row in flat arrays (kind, limit,
+# clear level, state). A batch only touches the bindings of its own nodes, so
+# the cost per sample does not grow with the total number of rules or nodes.
+# An alarm is raised when its condition starts and cleared once the value is
+# back past limit -/+ hysteresis; while the state holds nothing is emitted, and
+# alarms still open in the DB are taken over after a restart instead of being
+# raised again. Transitions are stored in the alarms table and, once committed,
+# kept in a short event buffer for /alarms/stream. If the write fails, the
+# bindings go back to their state before the batch and nothing is published, so
+# the next sample detects the transition again and retries it.
+import json
+import math
+import os
+import threading
+from array import array
+from collections import deque
+from fnmatch import fnmatchcase
+
+from sqlalchemy import update
+
+from backend.models import SessionLocal, Alarm
+from backend.nodes import to_iso
+
+ALARMS_FILE = os.environ.get("ALARMS_FILE", "")
+ALARMS_EVENT_BUFFER = int(os.environ.get("ALARMS_EVENT_BUFFER", "1000"))
+
+ABOVE, BELOW, RATE, STUCK, MASK = range(5)
+KINDS = {"above": ABOVE, "below": BELOW, "rate": RATE, "stuck": STUCK, "mask": MASK}
+# parameter holding the limit of each kind
+LIMIT_KEYS = {"above": "limit", "below": "limit", "rate": "limit", "stuck": "seconds", "mask": "mask"}
+
+
+def load_rules(path=ALARMS_FILE):
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    rules = []
+    for entry in config:
+        rule_id = entry.get("id")
+        kind = entry.get("kind")
+        if not rule_id or not entry.get("match"):
+            raise ValueError(f"Alarm rule {entry!r}: 'id' and 'match' are required")
+        if kind not in KINDS:
+            raise ValueError(f"Alarm rule {rule_id!r}: unknown kind {kind!r}, expected one of {tuple(KINDS)}")
+        if LIMIT_KEYS[kind] not in entry:
+            raise ValueError(f"Alarm rule {rule_id!r}: '{LIMIT_KEYS[kind]}' is required for kind {kind!r}")
+        rules.append({
+            "id": rule_id,
+            "match": entry["match"],
+            "bench": entry.get("bench"),
+            "kind": kind,
+            "limit": float(entry[LIMIT_KEYS[kind]]),
+            "hysteresis": float(entry.get("hysteresis", 0.0)),
+            "severity": entry.get("severity", "warning"),
+            "message": entry.get("message", rule_id),
+        })
+    return rules
+
+
+class AlarmEngine:
+    def __init__(self, rules, event_buffer=ALARMS_EVENT_BUFFER):
+        ids = [rule["id"] for rule in rules]
+        duplicates = {i for i in ids if ids.count(i) > 1}
+        if duplicates:
+            raise ValueError(f"Duplicate alarm rule ids {sorted(duplicates)}")
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.by_node = {}  # nodes.id -> [binding, ...]
+        self.nodes = {}  # nodes.id -> (bench, device, type, node_id)
+        # one row per (node, rule) binding
+        self.rule = array('l')
+        self.node = array('q')
+        self.kind = array('b')
+        self.limit = array('d')
+        self.clear = array('d')
+        self.active = array('b')
+        self.alarm_id = array('q')
+        self.raised_at = array('d')
+        self.last_value = array('d')
+        self.last_ts = array('d')
+        self.since = array('d')  # stuck: time of the last change
+        self.events = deque(maxlen=event_buffer)
+        self.seq = 0
+        self._open = None
+        self.metrics = {"evaluated": 0, "raised": 0, "cleared": 0, "errors": 0}
+
+    def _open_alarms(self):
+        # alarms raised before a restart and never cleared: (rule, node) -> (id, raised_at)
+        if self._open is None:
+            db = SessionLocal()
+            try:
+                self._open = {
+                    (rule, node): (alarm_id, raised_at)
+                    for alarm_id, rule, node, raised_at in db.query(Alarm.id, Alarm.rule, Alarm.node, Alarm.raised_at)
+                    .filter(Alarm.cleared_at.is_(None))
+                }
+            finally:
+                db.close()
+        return self._open
+
+    def _bind(self, node, bench, device, value_type, node_id):
+        text = f"{device}.{value_type}"
+        bindings = []
+        for r, rule in enumerate(self.rules):
+            if rule["bench"] and rule["bench"] != bench:
+                continue
+            if not (fnmatchcase(text, rule["match"]) or fnmatchcase(node_id, rule["match"])):
+                continue
+            kind = KINDS[rule["kind"]]
+            limit, hysteresis = rule["limit"], rule["hysteresis"]
+            alarm_id, raised_at = self._open_alarms().get((rule["id"], node), (0, math.nan))
+            bindings.append(len(self.rule))
+            self.rule.append(r)
+            self.node.append(node)
+            self.kind.append(kind)
+            self.limit.append(limit)
+            self.clear.append(limit + hysteresis if kind == BELOW else limit - hysteresis)
+            self.active.append(1 if alarm_id else 0)
+            self.alarm_id.append(alarm_id)
+            self.raised_at.append(raised_at)
+            self.last_value.append(math.nan)
+            self.last_ts.append(math.nan)
+            self.since.append(math.nan)
+        self.by_node[node] = bindings
+        self.nodes[node] = (bench, device, value_type, node_id)
+        return bindings
+
+    def evaluate(self, samples):
+        """Check [(nodes.id, bench, device, type, node_id, unix ts, value), ...] in time order.
+
+        Returns the raise/clear events; they are also stored and published. Nothing is
+        published if storing them fails.
+        """
+        if not self.rules:
+            return []
+        with self.lock:
+            kind, limit, clear, active = self.kind, self.limit, self.clear, self.active
+            last_value, last_ts, since = self.last_value, self.last_ts, self.since
+            transitions = []
+            for node, bench, device, value_type, node_id, ts, value in samples:
+                bindings = self.by_node.get(node)
+                if bindings is None:
+                    bindings = self._bind(node, bench, device, value_type, node_id)
+                if not bindings or value is None or value != value:
+                    continue
+                for b in bindings:
+                    k = kind[b]
+                    on = active[b]
+                    if k == ABOVE:
+                        state = value > (clear[b] if on else limit[b])
+                    elif k == BELOW:
+                        state = value < (clear[b] if on else limit[b])
+                    elif k == RATE:
+                        dt = ts - last_ts[b]
+                        if dt > 0:
+                            state = abs(value - last_value[b]) / dt > (clear[b] if on else limit[b])
+                        else:
+                            state = on
+                    elif k == STUCK:
+                        if value != last_value[b]:
+                            since[b] = ts
+                        state = ts - since[b] >= limit[b]
+                    else:
+                        state = (int(value) & int(limit[b])) != 0
+                    last_value[b] = value
+                    last_ts[b] = ts
+                    if state != on:
+                        active[b] = 1 if state else 0
+                        transitions.append((b, state, ts, value))
+            self.metrics["evaluated"] += len(samples)
+            if not transitions:
+                return []
+            return self._record(transitions)
+
+    def _record(self, transitions):
+        db = SessionLocal()
+        try:
+            ids = {}  # binding -> its alarm id after the transitions so far (0: cleared)
+            stored = []
+            for b, raised, ts, value in transitions:
+                if raised:
+                    rule = self.rules[self.rule[b]]
+                    alarm = Alarm(rule=rule["id"], node=self.node[b], severity=rule["severity"],
+                                  message=rule["message"], value=value, raised_at=ts)
+                    db.add(alarm)
+                    db.flush()
+                    alarm_id = ids[b] = alarm.id
+                else:
+                    # the alarm may have been raised earlier in this batch
+                    alarm_id = ids.get(b, self.alarm_id[b])
+                    if alarm_id:
+                        db.execute(update(Alarm).where(Alarm.id == alarm_id).values(cleared_at=ts))
+                    ids[b] = 0
+                stored.append((b, raised, ts, value, alarm_id))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            # nothing is stored: back to the state before the batch, so the next sample retries
+            for b, raised, _, _ in reversed(transitions):
+                self.active[b] = 0 if raised else 1
+            self.metrics["errors"] += 1
+            print(f"Alarms: failed to store {len(transitions)} transitions: {e}")
+            return []
+        finally:
+            db.close()
+        events = []
+        for b, raised, ts, value, alarm_id in stored:
+            self.alarm_id[b] = alarm_id
+            self.seq += 1
+            event = dict(self._describe(b), seq=self.seq, event="raised" if raised else "cleared",
+                         time=to_iso(ts), value=value)
+            if raised:
+                self.raised_at[b] = ts
+            else:
+                self.alarm_id[b] = 0
+                self.raised_at[b] = math.nan
+            self.events.append(event)
+            events.append(event)
+            self.metrics["raised" if raised else "cleared"] += 1
+        return events
+
+    def _describe(self, b):
+        rule = self.rules[self.rule[b]]
+        bench, device, value_type, node_id = self.nodes[self.node[b]]
+        return {
+            "id": self.alarm_id[b] or None,
+            "rule": rule["id"],
+            "severity": rule["severity"],
+            "message": rule["message"],
+            "bench": bench,
+            "device": device,
+            "type": value_type,
+            "node_id": node_id,
+        }
+
+    def active_alarms(self, bench=None):
+        with self.lock:
+            result = []
+            for b, on in enumerate(self.active):
+                if on and (not bench or self.nodes[self.node[b]][0] == bench):
+                    raised_at = self.raised_at[b]
+                    result.append(dict(self._describe(b), raised_at=None if raised_at != raised_at else to_iso(raised_at),
+                                       value=None if self.last_value[b] != self.last_value[b] else self.last_value[b]))
+            return result
+
+    def events_since(self, seq):
+        """Buffered events with a sequence number above seq (oldest first)."""
+        with self.lock:
+            return [event for event in self.events if event["seq"] > seq]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, rules=len(self.rules), bindings=len(self.rule),
+                        active=sum(self.active), seq=self.seq)
+
+
+alarm_engine = AlarmEngine(load_rules())
@@ -0,0 +1,223 @@
+# Optional DuckDB analytics engine for historical data.
+#
+# The historian SQLite file (and any archive files matching ANALYTICS_ARCHIVES,
+# e.g. "archive/*.db") are attached read-only into an in-process DuckDB and
+# exposed as one view `history`. Only predefined, parameterized aggregations
+# can be run, through POST /analytics/query:
+#
+#   {"query": "percentiles", "params": {"start": "...", "end": "...", "match": "%Strom%", "bench": "bench1"}}
+#
+# DuckDB executes them vectorized and multi-threaded (ANALYTICS_THREADS). If the
+# duckdb package is not installed, or its sqlite extension can neither be loaded
+# nor downloaded, the endpoints answer 503 and nothing else in the backend is
+# affected; a failed setup is retried at most every ANALYTICS_RETRY_SECONDS.
+# The lifespan prepares the connection in the background (start()), so the
+# extension is loaded once and not on the first query.
+import glob
+import math
+import os
+import threading
+import time
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from backend.models import DATABASE_URL
+
+router = APIRouter(prefix="/analytics")
+
+ANALYTICS_ARCHIVES = os.environ.get("ANALYTICS_ARCHIVES", "")
+ANALYTICS_THREADS = int(os.environ.get("ANALYTICS_THREADS", str(os.cpu_count() or 4)))
+ANALYTICS_MAX_ROWS = int(os.environ.get("ANALYTICS_MAX_ROWS", "10000"))
+ANALYTICS_RETRY_SECONDS = float(os.environ.get("ANALYTICS_RETRY_SECONDS", "60"))
+
+# Common filter for all queries: $start/$end (ISO strings, optional), $match (LIKE on
+# device.type/node_id) and $bench (one test bench; all benches if omitted)
+_FILTER = """
+    WHERE ($start IS NULL OR ts >= CAST($start AS TIMESTAMP))
+      AND ($end IS NULL OR ts <= CAST($end AS TIMESTAMP))
+      AND ($match IS NULL OR series LIKE $match OR node_id LIKE $match)
+      AND ($bench IS NULL OR bench = $bench)
+      AND value IS NOT NULL
+"""
+
+QUERIES = {
+    "percentiles": {
+        "description": "Distribution per series (valve/parameter): count, mean, std, min, p05, p50, p95, p99, max",
+        "params": ["start", "end", "match", "bench"],
+        "sql": f"""
+            SELECT bench, device, series, node_id, count(*) AS count, avg(value) AS mean, stddev_samp(value) AS std,
+                   min(value) AS min, quantile_cont(value, 0.05) AS p05, quantile_cont(value, 0.5) AS p50,
+                   quantile_cont(value, 0.95) AS p95, quantile_cont(value, 0.99) AS p99, max(value) AS max
+            FROM history {_FILTER}
+            GROUP BY bench, device, series, node_id
+            ORDER BY bench, device, series
+        """,
+    },
+    "per_block": {
+        "description": "Same parameter compared across Block1-4: stats per block and parameter name",
+        "params": ["start", "end", "match", "bench"],
+        "sql": f"""
+            SELECT bench, regexp_extract(device || '.' || series, 'Block[0-9]+') AS block,
+                   regexp_replace(series, '.*\\.', '') AS parameter,
+                   count(*) AS count, avg(value) AS mean, stddev_samp(value) AS std,
+                   quantile_cont(value, 0.5) AS p50, quantile_cont(value, 0.95) AS p95, min(value) AS min, max(value) AS max
+            FROM history {_FILTER}
+            GROUP BY ALL
+            ORDER BY parameter, bench, block
+        """,
+    },
+    "drift": {
+        "description": "Drift per series: linear trend per hour and mean of the first vs. last bucket ($bucket, e.g. '1 hour')",
+        "params": ["start", "end", "match", "bench", "bucket"],
+        "sql": f"""
+            WITH b AS (
+                SELECT bench, device, series, node_id, time_bucket(CAST(coalesce($bucket, '1 hour') AS INTERVAL), ts) AS bucket,
+                       avg(value) AS mean
+                FROM history {_FILTER}
+                GROUP BY ALL
+            )
+            SELECT bench, device, series, node_id, count(*) AS buckets,
+                   regr_slope(mean, epoch(bucket)) * 3600 AS slope_per_hour,
+                   arg_min(mean, bucket) AS first_mean, arg_max(mean, bucket) AS last_mean,
+                   arg_max(mean, bucket) - arg_min(mean, bucket) AS drift
+            FROM b
+            GROUP BY bench, device, series, node_id
+            ORDER BY abs(drift) DESC NULLS LAST
+        """,
+    },
+    "compare_runs": {
+        "description": "Stats per series for several test runs: $runs = [{\"name\", \"start\", \"end\"}, ...]",
+        "params": ["runs", "match", "bench"],
+        "sql": """
+            WITH runs AS (
+                SELECT r.name AS run, CAST(r.start AS TIMESTAMP) AS run_start, CAST(r."end" AS TIMESTAMP) AS run_end
+                FROM (SELECT unnest(CAST($runs AS STRUCT(name VARCHAR, start VARCHAR, "end" VARCHAR)[])) AS r)
+            )
+            SELECT run, bench, device, series, node_id, count(*) AS count, avg(value) AS mean, stddev_samp(value) AS std,
+                   min(value) AS min, quantile_cont(value, 0.5) AS p50, quantile_cont(value, 0.95) AS p95, max(value) AS max
+            FROM history JOIN runs ON ts BETWEEN run_start AND run_end
+            WHERE ($match IS NULL OR series LIKE $match OR node_id LIKE $match)
+              AND ($bench IS NULL OR bench = $bench) AND value IS NOT NULL
+            GROUP BY ALL
+            ORDER BY bench, series, run
+        """,
+    },
+}
+
+
+class AnalyticsQuery(BaseModel):
+    query: str
+    params: dict = {}
+
+
+_lock = threading.Lock()
+_connection = None
+_last_error = None
+_next_attempt = 0.0
+
+
+def sqlite_path():
+    return DATABASE_URL.split("sqlite:///", 1)[-1]
+
+
+def get_connection():
+    """Lazily create the shared DuckDB connection with the historian and archives attached read-only."""
+    global _connection, _last_error, _next_attempt
+    with _lock:
+        if _connection is not None:
+            return _connection
+        try:
+            import duckdb
+        except ImportError:
+            raise HTTPException(status_code=503, detail="Analytics engine not available: pip install duckdb")
+        if time.monotonic() < _next_attempt:
+            raise HTTPException(status_code=503, detail=f"Analytics engine not available: {_last_error}")
+        try:
+            _connection = _connect(duckdb)
+        except duckdb.Error as e:
+            _last_error = str(e).splitlines()[0]
+            _next_attempt = time.monotonic() + ANALYTICS_RETRY_SECONDS
+            raise HTTPException(status_code=503, detail=f"Analytics engine not available: {_last_error}")
+        _last_error = None
+        return _connection
+
+
+def _connect(duckdb):
+    con = duckdb.connect(database=":memory:")
+    try:
+        con.execute(f"SET threads = {ANALYTICS_THREADS}")
+        try:
+            con.execute("LOAD sqlite")
+        except duckdb.Error:
+            # not installed yet: download once (needs network)
+            con.execute("INSTALL sqlite")
+            con.execute("LOAD sqlite")
+        files = [sqlite_path()] + sorted(glob.glob(ANALYTICS_ARCHIVES) if ANALYTICS_ARCHIVES else [])
+        selects = []
+        for i, path in enumerate(files):
+            con.execute(f"ATTACH '{os.path.abspath(path)}' AS h{i} (TYPE SQLITE, READ_ONLY)")
+            # rows hold the integer node id and unix seconds; names come from the node dictionary
+            selects.append(f"""
+                SELECT n.bench, d.name AS device, d.name || '.' || n.type AS series, n.type, n."index", n.node_id,
+                       CAST(v.value AS DOUBLE) AS value,
+                       make_timestamp(CAST(CAST(v.timestamp AS DOUBLE) * 1000000 AS BIGINT)) AS ts
+                FROM h{i}.historical_values v
+                JOIN h{i}.nodes n ON n.id = v.node
+                JOIN h{i}.devices d ON d.id = n.device_id""")
+        con.execute("CREATE VIEW history AS " + " UNION ALL ".join(selects))
+    except BaseException:
+        con.close()
+        raise
+    return con
+
+
+def start():
+    """Prepare the connection in the background if duckdb is installed; errors are reported by the endpoints."""
+    import importlib.util
+    if importlib.util.find_spec("duckdb") is None:
+        return
+
+    def prepare():
+        try:
+            get_connection()
+        except HTTPException as e:
+            print(f"Analytics: {e.detail}")
+    threading.Thread(target=prepare, name="analytics-init", daemon=True).start()
+
+
+def run_query(con, name, params):
+    spec = QUERIES.get(name)
+    if spec is None:
+        raise HTTPException(status_code=404, detail=f"Unknown analytics query {name}")
+    unknown = set(params) - set(spec["params"])
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown parameters for {name}: {sorted(unknown)}")
+    if "runs" in spec["params"] and not params.get("runs"):
+        raise HTTPException(status_code=400, detail="Parameter 'runs' is required")
+    bound = {p: params.get(p) for p in spec["params"]}
+    import duckdb
+    # each request gets its own cursor on the shared database
+    cur = con.cursor()
+    try:
+        cur.execute(spec["sql"], bound)
+        columns = [d[0] for d in cur.description]
+        rows = cur.fetchmany(ANALYTICS_MAX_ROWS)
+    except (duckdb.DataError, duckdb.ProgrammingError) as e:
+        # a parameter DuckDB cannot cast or bind (e.g. start="garbage", bucket="xyz"): the client's error
+        raise HTTPException(status_code=400, detail=f"Invalid parameters for {name}: {str(e).splitlines()[0]}")
+    finally:
+        cur.close()
+    # NaN/inf (e.g. the slope of a single-bucket series) are not valid JSON: NULL instead
+    rows = [[None if isinstance(v, float) and not math.isfinite(v) else v for v in r] for r in rows]
+    return {"query": name, "columns": columns, "rows": rows, "truncated": len(rows) == ANALYTICS_MAX_ROWS}
+
+
+@router.get("/queries")
+def list_queries():
+    return {name: {"description": q["description"], "params": q["params"]} for name, q in QUERIES.items()}
+
+
+@router.post("/query")
+def analytics_query(body: AnalyticsQuery):
+    return run_query(get_connection(), body.query, body.params)
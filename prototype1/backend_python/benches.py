@@ -0,0 +1,316 @@
+# Test benches: the OPC UA endpoints this backend polls.
+#
+# BENCHES_FILE points to a JSON list, one object per bench:
+#
+#   [{"id": "bench1", "url": "opc.tcp://10.0.0.11:4840",
+#     "mapping": "SPSData/Mapping_Ventiltester_V5_NS5.xml", "interval": 1.0}, ...]
+#
+# Relative mapping paths are resolved against the directory of BENCHES_FILE.
+# Without it there is a single bench "default" at OPCUA_SERVER_URL polling the
+# built-in node list every 5 s. Every bench has its own OPC UA session, node list
+# and poller thread, so a slow or dead bench only delays itself. A sweep reads all
+# nodes of a bench with batched Read requests and hands the values to the
+# historian, tagged with the bench id; a rising *_Start/*_Stop bit also takes a
+# full-state snapshot (backend.snapshots). Each sweep is also published to a
+# shared-memory table (backend.shared_values) that every worker reads; with
+# several workers only the elected one polls. The table also holds the simulated
+# DeviceX.SimValueY/ParamValueY nodes behind /sim_values and /param_values: they
+# are read in the same batched Read but not stored in the history.
+import datetime
+import json
+import math
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from array import array
+
+from fastapi import HTTPException
+
+from backend.models import DEFAULT_BENCH
+from backend.opcua_client import OPCUASession, OPCUAUnavailable, OPCUA_SERVER_URL, OPCUA_TIMEOUT
+from backend.historian import historian
+from backend.profiling import profiler, span
+from backend.snapshots import snapshot_store
+from backend.shared_values import SharedTable
+
+BENCHES_FILE = os.environ.get("BENCHES_FILE", "")
+DEFAULT_INTERVAL = 5.0
+BENCH_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# Device nodes served by /sim_values and /param_values from the shared table
+NUM_DEVICES = 10
+NUM_VALUES = 10
+
+
+def device_value_nodes(kind):
+    """Node ids of DeviceX.<kind>Y in device/index order, e.g. kind "SimValue"."""
+    return [f"ns=2;s=Device{d+1}.{kind}{i+1}" for d in range(NUM_DEVICES) for i in range(NUM_VALUES)]
+
+
+DEVICE_VALUE_NODES = device_value_nodes("SimValue") + device_value_nodes("ParamValue")
+
+# Nodes polled when a bench has no mapping file: (block, variables)
+DEFAULT_NODES = [
+    ("AllgemeineParameter", [
+        "SkalierungDruckmessungMin",
+        "SkalierungDruckmessungMax",
+        "SkalierungDurchflussmessungMin",
+        "SkalierungDurchflussmessungMax",
+        "Fehlerbit"
+    ]),
+    ("Ventilkonfiguration", [
+        "VentilanzahlInVerwendung",
+        "VentilSperre",
+        "PWM.Anregung",
+        "PWM.Anregungszeit",
+        "PWM.Zwischenerregung",
+        "PWM.Zwischenerregungszeit",
+        "PWM.Halten",
+        "KonfigÜbernehmen"
+    ]),
+    ("Kommandos", [
+        "Langzeittest_Start",
+        "Langzeittest_Stop",
+        "Detailtest_Start",
+        "Detailtest_Stop",
+        "Einzeltest_Start",
+        "Einzeltest_Stop"
+    ])
+]
+
+
+def load_mapping(path):
+    """(device, type, index, node_id) for every Mapping of an SPSData mapping file.
+
+    Labels look like "Block1.DB_Daten_Langzeittest_1.Ventil3.Schaltzyklen": the first
+    two parts are the device, the rest is the type.
+    """
+    root = ET.parse(path).getroot()
+    mappings = root.find("Mappings")
+    if mappings is None:
+        return []
+    nodes = []
+    for mapping in mappings.iter("Mapping"):
+        node_id = mapping.get("NodeId")
+        if not node_id:
+            continue
+        parts = (mapping.get("Label") or node_id).split(".")
+        device = ".".join(parts[:2]) if len(parts) > 2 else parts[0]
+        value_type = ".".join(parts[2:]) if len(parts) > 2 else parts[-1]
+        nodes.append((device, value_type, 0, node_id))
+    return nodes
+
+
+class Bench:
+    def __init__(self, id, url, mapping=None, interval=DEFAULT_INTERVAL, timeout=OPCUA_TIMEOUT):
+        if not BENCH_ID.match(id):
+            raise ValueError(f"Invalid bench id {id!r}: letters, digits, '_' and '-' only")
+        self.id = id
+        self.url = url
+        self.mapping = mapping
+        self.interval = float(interval)
+        self.session = OPCUASession(url, timeout=timeout)
+        self._nodes = None
+        self._table_nodes = None
+        self.table = None  # shared current values; created by the poller, attached by readers
+        self._thread = None
+        self._stop = threading.Event()
+        self.metrics = {
+            "sweeps": 0,
+            "skipped": 0,
+            "overruns": 0,
+            "samples": 0,
+            "last_sweep_ms": None,
+            "last_sweep_at": None,
+        }
+
+    def nodes(self):
+        """(device, type, index, node_id) polled on this bench; the mapping file is parsed on first use."""
+        if self._nodes is None:
+            if self.mapping:
+                self._nodes = load_mapping(self.mapping)
+            else:
+                self._nodes = [(block, var, 0, f"ns=2;s={block}.{var}") for block, variables in DEFAULT_NODES for var in variables]
+        return self._nodes
+
+    def table_nodes(self):
+        """Node ids of the shared table: the mapped nodes, then the device value nodes not mapped already."""
+        if self._table_nodes is None:
+            mapped = [node_id for _, _, _, node_id in self.nodes()]
+            known = set(mapped)
+            self._table_nodes = mapped + [node_id for node_id in DEVICE_VALUE_NODES if node_id not in known]
+        return self._table_nodes
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            if self.table is None:
+                self.table = self._open_table(create=True)
+            self._thread = threading.Thread(target=self._run, name=f"poller-{self.id}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _open_table(self, create):
+        try:
+            return SharedTable.open(self.id, self.table_nodes(), create=create)
+        except Exception as e:
+            if create:
+                print(f"Bench {self.id}: no shared current-value table: {e}")
+            return None
+
+    def current_table(self):
+        """The shared table the poller publishes to; None while no poller has created it."""
+        if self.table is None:
+            self.table = self._open_table(create=False)
+        return self.table
+
+    def written(self, node_id, value):
+        """A client wrote value to node_id through this process: show it until the next sweep reads it back."""
+        if self.table is not None:
+            number = _number(value)
+            self.table.update(node_id, math.nan if number is None else float(number))
+
+    @property
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self):
+        next_run = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except OPCUAUnavailable:
+                # no server: skip this sweep instead of storing empty samples; the session retries later
+                self.metrics["skipped"] += 1
+            except Exception as e:
+                self.metrics["skipped"] += 1
+                print(f"Bench {self.id}: sweep failed: {e}")
+            # fixed rate; a sweep longer than the interval starts the next one at once
+            next_run += self.interval
+            delay = next_run - time.monotonic()
+            if delay < 0:
+                self.metrics["overruns"] += 1
+                next_run = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def sweep(self):
+        with profiler.trace("poll", bench=self.id):
+            self._sweep()
+
+    def _sweep(self):
+        started = time.perf_counter()
+        nodes = self.nodes()
+        node_ids = self.table_nodes()
+        with span("read", nodes=len(node_ids)):
+            read = self.session.read_values(node_ids)
+        timestamp = datetime.datetime.utcnow().isoformat()
+        table = self.table
+        if table is not None:
+            with span("publish"):
+                table.publish(array('d', [math.nan if (v := _number(value)) is None else v for value in read]),
+                              time.time())
+        # only the mapped nodes are history; the device value nodes follow them
+        values = read[:len(nodes)]
+        with span("transform"):
+            samples = []
+            for (device, value_type, index, node_id), value in zip(nodes, values):
+                if isinstance(value, (list, tuple)):
+                    # arrays: one series per element
+                    for i, item in enumerate(value):
+                        samples.append((device, value_type, i, f"{node_id}[{i}]", _number(item)))
+                else:
+                    samples.append((device, value_type, index, node_id, _number(value)))
+        # DB write and commit happen in the historian writer thread (its own "historian.write" traces)
+        with span("enqueue", samples=len(samples)):
+            for device, value_type, index, node_id, value in samples:
+                historian.add(self.id, device, value_type, index, node_id, value, timestamp)
+        snapshot_store.on_sweep(self, nodes, values)
+        self.metrics["sweeps"] += 1
+        self.metrics["samples"] += len(samples)
+        self.metrics["last_sweep_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.metrics["last_sweep_at"] = timestamp
+
+    def stats(self):
+        return dict(self.metrics, id=self.id, url=self.url, mapping=self.mapping, interval=self.interval,
+                    nodes=len(self._nodes) if self._nodes is not None else None, running=self.running,
+                    opcua=self.session.stats(), shared_table=self.table.stats() if self.table is not None else None)
+
+
+def _number(value):
+    # values are stored as floats; strings, structures etc. are stored as empty samples
+    if isinstance(value, bool):
+        return float(value)
+    return value if isinstance(value, (int, float)) else None
+
+
+class BenchRegistry:
+    def __init__(self, benches):
+        if not benches:
+            raise ValueError("At least one bench is required")
+        self.benches = {}
+        for bench in benches:
+            if bench.id in self.benches:
+                raise ValueError(f"Duplicate bench id {bench.id!r}")
+            self.benches[bench.id] = bench
+        self.default_id = benches[0].id
+
+    def __iter__(self):
+        return iter(self.benches.values())
+
+    def get(self, bench_id=None):
+        bench = self.benches.get(bench_id or self.default_id)
+        if bench is None:
+            raise HTTPException(status_code=404, detail=f"Unknown bench {bench_id}")
+        return bench
+
+    def resolve_id(self, bench_id=None):
+        # stored data may belong to benches that are no longer configured, so no lookup here
+        return bench_id or self.default_id
+
+    def start(self):
+        for bench in self:
+            bench.start()
+
+    def stop(self, timeout=10.0):
+        for bench in self:
+            bench.stop()
+        deadline = time.monotonic() + timeout
+        for bench in self:
+            bench.join(max(0.0, deadline - time.monotonic()))
+        for bench in self:
+            bench.session.close()
+            if bench.table is not None:
+                bench.table.close()
+                bench.table = None
+
+    def stats(self):
+        return {bench.id: bench.stats() for bench in self}
+
+
+def load_benches(path=BENCHES_FILE):
+    if not path:
+        return BenchRegistry([Bench(DEFAULT_BENCH, OPCUA_SERVER_URL)])
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    benches = []
+    for entry in config:
+        mapping = entry.get("mapping")
+        if mapping and not os.path.isabs(mapping):
+            mapping = os.path.join(base, mapping)
+        benches.append(Bench(entry["id"], entry["url"], mapping=mapping,
+                             interval=entry.get("interval", DEFAULT_INTERVAL),
+                             timeout=entry.get("timeout", OPCUA_TIMEOUT)))
+    return BenchRegistry(benches)
+
+
+benches = load_benches()
@@ -0,0 +1,179 @@
+# Endpoints for the Grafana simpod-json-datasource plugin (datasource URL: http://<backend>:8000/grafana)
+#
+#   GET  /grafana/             connection test
+#   POST /grafana/search       list of selectable series (one per bench and node_id)
+#   POST /grafana/query        time series, aggregated to the panel's maxDataPoints
+#   POST /grafana/annotations  test start/stop events from the Kommandos section
+#
+# Queries never return raw rows: the requested range is split into at most
+# maxDataPoints buckets and every bucket is answered with one aggregated point,
+# read from the coarsest rollup level (backend.rollups) that fits the bucket width.
+# Complete buckets are kept in backend.query_cache, so a dashboard refresh only
+# reads the buckets after the last committed sample.
+#
+# Targets are "<bench>|<node_id>"; a target without "|" (dashboards from before
+# multi-bench support) refers to the default bench.
+import datetime
+import math
+
+from fastapi import APIRouter, Depends
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from backend.models import get_db, Device, Node, HistoricalValue, DEFAULT_BENCH
+from backend.nodes import node_dictionary, to_epoch
+from backend.rollups import pick_level, level_buckets
+from backend.query_cache import query_cache
+
+router = APIRouter(prefix="/grafana")
+
+DEFAULT_MAX_POINTS = 1000
+# Kommandos nodes whose rising edge marks a test start/stop
+COMMAND_SUFFIXES = ("_Start", "_Stop")
+
+
+def parse_grafana_time(value):
+    # Grafana sends ISO timestamps with 'Z'; the backend works with naive UTC datetimes
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def to_epoch_ms(dt):
+    return int(dt.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def bucket_seconds(start, end, max_points):
+    span = max((end - start).total_seconds(), 1.0)
+    return max(span / max(max_points, 1), 0.001)
+
+
+def query_series(db, node, start, end, max_points):
+    """Return [[value, epoch_ms], ...] for node (nodes.id) in [start, end] with at most max_points buckets (avg per bucket)."""
+    width = bucket_seconds(start, end, max_points)
+    # best-fitting rollup level; raw rows only when the panel wants sub-second resolution
+    level = pick_level(width)
+    if level is not None:
+        level_width, table = level
+        # whole level buckets per output bucket, so no level bucket is split
+        width = math.ceil(width / level_width) * level_width
+
+        def fetch(lo, hi, include_hi):
+            # level buckets are whole seconds: [lo, hi) is bucket <= hi - 1
+            buckets = level_buckets(db, table, node, int(lo) // level_width * level_width,
+                                    hi if include_hi else hi - 1, width)
+            return [(b, node, avg) for b, avg, _, _, _ in buckets]
+        rows = query_cache.query(db, ("series", node, width), [node], to_epoch(start), to_epoch(end), fetch, width)
+        return [[avg, int(b * 1000)] for b, _, avg in rows]
+    bucket = func.floor(HistoricalValue.timestamp / width)
+    rows = (
+        db.query(bucket.label("bucket"), func.avg(HistoricalValue.value))
+        .filter(HistoricalValue.node == node)
+        .filter(HistoricalValue.timestamp >= to_epoch(start))
+        .filter(HistoricalValue.timestamp <= to_epoch(end))
+        .filter(HistoricalValue.value.isnot(None))
+        .group_by("bucket")
+        .order_by("bucket")
+        .all()
+    )
+    return [[value, int(b * width * 1000)] for b, value in rows]
+
+
+@router.get("/")
+def grafana_health():
+    return {"status": "ok"}
+
+
+@router.post("/search")
+def grafana_search(body: dict = None, db: Session = Depends(get_db)):
+    target = ((body or {}).get("target") or "").lower()
+    # the node dictionary has exactly one row per series, so this never touches the history table
+    rows = (
+        db.query(Node.bench, Device.name, Node.type, Node.index, Node.node_id)
+        .join(Device, Device.id == Node.device_id)
+        .all()
+    )
+    result = []
+    for bench, device, value_type, index, node_id in rows:
+        text = f"{bench}: {device}.{value_type}" + (f"[{index}]" if index else "")
+        if target and target not in text.lower() and target not in (node_id or "").lower():
+            continue
+        result.append({"text": text, "value": f"{bench}|{node_id}"})
+    return sorted(result, key=lambda r: r["text"])
+
+
+@router.post("/query")
+def grafana_query(body: dict, db: Session = Depends(get_db)):
+    start = parse_grafana_time(body["range"]["from"])
+    end = parse_grafana_time(body["range"]["to"])
+    max_points = int(body.get("maxDataPoints") or DEFAULT_MAX_POINTS)
+    result = []
+    for t in body.get("targets", []):
+        target = t.get("target")
+        if not target or t.get("hide"):
+            continue
+        bench, sep, node_id = target.partition("|")
+        if not sep:
+            bench, node_id = DEFAULT_BENCH, target
+        info = node_dictionary.lookup(db, bench, node_id)
+        datapoints = query_series(db, info.id, start, end, max_points) if info else []
+        result.append({"target": target, "datapoints": datapoints})
+    return result
+
+
+@router.post("/annotations")
+def grafana_annotations(body: dict, db: Session = Depends(get_db)):
+    start = parse_grafana_time(body["range"]["from"])
+    end = parse_grafana_time(body["range"]["to"])
+    annotation = body.get("annotation") or {}
+    command_nodes = (
+        db.query(Node.id)
+        .join(Device, Device.id == Node.device_id)
+        .filter(or_(Device.name.like("%Kommandos%"), Node.type.like("%Kommandos%")))
+        .filter(or_(*[Node.type.like(f"%{s}") for s in COMMAND_SUFFIXES]))
+        .all()
+    )
+    ids = [node for node, in command_nodes]
+    if not ids:
+        return []
+    # state of every command just before the range, so an edge at the range start is detected correctly
+    before = (
+        db.query(HistoricalValue.node, func.max(HistoricalValue.timestamp).label("ts"))
+        .filter(HistoricalValue.node.in_(ids))
+        .filter(HistoricalValue.timestamp < to_epoch(start))
+        .group_by(HistoricalValue.node)
+        .subquery()
+    )
+    last = {
+        node: bool(value)
+        for node, value in (
+            db.query(HistoricalValue.node, HistoricalValue.value)
+            .join(before, (before.c.node == HistoricalValue.node) & (before.c.ts == HistoricalValue.timestamp))
+        )
+    }
+    query = (
+        db.query(HistoricalValue.node, HistoricalValue.value, HistoricalValue.timestamp)
+        .filter(HistoricalValue.node.in_(ids))
+        .filter(HistoricalValue.timestamp >= to_epoch(start))
+        .filter(HistoricalValue.timestamp <= to_epoch(end))
+        .order_by(HistoricalValue.timestamp)
+    )
+    events = []
+    for node, value, timestamp in query:
+        active = bool(value)
+        # rising edge of the command bit; without an earlier sample the first one only sets the state
+        if active and last.get(node, True) is False:
+            info = node_dictionary.info(db, node)
+            device, command = info.device, info.type
+            block = device.split(".")[0]
+            action = command.rsplit(".", 1)[-1]
+            events.append({
+                "annotation": annotation,
+                "time": int(timestamp * 1000),
+                "title": f"{info.bench} {block} {action}",
+                "text": f"{info.bench}: {device}.{command}",
+                "tags": [info.bench, block, action.rsplit("_", 1)[-1].lower()],
+            })
+        last[node] = active
+    return sorted(events, key=lambda e: e["time"])
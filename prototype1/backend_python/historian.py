@@ -0,0 +1,400 @@
+# Single-writer historian.
+#
+# All DB writes of samples (poller, /save_data) go through one bounded queue
+# that is drained by a single writer thread. The writer groups samples into one
+# transaction per batch (HISTORIAN_BATCH_SIZE samples or HISTORIAN_BATCH_SECONDS,
+# whichever comes first) and, per batch, resolves node ids (creating missing
+# devices/nodes), upserts current_values, bulk-inserts historical_values and
+# merges the rollups. Committed samples then advance the query cache watermark
+# and go to the in-memory stages (recent_history, streaming_stats, alarms). HTTP
+# handlers only enqueue and never wait for the disk. A failing stage or batch is
+# logged and counted in metrics["errors"]; the writer thread keeps running.
+#
+# Other writes (snapshots) are queued as jobs with submit(fn): the writer runs
+# fn(db) in its own transaction, in queue order with the samples, and completes
+# the returned Future. Jobs always wait for queue space; they are never dropped
+# or spilled.
+#
+# Backpressure when the queue is full (HISTORIAN_POLICY):
+#   block        the producer waits for space (default)
+#   drop_oldest  the oldest queued sample is discarded
+#   spill        samples are appended to HISTORIAN_SPILL_FILE (NDJSON) and
+#                written once the queue has drained, one batch at a time;
+#                order is preserved. The read position is kept in
+#                <file>.offset and the file is removed only after its last
+#                batch is committed, so a spill left by a crash is drained
+#                after the next start.
+#
+# Durability (HISTORIAN_DURABILITY, applied as SQLite PRAGMA synchronous in
+# models.py): full, normal (default, WAL-safe against application crashes), off.
+import json
+import os
+import queue
+from concurrent.futures import Future
+import threading
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.dialects.sqlite import insert as upsert
+
+from backend.models import SessionLocal, CurrentValue, HistoricalValue
+from backend.nodes import node_dictionary, to_epoch
+from backend.rollups import update_rollups
+from backend.recent_history import recent_history
+from backend.streaming_stats import streaming_stats
+from backend.alarms import alarm_engine
+from backend.query_cache import query_cache
+from backend.profiling import profiler, span
+
+HISTORIAN_QUEUE_SIZE = int(os.environ.get("HISTORIAN_QUEUE_SIZE", "10000"))
+HISTORIAN_BATCH_SIZE = int(os.environ.get("HISTORIAN_BATCH_SIZE", "500"))
+HISTORIAN_BATCH_SECONDS = float(os.environ.get("HISTORIAN_BATCH_SECONDS", "0.5"))
+HISTORIAN_POLICY = os.environ.get("HISTORIAN_POLICY", "block")
+HISTORIAN_SPILL_FILE = os.environ.get("HISTORIAN_SPILL_FILE", "historian_spill.ndjson")
+
+POLICIES = ("block", "drop_oldest", "spill")
+
+
+class Job:
+    __slots__ = ("fn", "future")
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.future = Future()
+
+
+class Historian:
+    def __init__(self, maxsize=HISTORIAN_QUEUE_SIZE, batch_size=HISTORIAN_BATCH_SIZE,
+                 batch_seconds=HISTORIAN_BATCH_SECONDS, policy=HISTORIAN_POLICY, spill_file=HISTORIAN_SPILL_FILE):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown historian policy {policy!r}, expected one of {POLICIES}")
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.policy = policy
+        self.spill_file = spill_file
+        self._spill_lock = threading.Lock()
+        self._spilling = False  # the spill file holds samples not yet written
+        self._spill_offset = 0  # bytes of the spill file already written
+        self._thread = None
+        self._stop = threading.Event()
+        self.metrics = {
+            "enqueued": 0,
+            "written": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "batches": 0,
+            "errors": 0,
+            "jobs": 0,
+            "job_errors": 0,
+            "max_depth": 0,
+            "last_batch_size": 0,
+            "last_commit_ms": 0.0,
+        }
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._resume_spill()
+            self._thread = threading.Thread(target=self._run, name="historian-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self.flush(timeout)
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    # --- producer side -------------------------------------------------
+
+    def add(self, bench, device, value_type, index, node_id, value, timestamp):
+        """Enqueue one sample (timestamp: naive UTC isoformat string). Returns without touching the DB."""
+        item = (bench, device, value_type, index, node_id, value, timestamp)
+        self.metrics["enqueued"] += 1
+        if self.policy == "spill":
+            with self._spill_lock:
+                if not self._spilling:
+                    try:
+                        self.queue.put_nowait(item)
+                        self._track_depth()
+                        return
+                    except queue.Full:
+                        self._spilling = True
+                self._spill([item])
+            return
+        if self.policy == "drop_oldest":
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        dropped = self.queue.get_nowait()
+                        self.queue.task_done()
+                    except queue.Empty:
+                        continue
+                    if isinstance(dropped, Job):
+                        # jobs are not samples to shed: back to the end of the queue (put waits for space)
+                        self.queue.put(dropped)
+                    else:
+                        self.metrics["dropped"] += 1
+        else:
+            self.queue.put(item)
+        self._track_depth()
+
+    def submit(self, fn):
+        """Queue fn(db) to run in the writer thread and commit; returns a Future of its result."""
+        job = Job(fn)
+        self.queue.put(job)
+        self._track_depth()
+        return job.future
+
+    def _track_depth(self):
+        depth = self.queue.qsize()
+        if depth > self.metrics["max_depth"]:
+            self.metrics["max_depth"] = depth
+
+    def _spill(self, items):
+        with open(self.spill_file, "a", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item))
+                f.write("\n")
+        self.metrics["spilled"] += len(items)
+
+    # --- writer side ---------------------------------------------------
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch, spill_end = self._take_spill()
+            if spill_end is None:
+                batch = self._collect()
+                if not batch:
+                    continue
+            try:
+                self._write_items(batch)
+            except Exception as e:
+                # the writer must outlive a bad batch: without it producers block, drop or spill forever
+                self.metrics["errors"] += 1
+                print(f"Historian: failed to process batch of {len(batch)} items: {e}")
+                for item in batch:
+                    if isinstance(item, Job) and not item.future.done():
+                        item.future.set_exception(e)
+            finally:
+                if spill_end is None:
+                    for _ in batch:
+                        self.queue.task_done()
+                else:
+                    # spilled items were never counted by the queue
+                    self._spill_done(spill_end)
+
+    def _write_items(self, batch):
+        samples = []
+        for item in batch:
+            if isinstance(item, Job):
+                # samples queued before the job are committed first
+                self._write_samples(samples)
+                samples = []
+                self._run_job(item)
+            else:
+                samples.append(item)
+        self._write_samples(samples)
+
+    def _collect(self):
+        # first item blocks briefly, then fill until size or time limit
+        try:
+            batch = [self.queue.get(timeout=self.batch_seconds)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _take_spill(self):
+        """(items, end offset) of the next batch in the spill file; ([], None) if there is none to write.
+
+        Queued samples are older than the spill, so it is read only once the queue is empty. While
+        it is drained new samples keep going to the end of the file, so order is preserved.
+        """
+        with self._spill_lock:
+            if not self._spilling or not self.queue.empty():
+                return [], None
+            items = []
+            try:
+                with open(self.spill_file, "rb") as f:
+                    f.seek(self._spill_offset)
+                    while len(items) < self.batch_size:
+                        line = f.readline()
+                        if not line:
+                            break
+                        if not line.strip():
+                            continue
+                        try:
+                            items.append(tuple(json.loads(line)))
+                        except ValueError:
+                            # a line torn by a crash during a spill write
+                            self.metrics["errors"] += 1
+                    return items, f.tell()
+            except FileNotFoundError:
+                self._spilling = False
+                self._spill_offset = 0
+                return [], None
+
+    def _spill_done(self, end):
+        """The spill file up to end is written: remember the position, remove the file once drained."""
+        with self._spill_lock:
+            try:
+                drained = end >= os.path.getsize(self.spill_file)
+                if drained:
+                    os.remove(self.spill_file)
+                    if os.path.exists(self.spill_file + ".offset"):
+                        os.remove(self.spill_file + ".offset")
+                else:
+                    tmp = self.spill_file + ".offset.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(str(end))
+                    os.replace(tmp, self.spill_file + ".offset")
+            except OSError as e:
+                self.metrics["errors"] += 1
+                print(f"Historian: failed to update spill file {self.spill_file}: {e}")
+                drained = False
+            if drained:
+                # producers go back to the queue
+                self._spilling = False
+                self._spill_offset = 0
+            else:
+                self._spill_offset = end
+
+    def _resume_spill(self):
+        # a spill file left by a previous run is drained from where that run stopped
+        with self._spill_lock:
+            if self._spilling or not os.path.exists(self.spill_file):
+                return
+            try:
+                with open(self.spill_file + ".offset", encoding="utf-8") as f:
+                    self._spill_offset = int(f.read())
+            except (OSError, ValueError):
+                self._spill_offset = 0
+            self._spilling = True
+
+    def _write_samples(self, samples):
+        for i in range(0, len(samples), self.batch_size):
+            self._write(samples[i:i + self.batch_size])
+
+    def _write(self, batch):
+        with profiler.trace("historian.write", samples=len(batch)):
+            self._write_batch(batch)
+
+    def _run_job(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        db = SessionLocal()
+        try:
+            with profiler.trace("historian.job"):
+                result = job.fn(db)
+                with span("commit"):
+                    db.commit()
+        except Exception as e:
+            db.rollback()
+            self.metrics["job_errors"] += 1
+            job.future.set_exception(e)
+        else:
+            self.metrics["jobs"] += 1
+            job.future.set_result(result)
+        finally:
+            db.close()
+
+    def _write_batch(self, batch):
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            current = {}
+            history = []
+            rollup_samples = []
+            with span("resolve"):
+                for bench, device, value_type, index, node_id, value, timestamp in batch:
+                    node = node_dictionary.resolve(db, bench, device, value_type, index, node_id)
+                    ts = to_epoch(timestamp)
+                    current[node] = {"node": node, "value": value, "timestamp": ts}
+                    history.append({"node": node, "timestamp": ts, "value": value})
+                    rollup_samples.append((node, ts, value))
+            with span("db.write"):
+                stmt = upsert(CurrentValue)
+                db.execute(stmt.on_conflict_do_update(index_elements=[CurrentValue.node],
+                                                      set_={"value": stmt.excluded.value, "timestamp": stmt.excluded.timestamp}),
+                           list(current.values()))
+                db.execute(insert(HistoricalValue), history)
+            with span("rollups"):
+                update_rollups(db, rollup_samples)
+            with span("commit"):
+                db.commit()
+        except Exception as e:
+            db.rollback()
+            # ids of nodes created in this transaction no longer exist
+            node_dictionary.invalidate()
+            self.metrics["errors"] += 1
+            print(f"Historian: failed to write batch of {len(batch)} samples: {e}")
+            return
+        finally:
+            db.close()
+        written = {}
+        stats_samples = []
+        alarm_samples = []
+        for (bench, device, value_type, index, node_id, value, _), row in zip(batch, history):
+            node, ts = row["node"], row["timestamp"]
+            seen = written.get(node)
+            written[node] = (ts, ts) if seen is None else (min(seen[0], ts), max(seen[1], ts))
+            stats_samples.append((bench, device, value_type, index, node_id, ts, value))
+            alarm_samples.append((node, bench, device, value_type, node_id, ts, value))
+        # the samples are committed: a failing stage only misses them, the others still run
+        self._after_commit("query_cache", query_cache.advance, written)
+        self._after_commit("recent_history", _add_recent, stats_samples)
+        self._after_commit("streaming_stats", streaming_stats.add_batch, stats_samples)
+        self._after_commit("alarms", alarm_engine.evaluate, alarm_samples)
+        self.metrics["written"] += len(batch)
+        self.metrics["batches"] += 1
+        self.metrics["last_batch_size"] = len(batch)
+        self.metrics["last_commit_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def _after_commit(self, stage, fn, arg):
+        with span(stage):
+            try:
+                fn(arg)
+            except Exception as e:
+                self.metrics["errors"] += 1
+                print(f"Historian: {stage} failed for committed samples: {e}")
+
+    # --- monitoring ----------------------------------------------------
+
+    def flush(self, timeout=10.0):
+        """Wait until everything enqueued so far is committed. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.queue.unfinished_tasks == 0 and not self._spilling:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def stats(self):
+        return dict(
+            self.metrics,
+            depth=self.queue.qsize(),
+            capacity=self.queue.maxsize,
+            policy=self.policy,
+            spilling=self._spilling,
+            running=bool(self._thread and self._thread.is_alive()),
+        )
+
+
+def _add_recent(samples):
+    for sample in samples:
+        recent_history.add(*sample)
+
+
+historian = Historian()
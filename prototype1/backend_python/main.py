@@ -1,6 +1,6 @@
 
 # Utility to build hierarchical OPC UA data tree
-def build_opcua_tree():
+def build_opcua_tree(session):
     # This is a static structure based on your provided hierarchy. In production, you may want to browse nodes dynamically.
     tree = {
         "AllgemeineParameter": [
@@ -28,7 +28,7 @@ def build_opcua_tree():
     def read_node(node):
         if isinstance(node, dict) and "node_id" in node:
             try:
-                value = sim_client.get_node(node["node_id"]).get_value()
+                value = session.read_value(node["node_id"])
             except Exception:
                 value = None
             return {"name": node.get("name", ""), "node_id": node["node_id"], "value": value}
@@ -40,25 +40,146 @@ def build_opcua_tree():
     return read_node(tree)
 
 
-from fastapi import FastAPI, HTTPException, Depends, Query
-from fastapi import FastAPI, HTTPException, Depends, Query
+import time
+_import_started = time.perf_counter()
+
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from backend.models import Base, engine, get_db, Device
-from backend.opcua_client import read_opcua_value, write_opcua_value
-from opcua import Client
-import uvicorn
-import threading
-import time
+from backend.benches import benches, device_value_nodes, NUM_DEVICES, NUM_VALUES
+from backend.grafana import router as grafana_router
+from backend.analytics import router as analytics_router, start as start_analytics
+from backend.recent_history import recent_history
+from backend.historian import historian
+from backend.nodes import node_dictionary, history_rows, check_layout, to_epoch, to_iso
+from backend.response_cache import response_cache, dumps
+from backend.streaming_stats import streaming_stats
+from backend.alarms import alarm_engine
+from backend.profiling import profiler, span
+from backend.snapshots import snapshot_store, SnapshotUnavailable
+from backend.query_cache import query_cache
+from backend.shared_values import poller_election, poller_endpoint, startup_lock
+import os
+
+# Cold start: import of this module -> lifespan done -> first request answered
+STARTUP_TARGET_MS = float(os.environ.get("STARTUP_TARGET_MS", "1500"))
+startup = {"import_ms": None, "lifespan_ms": None, "first_request_ms": None, "target_ms": STARTUP_TARGET_MS}
+
+# Everything with side effects happens here, not at import: the DB schema, the
+# historian writer and the bench pollers. OPC UA connects lazily on first use
+# (backend.opcua_client), so startup does not wait for or require the PLCs.
+# With several workers only the one holding the poller lock polls the benches;
+# the others read its shared current-value tables and forward POLLER_ROUTES to
+# it (backend.shared_values).
+def start_polling():
+    # this process now writes all samples: its query cache sees every commit from here on
+    query_cache.clear()
+    query_cache.active = True
+    benches.start()
+    poller_endpoint.start(app)
+
+@asynccontextmanager
+async def lifespan(app):
+    # workers start together: one at a time creates what is missing
+    with startup_lock():
+        check_layout(engine)
+        Base.metadata.create_all(bind=engine)
+    historian.start()
+    query_cache.active = False
+    poller_election.run(start_polling)
+    start_analytics()
+    # ready to serve; import + lifespan is what a restart costs
+    startup["lifespan_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
+    if startup["lifespan_ms"] > STARTUP_TARGET_MS:
+        print(f"Cold start took {startup['lifespan_ms']} ms (target {STARTUP_TARGET_MS} ms)")
+    try:
+        yield
+    finally:
+        poller_election.stop_waiting()
+        poller_endpoint.stop()
+        benches.stop()
+        historian.stop()
+        # only now, with the last sweep committed, may another worker start polling
+        poller_election.release()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def record_first_request(request: Request, call_next):
+    response = await call_next(request)
+    if startup["first_request_ms"] is None:
+        startup["first_request_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
+    return response
+
+# Opt-in profiling (backend.profiling): "X-Profile: 1" or ?profile=1 records spans and a stack profile
+# of this request; PROFILE_SAMPLE_RATE traces a random fraction of all requests (spans only)
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    flagged = request.headers.get("x-profile") == "1" or request.query_params.get("profile") == "1"
+    with profiler.trace(f"{request.method} {request.url.path}", force=flagged, stacks=flagged,
+                        query=str(request.url.query)) as trace:
+        response = await call_next(request)
+    if trace is not None:
+        response.headers["X-Profile-Id"] = trace.id
+    return response
+
+# Endpoints that need a PLC session or the in-memory state fed by the poller (statistics,
+# alarms, recent history). A worker that is not the elected poller forwards them to it;
+# polled values (/current_values, /sim_values, /param_values) come from the shared tables.
+POLLER_ROUTES = {
+    ("POST", "/param_values"), ("GET", "/opcua_tree"),
+    ("POST", "/read_opcua"), ("POST", "/write_opcua"), ("POST", "/save_data"), ("GET", "/benches"),
+    ("POST", "/snapshots"), ("GET", "/recent_values"), ("GET", "/stats"), ("POST", "/stats/reset"),
+    ("GET", "/stats/stream"), ("GET", "/alarms"), ("GET", "/alarms/stream"),
+}
 
+@app.middleware("http")
+async def forward_to_poller(request: Request, call_next):
+    if poller_election.leader or (request.method, request.url.path) not in POLLER_ROUTES:
+        return await call_next(request)
+    return await poller_endpoint.forward(request)
 
-app = FastAPI()
+# Liveness: the process answers. Readiness: DB, historian and all bench pollers are up.
+@app.get("/health/live")
+def health_live():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def health_ready():
+    # a worker that lost the poller election reads the shared tables and has no pollers of its own
+    checks = {"database": False, "historian": historian.stats()["running"],
+              "pollers": all(bench.running for bench in benches) if poller_election.leader else True}
+    try:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1 FROM nodes LIMIT 1")
+        checks["database"] = True
+    except Exception:
+        pass
+    ready = all(checks.values())
+    # OPC UA is reported but not required: history, exports and Grafana work without the PLCs
+    body = {"ready": ready, "checks": checks, "opcua": {bench.id: bench.session.stats() for bench in benches},
+            "poller": dict(poller_election.stats(), endpoint=poller_endpoint.stats()), "startup": startup}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+app.include_router(grafana_router)
+app.include_router(analytics_router)
 
 # Place this after app = FastAPI()
 @app.get("/opcua_tree")
-def get_opcua_tree():
-    return build_opcua_tree()
+def get_opcua_tree(request: Request, bench: str = Query(None)):
+    bench = benches.get(bench)
+    return response_cache.respond(request, f"/opcua_tree?bench={bench.id}", lambda: build_opcua_tree(bench.session))
+
+# Configured test benches with their poller and OPC UA session state
+@app.get("/benches")
+def get_benches():
+    return {"default": benches.default_id, "benches": benches.stats()}
 
 # Status endpoint for OPC UA server and backend
 import datetime
@@ -66,16 +187,12 @@ start_time = datetime.datetime.utcnow()
 
 @app.get("/status")
 def get_status(db: Session = Depends(get_db)):
-    # OPC UA server status
-    opcua_connected = False
-    try:
-        # Try to read a known node value
-        test_node_id = "ns=2;s=Device1.SimValue1"
-        node = sim_client.get_node(test_node_id)
-        value = node.get_value()
-        opcua_connected = value is not None
-    except Exception:
-        opcua_connected = False
+    # OPC UA server status (default bench; all benches under "benches"): connected while its
+    # poller keeps publishing sweeps, the same answer in every worker
+    bench = benches.get()
+    table = bench.current_table()
+    age = table.age() if table is not None else None
+    opcua_connected = age is not None and age < 3 * bench.interval
     # Database status
     db_status = True
     try:
@@ -89,7 +206,18 @@ def get_status(db: Session = Depends(get_db)):
     return {
         "opcua_connected": opcua_connected,
         "db_status": db_status,
-        "uptime_seconds": int(uptime)
+        "uptime_seconds": int(uptime),
+        "recent_history": recent_history.stats(),
+        "streaming_stats": streaming_stats.stats(),
+        "alarms": alarm_engine.stats(),
+        "profiling": profiler.stats(),
+        "snapshots": snapshot_store.stats(),
+        "historian": historian.stats(),
+        "response_cache": response_cache.stats(),
+        "query_cache": query_cache.stats(),
+        "benches": benches.stats(),
+        "poller": dict(poller_election.stats(), endpoint=poller_endpoint.stats()),
+        "startup": startup
     }
 
 # Get historical values filtered by device and time range
@@ -98,28 +226,291 @@ def get_historical_values(
     device_name: str = Query(...),
     start: str = Query(None),
     end: str = Query(None),
+    bench: str = Query(None),
     db: Session = Depends(get_db)
 ):
-    from backend.models import Device, HistoricalValue
-    device = db.query(Device).filter_by(name=device_name).first()
-    if not device:
+    bench = benches.resolve_id(bench)
+    start_dt, end_dt = _parse_range(start, end)
+    # ranges inside the in-memory window are answered without touching the DB
+    if recent_history.covers(bench, device_name, start_dt):
+        return recent_history.device_rows(bench, device_name, start_dt, end_dt)
+    # rows only hold the integer node id; expanded from the in-memory node dictionary
+    nodes = {info.id: info for info in node_dictionary.device_nodes(db, bench, device_name)}
+    if not nodes:
         return []
-    query = db.query(HistoricalValue).filter(HistoricalValue.device_id == device.id)
-    if start:
-        query = query.filter(HistoricalValue.timestamp >= start)
-    if end:
-        query = query.filter(HistoricalValue.timestamp <= end)
-    results = query.order_by(HistoricalValue.timestamp).all()
-    return [
-        {
-            "type": v.type,
-            "index": v.index,
-            "node_id": v.node_id,
-            "value": v.value,
-            "timestamp": v.timestamp
-        }
-        for v in results
-    ]
+
+    def fetch(lo, hi, include_hi):
+        return list(history_rows(db, nodes, None if lo == -math.inf else lo, None if hi == math.inf else hi, include_hi))
+    # committed ranges come from backend.query_cache; only the part after its watermark is queried
+    with span("query"):
+        rows = query_cache.query(db, ("rows", tuple(sorted(nodes))), list(nodes),
+                                 to_epoch(start_dt) if start_dt else None, to_epoch(end_dt) if end_dt else None, fetch)
+    with span("transform", rows=len(rows)):
+        return [
+            {
+                "bench": bench,
+                "type": nodes[node].type,
+                "index": nodes[node].index,
+                "node_id": nodes[node].node_id,
+                "value": value,
+                "timestamp": to_iso(ts)
+            }
+            for ts, node, value in rows
+        ]
+
+def _parse_range(start, end):
+    try:
+        return (datetime.datetime.fromisoformat(start) if start else None,
+                datetime.datetime.fromisoformat(end) if end else None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be ISO timestamps")
+
+# Last `seconds` of one node straight from the in-memory ring buffer, as two flat arrays
+@app.get("/recent_values")
+def get_recent_values(node_id: str = Query(...), seconds: float = Query(300.0, gt=0), bench: str = Query(None)):
+    bench = benches.resolve_id(bench)
+    start = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+    window = recent_history.window(bench, node_id, start)
+    if window is None:
+        raise HTTPException(status_code=404, detail=f"{node_id} is not buffered")
+    ts, values = window
+    values = values.tolist()
+    return {
+        "bench": bench,
+        "node_id": node_id,
+        "timestamps": ts.tolist(),
+        "values": [None if v != v else v for v in values] if any(v != v for v in values) else values
+    }
+
+# Running statistics per node (backend.streaming_stats); all benches unless bench is given
+@app.get("/stats")
+def get_stats(bench: str = Query(None), device_name: str = Query(None), node_id: str = Query(None)):
+    _, rows = streaming_stats.query(bench, device_name, node_id)
+    return rows
+
+# Start a new run: clears the accumulators of the matching sections
+@app.post("/stats/reset")
+def reset_stats(bench: str = Query(None), device_name: str = Query(None)):
+    return {"cleared": streaming_stats.reset(bench, device_name)}
+
+# Live stream (server-sent events): every `interval` seconds the stats of all sections that changed
+@app.get("/stats/stream")
+async def stream_stats(request: Request, bench: str = Query(None), device_name: str = Query(None),
+                       interval: float = Query(1.0, ge=0.1)):
+    from fastapi.responses import StreamingResponse
+
+    async def events():
+        since = 0
+        while not await request.is_disconnected():
+            since, rows = streaming_stats.query(bench, device_name, since=since)
+            if rows:
+                yield b"data: " + dumps(rows) + b"\n\n"
+            await asyncio.sleep(interval)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Alarms (backend.alarms): active now, stored episodes, rules and a live stream of raise/clear events
+@app.get("/alarms")
+def get_alarms(bench: str = Query(None)):
+    return alarm_engine.active_alarms(bench)
+
+@app.get("/alarms/history")
+def get_alarm_history(
+    start: str = Query(None),
+    end: str = Query(None),
+    bench: str = Query(None),
+    limit: int = Query(1000, gt=0, le=10000),
+    db: Session = Depends(get_db)
+):
+    from backend.models import Alarm, Node
+    start_dt, end_dt = _parse_range(start, end)
+    query = db.query(Alarm)
+    if start_dt:
+        query = query.filter(Alarm.raised_at >= to_epoch(start_dt))
+    if end_dt:
+        query = query.filter(Alarm.raised_at <= to_epoch(end_dt))
+    if bench:
+        query = query.join(Node, Node.id == Alarm.node).filter(Node.bench == bench)
+    rows = []
+    for alarm in query.order_by(Alarm.raised_at.desc()).limit(limit):
+        info = node_dictionary.info(db, alarm.node)
+        rows.append({
+            "id": alarm.id,
+            "rule": alarm.rule,
+            "severity": alarm.severity,
+            "message": alarm.message,
+            "bench": info.bench,
+            "device": info.device,
+            "type": info.type,
+            "node_id": info.node_id,
+            "value": alarm.value,
+            "raised_at": to_iso(alarm.raised_at),
+            "cleared_at": to_iso(alarm.cleared_at) if alarm.cleared_at is not None else None,
+        })
+    return rows
+
+@app.get("/alarms/rules")
+def get_alarm_rules():
+    return alarm_engine.rules
+
+# Server-sent events; a reconnecting client sends Last-Event-ID and gets the events it missed
+@app.get("/alarms/stream")
+async def stream_alarms(request: Request, bench: str = Query(None)):
+    from fastapi.responses import StreamingResponse
+    last_event_id = request.headers.get("last-event-id", "")
+    seq = int(last_event_id) if last_event_id.isdigit() else alarm_engine.seq
+
+    async def events():
+        nonlocal seq
+        while not await request.is_disconnected():
+            for event in alarm_engine.events_since(seq):
+                seq = event["seq"]
+                if not bench or event["bench"] == bench:
+                    yield b"id: %d\ndata: " % seq + dumps(event) + b"\n\n"
+            await asyncio.sleep(0.5)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Stored traces and profiles of backend.profiling
+@app.get("/profiling")
+def get_profiling():
+    return {"settings": profiler.stats(), "traces": profiler.list()}
+
+# Chrome trace-event JSON (chrome://tracing, Perfetto) of all stored traces, or of one
+@app.get("/profiling/trace")
+def get_profiling_trace(id: str = Query(None)):
+    if id and profiler.get(id) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown trace {id}")
+    filename = f"trace_{id or 'all'}.json"
+    return JSONResponse(profiler.chrome_trace(id), headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# Sampled stack profile of a flagged request, folded format (speedscope, flamegraph.pl)
+@app.get("/profiling/profiles/{trace_id}")
+def get_profiling_profile(trace_id: str):
+    from fastapi.responses import PlainTextResponse
+    trace = profiler.get(trace_id)
+    if trace is None or trace.profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile {trace_id}")
+    return PlainTextResponse(trace.profile.folded(),
+                             headers={"Content-Disposition": f'attachment; filename="profile_{trace_id}.folded"'})
+
+# Full-state snapshots (backend.snapshots): take one now, list, restore and diff stored ones
+@app.post("/snapshots")
+def take_snapshot(bench: str = Query(None), label: str = Query(None)):
+    from backend.opcua_client import OPCUAUnavailable
+    bench = benches.get(bench)
+    try:
+        return snapshot_store.take(bench, label)
+    except (OPCUAUnavailable, SnapshotUnavailable) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/snapshots")
+def get_snapshots(
+    bench: str = Query(None),
+    start: str = Query(None),
+    end: str = Query(None),
+    limit: int = Query(100, gt=0, le=10000),
+    db: Session = Depends(get_db)
+):
+    start_dt, end_dt = _parse_range(start, end)
+    return snapshot_store.list(db, bench, to_epoch(start_dt) if start_dt else None,
+                               to_epoch(end_dt) if end_dt else None, limit)
+
+@app.get("/snapshots/diff")
+def diff_snapshots(a: int = Query(...), b: int = Query(...), db: Session = Depends(get_db)):
+    try:
+        return snapshot_store.diff(db, a, b)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/snapshots/{snapshot_id}")
+def restore_snapshot(snapshot_id: int, db: Session = Depends(get_db)):
+    try:
+        return snapshot_store.restore(db, snapshot_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+EXPORT_BATCH_SIZE = 5000
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_COLUMNS = ("timestamp", "type", "index", "node_id", "value", "bench")
+
+def _export_rows(nodes, start, end):
+    # Own session: the generator outlives the request dependency. Plain tuples from one
+    # cursor per node, merged in timestamp order, so nothing is sorted before the first row.
+    from backend.models import SessionLocal
+    db = SessionLocal()
+    try:
+        rows = history_rows(db, nodes, to_epoch(start) if start else None, to_epoch(end) if end else None,
+                            batch=max(EXPORT_BATCH_SIZE // len(nodes), 100))
+        for ts, node, value in rows:
+            info = nodes[node]
+            yield to_iso(ts), info.type, info.index, info.node_id, value, info.bench
+    finally:
+        db.close()
+
+def _export_stream(nodes, start, end, fmt, use_gzip):
+    import csv
+    import io
+    import json
+    import zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n") if fmt == "csv" else None
+
+    def flush(sync=False):
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        if not compressor:
+            return data
+        data = compressor.compress(data)
+        return data + compressor.flush(zlib.Z_SYNC_FLUSH) if sync else data
+
+    # CSV header goes out before the query runs, so the client sees the first byte at once
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+        yield flush(sync=True)
+    for row in _export_rows(nodes, start, end):
+        if writer:
+            writer.writerow(row)
+        else:
+            buf.write(json.dumps(dict(zip(EXPORT_COLUMNS, row))))
+            buf.write("\n")
+        if buf.tell() >= EXPORT_CHUNK_BYTES:
+            chunk = flush()
+            if chunk:
+                yield chunk
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+# Stream historical values as CSV or NDJSON (chunked, optionally gzip-compressed).
+# Memory use is bounded by one fetch batch + one output chunk, independent of the row count.
+@app.get("/historical_values/export")
+def export_historical_values(
+    device_name: str = Query(...),
+    start: str = Query(None),
+    end: str = Query(None),
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    gzip: bool = Query(False),
+    bench: str = Query(None),
+    db: Session = Depends(get_db)
+):
+    from fastapi.responses import StreamingResponse
+    bench = benches.resolve_id(bench)
+    start_dt, end_dt = _parse_range(start, end)
+    nodes = {info.id: info for info in node_dictionary.device_nodes(db, bench, device_name)}
+    if not nodes:
+        raise HTTPException(status_code=404, detail=f"Unknown device {device_name}")
+    filename = f"{bench}_{device_name}.{format}"
+    if gzip:
+        # a .gz file, not a transfer encoding: browsers would decompress it and save plain text under .gz
+        media_type = "application/gzip"
+        filename += ".gz"
+    else:
+        media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    return StreamingResponse(_export_stream(nodes, start_dt, end_dt, format, gzip), media_type=media_type, headers=headers)
 
 app.add_middleware(
     CORSMiddleware,
@@ -129,11 +520,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-Base.metadata.create_all(bind=engine)
 
 class OPCUADataIn(BaseModel):
     node_id: str
     value: float
+    bench: str = None
 
 @app.get("/data")
 def get_data(db: Session = Depends(get_db)):
@@ -142,19 +533,24 @@ def get_data(db: Session = Depends(get_db)):
 
 @app.post("/read_opcua")
 def read_opcua(data: OPCUADataIn):
-    value = read_opcua_value(data.node_id)
-    return {"node_id": data.node_id, "value": value}
+    bench = benches.get(data.bench)
+    value = bench.session.read_value(data.node_id)
+    return {"bench": bench.id, "node_id": data.node_id, "value": value}
 
 @app.post("/write_opcua")
 def write_opcua(data: OPCUADataIn):
-    success = write_opcua_value(data.node_id, data.value)
-    if not success:
+    bench = benches.get(data.bench)
+    try:
+        bench.session.write_value(data.node_id, data.value)
+    except Exception:
         raise HTTPException(status_code=400, detail="Write failed")
+    bench.written(data.node_id, data.value)
+    # any cached read of this bench may contain the node
+    response_cache.invalidate(bench=bench.id)
     return {"status": "ok"}
 
 @app.post("/save_data")
-def save_data(data: OPCUADataIn, db: Session = Depends(get_db)):
-    from backend.models import Device, CurrentValue, HistoricalValue
+def save_data(data: OPCUADataIn):
     import datetime
     # Extract device name from node_id
     import re
@@ -164,131 +560,88 @@ def save_data(data: OPCUADataIn, db: Session = Depends(get_db)):
     device_name, value_type, index = match.groups()
     value_type = "sim" if value_type == "SimValue" else "param"
     index = int(index)
-    device = db.query(Device).filter_by(name=device_name).first()
-    if not device:
-        device = Device(name=device_name)
-        db.add(device)
-        db.commit()
-        db.refresh(device)
-    curr = db.query(CurrentValue).filter_by(device_id=device.id, type=value_type, index=index).first()
-    if curr:
-        curr.value = data.value
-        curr.node_id = data.node_id
-    else:
-        curr = CurrentValue(device_id=device.id, type=value_type, index=index, node_id=data.node_id, value=data.value)
-        db.add(curr)
-    db.add(HistoricalValue(device_id=device.id, type=value_type, index=index, node_id=data.node_id, value=data.value, timestamp=datetime.datetime.utcnow().isoformat()))
-    db.commit()
-    db.refresh(curr)
-    return {"device": device_name, "type": value_type, "index": index, "value": data.value}
-
-# OPC UA Simulationsserver-Client
-OPCUA_SERVER_URL = "opc.tcp://localhost:4840"
-sim_client = Client(OPCUA_SERVER_URL)
-sim_client.connect()
-NUM_DEVICES = 10
-NUM_VALUES = 10
+    bench = benches.resolve_id(data.bench)
+    # the historian writer thread persists it; the request does not wait for the disk
+    historian.add(bench, device_name, value_type, index, data.node_id, data.value, datetime.datetime.utcnow().isoformat())
+    return {"bench": bench, "device": device_name, "type": value_type, "index": index, "value": data.value}
+
+# Current values of all mapped nodes of a bench from the shared table of the polling worker:
+# no OPC UA read and the same data in every worker
+@app.get("/current_values")
+def get_current_values(request: Request, bench: str = Query(None), device_name: str = Query(None)):
+    bench = benches.get(bench)
+    table = bench.current_table()
+    if table is None:
+        raise HTTPException(status_code=503, detail=f"No current values published for bench {bench.id} yet")
+
+    def render(snapshot):
+        seq, written_at, values = snapshot
+        return {
+            "bench": bench.id,
+            "timestamp": to_iso(written_at) if written_at == written_at else None,
+            "seq": seq,
+            "values": [
+                {"device": device, "type": value_type, "node_id": node_id, "value": None if value != value else value}
+                for (device, value_type, _, node_id), value in zip(bench.nodes(), values)
+                if not device_name or device == device_name
+            ],
+        }
+    return response_cache.respond(request, f"/current_values?bench={bench.id}&device={device_name or ''}", table.read, render)
+
+@app.get("/historian/metrics")
+def get_historian_metrics():
+    return historian.stats()
+
+def read_device_values(bench, kind):
+    # raw snapshot: only the values, in device/index order, from the shared table the poller fills
+    # every sweep (no OPC UA read, the same values in every worker); the dicts are built once per change
+    node_ids = device_value_nodes(kind)
+    table = bench.current_table()
+    if table is None:
+        return [None] * len(node_ids)
+    return [table.value(node_id) for node_id in node_ids]
 
+def render_device_values(bench, kind, value_type, values):
+    return [
+        {"bench": bench.id, "device": d+1, "type": value_type, "index": i+1, "node_id": f"ns=2;s=Device{d+1}.{kind}{i+1}",
+         "value": values[d * NUM_VALUES + i]}
+        for d in range(NUM_DEVICES)
+        for i in range(NUM_VALUES)
+    ]
+
+# Served from response_cache: pre-serialized bytes with ETag, 304 on If-None-Match
 @app.get("/sim_values")
-def get_sim_values():
-    values = []
-    for d in range(NUM_DEVICES):
-        for i in range(NUM_VALUES):
-            sim_node_id = f"ns=2;s=Device{d+1}.SimValue{i+1}"
-            try:
-                node = sim_client.get_node(sim_node_id)
-                value = node.get_value()
-            except Exception as e:
-                value = None
-            values.append({"device": d+1, "type": "sim", "index": i+1, "node_id": sim_node_id, "value": value})
-    return values
+def get_sim_values(request: Request, bench: str = Query(None)):
+    bench = benches.get(bench)
+    return response_cache.respond(request, f"/sim_values?bench={bench.id}", lambda: read_device_values(bench, "SimValue"),
+                                  lambda values: render_device_values(bench, "SimValue", "sim", values))
 
 @app.get("/param_values")
-def get_param_values():
-    values = []
-    for d in range(NUM_DEVICES):
-        for i in range(NUM_VALUES):
-            param_node_id = f"ns=2;s=Device{d+1}.ParamValue{i+1}"
-            try:
-                node = sim_client.get_node(param_node_id)
-                value = node.get_value()
-            except Exception as e:
-                value = None
-            values.append({"device": d+1, "type": "param", "index": i+1, "node_id": param_node_id, "value": value})
-    return values
+def get_param_values(request: Request, bench: str = Query(None)):
+    bench = benches.get(bench)
+    return response_cache.respond(request, f"/param_values?bench={bench.id}", lambda: read_device_values(bench, "ParamValue"),
+                                  lambda values: render_device_values(bench, "ParamValue", "param", values))
 
 class ParamValueIn(BaseModel):
     device: int
     index: int
     value: float
+    bench: str = None
 
 @app.post("/param_values")
 def set_param_value(data: ParamValueIn):
+    bench = benches.get(data.bench)
     param_node_id = f"ns=2;s=Device{data.device}.ParamValue{data.index}"
-    node = sim_client.get_node(param_node_id)
     try:
-        node.set_value(data.value)
+        bench.session.write_value(param_node_id, data.value)
+        bench.written(param_node_id, data.value)
+        # the next /param_values read goes to the server instead of the cached snapshot
+        response_cache.invalidate(f"/param_values?bench={bench.id}")
         return {"status": "ok"}
     except Exception:
         raise HTTPException(status_code=400, detail=f"Write failed for {param_node_id}")
-# Background thread to periodically read all values and store in DB
-def background_store_values():
-    from backend.models import SessionLocal, Device, CurrentValue, HistoricalValue
-    import datetime
-    while True:
-        db = SessionLocal()
-        # List of hierarchical node paths to read (expand as needed)
-        nodes_to_read = [
-            ("AllgemeineParameter", [
-                "SkalierungDruckmessungMin",
-                "SkalierungDruckmessungMax",
-                "SkalierungDurchflussmessungMin",
-                "SkalierungDurchflussmessungMax",
-                "Fehlerbit"
-            ]),
-            ("Ventilkonfiguration", [
-                "VentilanzahlInVerwendung",
-                "VentilSperre",
-                "PWM.Anregung",
-                "PWM.Anregungszeit",
-                "PWM.Zwischenerregung",
-                "PWM.Zwischenerregungszeit",
-                "PWM.Halten",
-                "KonfigÜbernehmen"
-            ])
-            # Add more blocks/categories here
-        ]
-        for block, variables in nodes_to_read:
-            for var in variables:
-                node_id = f"ns=2;s={block}.{var}" if "." in var else f"ns=2;s={block}.{var}"
-                try:
-                    value = sim_client.get_node(node_id).get_value()
-                except Exception:
-                    value = None
-                # Use block and var as device/type/index for DB (customize as needed)
-                device_name = block
-                value_type = var
-                index = None
-                # Store in DB (simplified, you may want to adjust schema)
-                device = db.query(Device).filter_by(name=device_name).first()
-                if not device:
-                    device = Device(name=device_name)
-                    db.add(device)
-                    db.commit()
-                    db.refresh(device)
-                curr = db.query(CurrentValue).filter_by(device_id=device.id, type=value_type, index=0).first()
-                if curr:
-                    curr.value = value
-                    curr.node_id = node_id
-                else:
-                    curr = CurrentValue(device_id=device.id, type=value_type, index=0, node_id=node_id, value=value)
-                    db.add(curr)
-                db.add(HistoricalValue(device_id=device.id, type=value_type, index=0, node_id=node_id, value=value, timestamp=datetime.datetime.utcnow().isoformat()))
-        db.commit()
-        db.close()
-        time.sleep(5)
-
-threading.Thread(target=background_store_values, daemon=True).start()
+startup["import_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,9 +1,26 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, create_engine
+import os
+
+from sqlalchemy import Column, Integer, String, Float, Boolean, LargeBinary, ForeignKey, Index, UniqueConstraint, create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 
 DATABASE_URL = "sqlite:///database.db"
+DEFAULT_BENCH = "default"  # bench id of data without an explicit bench (single-server setups)
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+# WAL lets HTTP readers run while the historian writes; synchronous is the durability mode
+SQLITE_SYNCHRONOUS = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}[os.environ.get("HISTORIAN_DURABILITY", "normal")]
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", "65536"))
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -18,26 +35,89 @@ class Device(Base):
     __tablename__ = "devices"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
-    current_values = relationship("CurrentValue", back_populates="device")
-    historical_values = relationship("HistoricalValue", back_populates="device")
+    nodes = relationship("Node", back_populates="device")
+
+# Node dictionary: every series (test bench + OPC UA NodeId) gets a small integer
+# id, so the value tables store one integer instead of repeating bench/device/
+# type/index/node_id strings per row. Mapped both ways in memory by backend.nodes.
+class Node(Base):
+    __tablename__ = "nodes"
+    id = Column(Integer, primary_key=True)
+    bench = Column(String, nullable=False, default=DEFAULT_BENCH)
+    node_id = Column(String, nullable=False)
+    device_id = Column(Integer, ForeignKey("devices.id"), index=True)
+    type = Column(String)  # 'sim', 'param' or the variable name
+    index = Column(Integer)
+    device = relationship("Device", back_populates="nodes")
+    __table_args__ = (UniqueConstraint("bench", "node_id", name="uq_nodes_bench_node_id"),)
 
 class CurrentValue(Base):
     __tablename__ = "current_values"
-    id = Column(Integer, primary_key=True, index=True)
-    device_id = Column(Integer, ForeignKey("devices.id"))
-    type = Column(String, index=True)  # 'sim' or 'param'
-    index = Column(Integer)
-    node_id = Column(String, index=True)
+    node = Column(Integer, ForeignKey("nodes.id"), primary_key=True)
     value = Column(Float)
-    device = relationship("Device", back_populates="current_values")
+    timestamp = Column(Float)  # unix seconds (UTC)
 
 class HistoricalValue(Base):
     __tablename__ = "historical_values"
-    id = Column(Integer, primary_key=True, index=True)
-    device_id = Column(Integer, ForeignKey("devices.id"))
-    type = Column(String, index=True)  # 'sim' or 'param'
-    index = Column(Integer)
-    node_id = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    node = Column(Integer, ForeignKey("nodes.id"), nullable=False)
+    timestamp = Column(Float, nullable=False)  # unix seconds (UTC)
     value = Column(Float)
-    timestamp = Column(String, index=True)
-    device = relationship("Device", back_populates="historical_values")
+    __table_args__ = (Index("ix_historical_values_node_timestamp", "node", "timestamp"),)
+
+# Rollups: one row per node and time bucket, maintained incrementally by backend.rollups
+class RollupMixin:
+    node = Column(Integer, primary_key=True)  # nodes.id
+    bucket = Column(Integer, primary_key=True)  # bucket start, unix seconds
+    min = Column(Float)
+    max = Column(Float)
+    sum = Column(Float)
+    count = Column(Integer)
+    first = Column(Float)
+    last = Column(Float)
+    first_ts = Column(Float)  # unix seconds of first/last sample, to merge out-of-order inserts
+    last_ts = Column(Float)
+
+class Rollup1s(RollupMixin, Base):
+    __tablename__ = "rollup_1s"
+
+class Rollup1m(RollupMixin, Base):
+    __tablename__ = "rollup_1m"
+
+class Rollup1h(RollupMixin, Base):
+    __tablename__ = "rollup_1h"
+
+# Alarm episodes from backend.alarms: one row per alarm, cleared_at is set when it clears
+class Alarm(Base):
+    __tablename__ = "alarms"
+    id = Column(Integer, primary_key=True)
+    rule = Column(String, nullable=False)
+    node = Column(Integer, ForeignKey("nodes.id"), nullable=False)
+    severity = Column(String)
+    message = Column(String)
+    value = Column(Float)  # value that raised the alarm
+    raised_at = Column(Float, nullable=False)  # unix seconds (UTC)
+    cleared_at = Column(Float)
+    __table_args__ = (Index("ix_alarms_raised_at", "raised_at"),)
+
+# Full-state snapshots from backend.snapshots. A snapshot row holds one compressed
+# blob: a keyframe with every value, or a delta against base_id (the previous
+# snapshot of the bench). The node list is stored once per distinct mapping.
+class SnapshotIndex(Base):
+    __tablename__ = "snapshot_indexes"
+    id = Column(Integer, primary_key=True)
+    digest = Column(String, unique=True, nullable=False)  # sha1 of the node list
+    nodes = Column(LargeBinary, nullable=False)  # zlib-compressed JSON [[device, type, node_id], ...]
+
+class Snapshot(Base):
+    __tablename__ = "snapshots"
+    id = Column(Integer, primary_key=True)
+    bench = Column(String, nullable=False)
+    label = Column(String)
+    taken_at = Column(Float, nullable=False)  # unix seconds (UTC)
+    keyframe = Column(Boolean, nullable=False)
+    base_id = Column(Integer, ForeignKey("snapshots.id"))  # snapshot a delta applies to
+    index_id = Column(Integer, ForeignKey("snapshot_indexes.id"), nullable=False)
+    changed = Column(Integer)  # values stored in the blob
+    data = Column(LargeBinary, nullable=False)
+    __table_args__ = (Index("ix_snapshots_bench_taken_at", "bench", "taken_at"),)
@@ -0,0 +1,341 @@
+# Node dictionary: integer ids for series.
+#
+# historical_values, current_values and the rollup tables store only the small
+# integer `nodes.id`; bench, device, type, index and the OPC UA NodeId string
+# live once in `nodes`. node_dictionary keeps both directions in memory (loaded
+# lazily on first use), so writers resolve (bench, NodeId) to its id and API
+# handlers expand ids back to strings without extra queries.
+#
+# Convert a database from an older layout (strings per row, or nodes without a
+# bench column) in place:
+#   python -m backend.nodes migrate
+# Stop the backend first; the command prints size and query time before/after.
+import datetime
+import heapq
+import os
+import threading
+import time
+from collections import namedtuple
+from operator import itemgetter
+
+from sqlalchemy import text
+
+from backend.models import DEFAULT_BENCH, Device, Node
+
+NodeInfo = namedtuple("NodeInfo", "id bench node_id device type index")
+
+
+def to_epoch(timestamp):
+    # naive UTC datetime or isoformat string -> unix seconds
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    return timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def to_iso(ts):
+    # unix seconds -> naive UTC isoformat string, the format the API always returned
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def history_rows(db, nodes, lo=None, hi=None, include_hi=True, batch=1000):
+    """(timestamp, nodes.id, value) rows of nodes within [lo, hi] (unix seconds, None = open), in timestamp order.
+
+    A single "node IN (...) ORDER BY timestamp" query makes SQLite sort every matching row before it
+    returns the first one. Instead each node is read as its own range of the (node, timestamp) index,
+    already sorted, and the streams are merged here; rows are fetched lazily, `batch` per node.
+    """
+    raw = db.connection().connection.dbapi_connection
+    sql = "SELECT timestamp, node, value FROM historical_values WHERE node = ?"
+    params = ()
+    if lo is not None:
+        sql += " AND timestamp >= ?"
+        params += (lo,)
+    if hi is not None:
+        sql += " AND timestamp <= ?" if include_hi else " AND timestamp < ?"
+        params += (hi,)
+    sql += " ORDER BY timestamp"
+
+    def stream(node):
+        cursor = raw.execute(sql, (node,) + params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+    return heapq.merge(*(stream(node) for node in nodes), key=itemgetter(0))
+
+
+class NodeDictionary:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.by_node_id = {}
+        self.by_id = {}
+        self.device_ids = {}
+
+    def _load(self, db):
+        with self.lock:
+            if self.loaded:
+                return
+            self.device_ids = {name: device_id for device_id, name in db.query(Device.id, Device.name)}
+            names = {device_id: name for name, device_id in self.device_ids.items()}
+            for row in db.query(Node.id, Node.bench, Node.node_id, Node.device_id, Node.type, Node.index):
+                self._remember(NodeInfo(row.id, row.bench, row.node_id, names.get(row.device_id), row.type, row.index))
+            self.loaded = True
+
+    def _remember(self, info):
+        self.by_node_id[(info.bench, info.node_id)] = info
+        self.by_id[info.id] = info
+
+    def invalidate(self):
+        """Forget everything, e.g. after a rolled back transaction created rows that no longer exist."""
+        with self.lock:
+            self.loaded = False
+            self.by_node_id = {}
+            self.by_id = {}
+            self.device_ids = {}
+
+    def resolve(self, db, bench, device, value_type, index, node_id):
+        """Id of (bench, node_id), creating the device and node rows if needed (flushed, not committed)."""
+        if not self.loaded:
+            self._load(db)
+        info = self.by_node_id.get((bench, node_id))
+        if info is not None:
+            return info.id
+        device_id = self.device_ids.get(device)
+        if device_id is None:
+            row = db.query(Device).filter_by(name=device).first()
+            if not row:
+                row = Device(name=device)
+                db.add(row)
+                db.flush()
+            device_id = row.id
+        node = Node(bench=bench, node_id=node_id, device_id=device_id, type=value_type, index=index)
+        db.add(node)
+        db.flush()
+        with self.lock:
+            self.device_ids[device] = device_id
+            self._remember(NodeInfo(node.id, bench, node_id, device, value_type, index))
+        return node.id
+
+    def lookup(self, db, bench, node_id):
+        """NodeInfo for a NodeId string of one bench, or None if it was never stored."""
+        if not self.loaded:
+            self._load(db)
+        info = self.by_node_id.get((bench, node_id))
+        if info is None:
+            # written after our load (e.g. by another process)
+            row = db.query(Node.id, Node.bench, Node.node_id, Device.name, Node.type, Node.index) \
+                .outerjoin(Device, Device.id == Node.device_id) \
+                .filter(Node.bench == bench, Node.node_id == node_id).first()
+            if row:
+                info = NodeInfo(*row)
+                with self.lock:
+                    self._remember(info)
+        return info
+
+    def info(self, db, id):
+        """NodeInfo for an integer id."""
+        if not self.loaded:
+            self._load(db)
+        info = self.by_id.get(id)
+        if info is None:
+            row = db.query(Node.id, Node.bench, Node.node_id, Device.name, Node.type, Node.index) \
+                .outerjoin(Device, Device.id == Node.device_id).filter(Node.id == id).first()
+            if row:
+                info = NodeInfo(*row)
+                with self.lock:
+                    self._remember(info)
+        return info
+
+    def device_nodes(self, db, bench, device):
+        """NodeInfos of all series of one device on one bench."""
+        if not self.loaded:
+            self._load(db)
+        return [info for info in list(self.by_id.values()) if info.device == device and info.bench == bench]
+
+
+node_dictionary = NodeDictionary()
+
+
+# --- migration from the string-per-row layout ---------------------------------
+
+_OLD_TABLES = ("historical_values", "current_values")
+_ROLLUP_TABLES = ("rollup_1s", "rollup_1m", "rollup_1h")
+# naive isoformat string -> unix seconds, keeping the microseconds exact
+_ISO_TO_EPOCH = "(CAST(strftime('%s', {0}) AS REAL) + coalesce(CAST(substr({0}, 20) AS REAL), 0))"
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))]
+
+
+def needs_migration(conn):
+    return "node_id" in _columns(conn, "historical_values")
+
+
+def needs_bench(conn):
+    columns = _columns(conn, "nodes")
+    return bool(columns) and "bench" not in columns
+
+
+def check_layout(engine):
+    """Refuse a database in an older layout: the historian could not write a single batch to it."""
+    with engine.connect() as conn:
+        if needs_migration(conn) or needs_bench(conn):
+            raise RuntimeError(f"{engine.url.database} uses an older history layout; stop the backend and run "
+                               f"`python -m backend.nodes migrate` first")
+
+
+def _benchmark(conn, old):
+    # one device, one hour in the middle of the recorded range, ordered by time; timed on the
+    # DB-API connection so the numbers show SQLite, not result-row construction
+    raw = conn.connection.dbapi_connection
+    if old:
+        lo, hi, device_id = raw.execute("SELECT min(timestamp), max(timestamp), min(device_id) FROM historical_values").fetchone()
+        if lo is None:
+            return None
+        lo, hi = datetime.datetime.fromisoformat(lo), datetime.datetime.fromisoformat(hi)
+        mid = lo + (hi - lo) / 2
+        sql = ('SELECT type, "index", node_id, value, timestamp FROM historical_values '
+               'WHERE device_id = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp')
+        params = (device_id, mid.isoformat(), (mid + datetime.timedelta(hours=1)).isoformat())
+    else:
+        lo, hi = raw.execute("SELECT min(timestamp), max(timestamp) FROM historical_values").fetchone()
+        if lo is None:
+            return None
+        device_id = raw.execute("SELECT min(device_id) FROM nodes").fetchone()[0]
+        mid = lo + (hi - lo) / 2
+        sql = ("SELECT node, value, timestamp FROM historical_values "
+               "WHERE node IN (SELECT id FROM nodes WHERE device_id = ?) "
+               "AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp")
+        params = (device_id, mid, mid + 3600)
+    best = None
+    for _ in range(10):
+        started = time.perf_counter()
+        rows = raw.execute(sql, params).fetchall()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(rows)
+
+
+def _history_bytes(conn):
+    # historical_values with its indexes; None if SQLite was built without dbstat
+    try:
+        return conn.execute(text(
+            "SELECT sum(pgsize) FROM dbstat WHERE name IN "
+            "(SELECT name FROM sqlite_master WHERE tbl_name = 'historical_values')")).scalar()
+    except Exception:
+        return None
+
+
+def migrate(engine):
+    """Convert historical_values/current_values/rollups to integer node ids. Returns a report dict."""
+    from backend.models import Base, SessionLocal
+    from backend.rollups import backfill
+
+    path = engine.url.database
+    report = {"size_before": os.path.getsize(path)}
+    with engine.begin() as conn:
+        report["query_before"] = _benchmark(conn, old=True)
+        report["history_before"] = _history_bytes(conn)
+        for table in _OLD_TABLES:
+            indexes = conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :t AND sql IS NOT NULL"), {"t": table})
+            for (name,) in list(indexes):
+                conn.execute(text(f'DROP INDEX "{name}"'))
+            conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+        for table in _ROLLUP_TABLES:
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        # current_values first, so the dictionary keeps the same device/type/index the UI showed
+        for table in ("current_values_old", "historical_values_old"):
+            conn.execute(text(
+                f'INSERT OR IGNORE INTO nodes (bench, node_id, device_id, type, "index") '
+                f'SELECT :bench, node_id, min(device_id), min(type), min("index") FROM {table} '
+                f'WHERE node_id IS NOT NULL GROUP BY node_id'), {"bench": DEFAULT_BENCH})
+        report["skipped"] = conn.execute(text(
+            "SELECT count(*) FROM historical_values_old WHERE node_id IS NULL OR timestamp IS NULL")).scalar()
+        conn.execute(text(
+            f"INSERT INTO historical_values (id, node, timestamp, value) "
+            f"SELECT h.id, n.id, {_ISO_TO_EPOCH.format('h.timestamp')}, h.value "
+            f"FROM historical_values_old h JOIN nodes n ON n.node_id = h.node_id "
+            f"WHERE h.timestamp IS NOT NULL ORDER BY h.id"))
+        conn.execute(text(
+            "INSERT OR REPLACE INTO current_values (node, value, timestamp) "
+            "SELECT n.id, c.value, (SELECT max(timestamp) FROM historical_values WHERE node = n.id) "
+            "FROM current_values_old c JOIN nodes n ON n.node_id = c.node_id"))
+        report["nodes"] = conn.execute(text("SELECT count(*) FROM nodes")).scalar()
+        report["rows"] = conn.execute(text("SELECT count(*) FROM historical_values")).scalar()
+        for table in _OLD_TABLES:
+            conn.execute(text(f"DROP TABLE {table}_old"))
+    db = SessionLocal()
+    try:
+        backfill(db)
+    finally:
+        db.close()
+    with engine.connect() as conn:
+        conn.exec_driver_sql("VACUUM")
+        report["query_after"] = _benchmark(conn, old=False)
+        report["history_after"] = _history_bytes(conn)
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    report["size_after"] = os.path.getsize(path)
+    node_dictionary.invalidate()
+    return report
+
+
+def add_bench(engine):
+    """Rebuild a nodes table from before multi-bench support; all its nodes belong to DEFAULT_BENCH."""
+    from backend.models import Base
+
+    with engine.begin() as conn:
+        # keep the foreign keys of the value tables pointing at "nodes", not at the renamed table
+        conn.exec_driver_sql("PRAGMA legacy_alter_table=ON")
+        indexes = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'nodes' AND sql IS NOT NULL"))
+        for (name,) in list(indexes):
+            conn.execute(text(f'DROP INDEX "{name}"'))
+        conn.execute(text("ALTER TABLE nodes RENAME TO nodes_old"))
+        conn.exec_driver_sql("PRAGMA legacy_alter_table=OFF")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text(
+            'INSERT INTO nodes (id, bench, node_id, device_id, type, "index") '
+            'SELECT id, :bench, node_id, device_id, type, "index" FROM nodes_old'), {"bench": DEFAULT_BENCH})
+        count = conn.execute(text("SELECT count(*) FROM nodes")).scalar()
+        conn.execute(text("DROP TABLE nodes_old"))
+    node_dictionary.invalidate()
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    from backend.models import engine
+
+    parser = argparse.ArgumentParser(description="Node dictionary maintenance")
+    parser.add_argument("command", choices=["migrate"])
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        old_layout, without_bench = needs_migration(conn), needs_bench(conn)
+    if without_bench:
+        print(f"Assigned {add_bench(engine)} nodes to bench '{DEFAULT_BENCH}'")
+    if not old_layout:
+        if not without_bench:
+            print("Database already uses the current layout")
+        raise SystemExit(0)
+    started = time.perf_counter()
+    report = migrate(engine)
+    mb = 1024 * 1024
+    print(f"Migrated {report['rows']} rows of {report['nodes']} nodes in {time.perf_counter() - started:.1f}s"
+          + (f" ({report['skipped']} rows without node_id/timestamp skipped)" if report["skipped"] else ""))
+    print(f"Database size: {report['size_before'] / mb:.1f} MB -> {report['size_after'] / mb:.1f} MB (incl. rebuilt rollups)")
+    if report["history_before"] and report["history_after"]:
+        print(f"historical_values + indexes: {report['history_before'] / mb:.1f} MB -> {report['history_after'] / mb:.1f} MB")
+    if report["query_before"] and report["query_after"]:
+        (before_ms, before_rows), (after_ms, after_rows) = report["query_before"], report["query_after"]
+        print(f"One device, one hour: {before_ms:.1f} ms ({before_rows} rows) -> {after_ms:.1f} ms ({after_rows} rows)")
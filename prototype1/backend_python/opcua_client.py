@@ -1,18 +1,122 @@
-from opcua import Client
+# Lazily connected OPC UA sessions, one per test bench (see backend.benches).
+#
+# Nothing connects at import: the first read/write opens the session, and a
+# failed or dropped connection is retried at most every OPCUA_RETRY_SECONDS, so
+# the backend starts (and serves history) without a reachable PLC. The opcua
+# package itself is only imported on the first connect.
+import os
+import threading
+import time
 
-OPCUA_SERVER_URL = "opc.tcp://localhost:4840"  # Anpassen!
+OPCUA_SERVER_URL = os.environ.get("OPCUA_SERVER_URL", "opc.tcp://localhost:4840")  # Anpassen!
+OPCUA_TIMEOUT = float(os.environ.get("OPCUA_TIMEOUT", "4"))
+OPCUA_RETRY_SECONDS = float(os.environ.get("OPCUA_RETRY_SECONDS", "5"))
+OPCUA_READ_BATCH = int(os.environ.get("OPCUA_READ_BATCH", "500"))  # nodes per Read request
 
-client = Client(OPCUA_SERVER_URL)
-client.connect()
 
-def read_opcua_value(node_id: str):
-    node = client.get_node(node_id)
-    return node.get_value()
+class OPCUAUnavailable(ConnectionError):
+    pass
+
+
+class OPCUASession:
+    def __init__(self, url=OPCUA_SERVER_URL, timeout=OPCUA_TIMEOUT, retry_seconds=OPCUA_RETRY_SECONDS):
+        self.url = url
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+        self.client = None
+        self.last_error = None
+        self.connected_since = None
+        self._next_attempt = 0.0
+        self._nodeids = {}
+
+    @property
+    def connected(self):
+        return self.client is not None
+
+    def get(self):
+        """The connected Client; connects on first use. Raises OPCUAUnavailable while the server is unreachable."""
+        client = self.client
+        if client is not None:
+            return client
+        with self.lock:
+            if self.client is not None:
+                return self.client
+            if time.monotonic() < self._next_attempt:
+                raise OPCUAUnavailable(f"{self.url} unavailable: {self.last_error}")
+            from opcua import Client
+            client = Client(self.url, timeout=self.timeout)
+            try:
+                client.connect()
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+                self._next_attempt = time.monotonic() + self.retry_seconds
+                raise OPCUAUnavailable(f"{self.url} unavailable: {self.last_error}") from e
+            self.client = client
+            self.last_error = None
+            self.connected_since = time.time()
+            return client
+
+    def reset(self, error=None):
+        """Drop the session after a transport error; the next call reconnects."""
+        with self.lock:
+            client, self.client = self.client, None
+            self.last_error = str(error) if error else self.last_error
+            self.connected_since = None
+        if client is not None:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+    def close(self):
+        self.reset()
+
+    def get_node(self, node_id):
+        return self.get().get_node(node_id)
+
+    def read_value(self, node_id):
+        try:
+            return self.get_node(node_id).get_value()
+        except (OSError, TimeoutError) as e:
+            # OPCUAUnavailable is an OSError too: nothing to reset then
+            if not isinstance(e, OPCUAUnavailable):
+                self.reset(e)
+            raise
+
+    def read_values(self, node_ids, batch=OPCUA_READ_BATCH):
+        """Values of many nodes with one Read request per batch; None for nodes the server rejects."""
+        from opcua import ua
+        client = self.get()
+        nodeids = []
+        for node_id in node_ids:
+            nodeid = self._nodeids.get(node_id)
+            if nodeid is None:
+                nodeid = self._nodeids[node_id] = ua.NodeId.from_string(node_id)
+            nodeids.append(nodeid)
+        values = []
+        try:
+            for i in range(0, len(nodeids), batch):
+                results = client.uaclient.get_attributes(nodeids[i:i + batch], ua.AttributeIds.Value)
+                values.extend(r.Value.Value if r.StatusCode.is_good() and r.Value is not None else None for r in results)
+        except (OSError, TimeoutError) as e:
+            self.reset(e)
+            raise
+        return values
+
+    def write_value(self, node_id, value):
+        try:
+            self.get_node(node_id).set_value(value)
+        except (OSError, TimeoutError) as e:
+            if not isinstance(e, OPCUAUnavailable):
+                self.reset(e)
+            raise
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "connected": self.connected,
+            "connected_since": self.connected_since,
+            "last_error": self.last_error,
+        }
 
-def write_opcua_value(node_id: str, value):
-    node = client.get_node(node_id)
-    try:
-        node.set_value(value)
-        return True
-    except Exception:
-        return False
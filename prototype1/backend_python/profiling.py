@@ -0,0 +1,181 @@
+# Opt-in profiling of requests, poll cycles and historian batches.
+#
+# A trace is a list of timed spans ("read", "serialize", "commit", ...) recorded
+# on whatever thread runs them. Traces are started
+#   - for a request with the header "X-Profile: 1" or the query flag ?profile=1;
+#     such a request additionally gets a sampled stack profile of all threads
+#     (every PROFILE_INTERVAL_MS) while it runs,
+#   - for a random PROFILE_SAMPLE_RATE fraction of requests, bench poll cycles
+#     and historian batches (spans only, no stack sampling).
+# Code marks spans with `with span("name"):`; outside a trace that is a single
+# context variable lookup, so the instrumentation stays in place in production.
+#
+# The last PROFILE_KEEP traces are kept in memory. /profiling/trace exports them
+# as Chrome trace-event JSON (chrome://tracing, Perfetto) and
+# /profiling/profiles/<id> returns a stack profile in folded format (speedscope,
+# flamegraph.pl).
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name, args):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.args = args
+        self.started_at = time.time()
+        self.start = time.perf_counter_ns()
+        self.end = None
+        self.tid = threading.get_ident()
+        self.spans = []  # (name, tid, start ns, end ns, args); list.append is thread-safe
+        self.profile = None
+
+    def add(self, name, start, end, args):
+        self.spans.append((name, threading.get_ident(), start, end, args))
+
+    @property
+    def duration_ms(self):
+        return None if self.end is None else round((self.end - self.start) / 1e6, 3)
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "args": self.args,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "spans": len(self.spans),
+            "profile": self.profile is not None,
+        }
+
+
+@contextmanager
+def span(name, **args):
+    """Time the block as a span of the current trace; no-op when nothing is traced."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter_ns(), args)
+
+
+class StackSampler(threading.Thread):
+    """Counts the call stacks of all other threads every interval seconds."""
+
+    def __init__(self, interval):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._finished = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._finished.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+class Profiler:
+    def __init__(self, rate=PROFILE_SAMPLE_RATE, interval_ms=PROFILE_INTERVAL_MS, keep=PROFILE_KEEP):
+        self.rate = rate
+        self.interval = interval_ms / 1000.0
+        self.traces = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.metrics = {"traces": 0, "profiles": 0}
+
+    @contextmanager
+    def trace(self, name, force=False, stacks=False, **args):
+        """Record the block as a trace if forced or sampled; yields the Trace or None."""
+        if current_trace.get() is not None or not (force or (self.rate > 0 and random.random() < self.rate)):
+            yield None
+            return
+        trace = Trace(name, args)
+        sampler = None
+        if stacks:
+            sampler = StackSampler(self.interval)
+            sampler.start()
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            trace.end = time.perf_counter_ns()
+            if sampler is not None:
+                sampler.stop()
+                trace.profile = sampler
+            with self.lock:
+                self.traces.append(trace)
+                self.metrics["traces"] += 1
+                self.metrics["profiles"] += sampler is not None
+
+    def get(self, trace_id):
+        with self.lock:
+            return next((t for t in self.traces if t.id == trace_id), None)
+
+    def list(self):
+        with self.lock:
+            return [t.summary() for t in reversed(self.traces)]
+
+    def chrome_trace(self, trace_id=None):
+        """Chrome trace-event JSON of one or all stored traces."""
+        with self.lock:
+            traces = [t for t in self.traces if trace_id is None or t.id == trace_id]
+        names = {t.ident: t.name for t in threading.enumerate()}
+        pid = os.getpid()
+        events = []
+        tids = set()
+        for trace in traces:
+            events.append({"name": trace.name, "cat": "trace", "ph": "X", "pid": pid, "tid": trace.tid,
+                           "ts": trace.start / 1000, "dur": (trace.end - trace.start) / 1000,
+                           "args": dict(trace.args, trace_id=trace.id)})
+            tids.add(trace.tid)
+            for name, tid, start, end, args in trace.spans:
+                events.append({"name": name, "cat": trace.name, "ph": "X", "pid": pid, "tid": tid,
+                               "ts": start / 1000, "dur": (end - start) / 1000, "args": dict(args, trace_id=trace.id)})
+                tids.add(tid)
+        events.extend({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": names.get(tid, str(tid))}}
+                      for tid in tids)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, rate=self.rate, interval_ms=self.interval * 1000, stored=len(self.traces),
+                        keep=self.traces.maxlen)
+
+
+profiler = Profiler()
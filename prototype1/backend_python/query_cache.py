@@ -0,0 +1,229 @@
+# Result cache for historical range queries (/historical_values, Grafana series).
+#
+# Dashboards repeat the same range queries on every refresh, and data that is
+# already committed does not change. For each normalized query key, the cache
+# keeps one segment of results, in key order:
+#   ("rows", node ids)             raw rows of a device
+#   ("series", node id, width)     rollup buckets of one Grafana series
+# A segment covers [start, closed): every row in it is final. `closed` comes from
+# the historian's write watermark (the newest committed timestamp) read before
+# the DB query; rows at the watermark itself are not final yet, because a sweep
+# committed in several batches shares one timestamp. For bucket segments both bounds are bucket boundaries, so only
+# complete buckets are stored.
+#
+# A query for [start, end] is answered from the segment when the segment starts
+# at or before `start`. Only the part after `closed` is read from the DB, and
+# that part extends the segment up to the new watermark. An open-ended "last N
+# hours" query therefore reads only the new tail on each refresh. For a bucket
+# query with an unaligned start, the first, partial bucket is read separately.
+#
+# The historian calls advance() after every commit. Samples at or after the
+# watermark only move it forward. A sample before it (out of order, a spill
+# replay) cuts the segments of its node back to that timestamp, so only results
+# overlapping the late data are dropped.
+# Segments are evicted least-recently-used when the total exceeds QUERY_CACHE_MB.
+#
+# Only the process whose historian writes sees the commits, so a worker that is
+# not the elected poller (backend.shared_values) sets active = False and reads
+# every query from the DB.
+import math
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+
+from sqlalchemy import func
+
+from backend.models import HistoricalValue
+
+QUERY_CACHE_MB = float(os.environ.get("QUERY_CACHE_MB", "64"))
+LATE_LOG = 256  # late writes remembered for queries still reading from the DB
+
+INF = math.inf
+
+
+class Segment:
+    __slots__ = ("nodes", "width", "start", "closed", "ts", "node", "values")
+
+    def __init__(self, nodes, width, start):
+        self.nodes = nodes
+        self.width = width  # bucket width, None for raw rows
+        self.start = start
+        self.closed = start  # rows with key < closed are final
+        self.ts = array('d')
+        self.node = array('q')
+        self.values = array('d')  # NaN for NULL
+
+    @property
+    def bytes(self):
+        return 24 * len(self.ts) + 8 * len(self.nodes) + 200
+
+    def cut(self, ts):
+        """First key a late sample at ts can change."""
+        return ts if self.width is None else math.floor(ts / self.width) * self.width
+
+    def extend(self, rows, lo, hi):
+        for ts, node, value in rows:
+            if lo <= ts < hi:
+                self.ts.append(ts)
+                self.node.append(node)
+                self.values.append(math.nan if value is None else value)
+        self.closed = hi
+
+    def truncate(self, key):
+        i = bisect_left(self.ts, key)
+        del self.ts[i:], self.node[i:], self.values[i:]
+        self.closed = min(self.closed, key)
+
+
+class QueryCache:
+    def __init__(self, max_mb=QUERY_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()  # key -> Segment, least recently used first
+        self.by_node = {}  # nodes.id -> keys of segments containing it
+        self.watermark = -INF  # newest committed sample timestamp
+        self.late = deque(maxlen=LATE_LOG)  # (seq, node, ts) of late writes
+        self.seq = 0
+        self.bytes = 0
+        self.active = True  # False: no commits reach this process, every query goes to the DB
+        self.metrics = {"hits": 0, "partial": 0, "misses": 0, "rows_cached": 0, "rows_read": 0,
+                        "late_writes": 0, "truncated": 0, "evicted": 0}
+
+    # -- writer side
+
+    def advance(self, written):
+        """After a commit: {nodes.id: (oldest, newest) timestamp written}."""
+        with self.lock:
+            mark = self.watermark
+            for node, (lo, hi) in written.items():
+                if lo < mark:
+                    self.seq += 1
+                    self.late.append((self.seq, node, lo))
+                    self.metrics["late_writes"] += 1
+                    for key in list(self.by_node.get(node, ())):
+                        segment = self.segments[key]
+                        cut = segment.cut(lo)
+                        if cut < segment.closed:
+                            self.bytes -= segment.bytes
+                            segment.truncate(cut)
+                            self.bytes += segment.bytes
+                            self.metrics["truncated"] += 1
+                            if segment.closed <= segment.start:
+                                self._drop(key)
+                if hi > self.watermark:
+                    self.watermark = hi
+
+    # -- reader side
+
+    def _init_watermark(self, db, nodes):
+        # after a restart nothing has been written yet: the newest stored sample of these nodes
+        if self.watermark == -INF and nodes:
+            newest = db.query(func.max(HistoricalValue.timestamp)) \
+                .filter(HistoricalValue.node.in_(nodes)).group_by(HistoricalValue.node).all()
+            with self.lock:
+                self.watermark = max([self.watermark] + [ts for ts, in newest if ts is not None])
+
+    def query(self, db, key, nodes, start, end, fetch, width=None):
+        """Rows (key ts, nodes.id, value) of key within [start, end] (unix seconds, None = open), in key order.
+
+        fetch(lo, hi, include_hi) reads [lo, hi] or [lo, hi) from the DB as (key ts, nodes.id, value) rows in
+        key order; width is the bucket width of bucketed results (keys are bucket starts).
+        """
+        lo = -INF if start is None else start
+        hi = INF if end is None else end
+        if not self.active:
+            self.metrics["misses"] += 1
+            return fetch(lo, hi, True)
+        first = lo if width is None or lo == -INF else math.ceil(lo / width) * width
+        self._init_watermark(db, nodes)
+        with self.lock:
+            mark, seq = self.watermark, self.seq
+            segment = self.segments.get(key)
+            if segment is not None and segment.start <= first < segment.closed:
+                self.segments.move_to_end(key)
+                i = bisect_left(segment.ts, first)
+                j = bisect_right(segment.ts, hi) if hi < segment.closed else len(segment.ts)
+                cached = [(t, n, None if v != v else v)
+                          for t, n, v in zip(segment.ts[i:j], segment.node[i:j], segment.values[i:j])]
+                closed = segment.closed
+            else:
+                segment = None
+                cached = []
+        if segment is not None and hi < closed:
+            self.metrics["hits"] += 1
+            self.metrics["rows_cached"] += len(cached)
+            head = fetch(lo, first, False) if lo < first else []
+            return head + cached
+        # final rows end before the watermark read ahead of the DB query and at the requested end
+        final = min(mark, math.nextafter(hi, INF))
+        if width is not None and final != INF:
+            final = math.floor(final / width) * width
+        if segment is not None:
+            self.metrics["partial"] += 1
+            self.metrics["rows_cached"] += len(cached)
+            head = fetch(lo, first, False) if lo < first else []
+            tail = fetch(closed, hi, True)
+            rows = head + cached + tail
+            new, new_lo = tail, closed
+        else:
+            self.metrics["misses"] += 1
+            rows = fetch(lo, hi, True)
+            new, new_lo = rows, first
+        self.metrics["rows_read"] += len(rows) - len(cached)
+        self._store(key, frozenset(nodes), width, segment, new, new_lo, final, seq)
+        return rows
+
+    def _store(self, key, nodes, width, segment, rows, lo, hi, seq):
+        with self.lock:
+            # late writes committed while the DB was read: keep only what precedes them
+            if self.late and seq + 1 < self.late[0][0]:
+                return  # more late writes than remembered
+            for event_seq, node, ts in self.late:
+                if event_seq > seq and node in nodes:
+                    hi = min(hi, ts if width is None else math.floor(ts / width) * width)
+            if hi <= lo or hi == INF:
+                return
+            current = self.segments.get(key)
+            if segment is not None:
+                if current is not segment or segment.closed != lo:
+                    return  # changed meanwhile
+                self.bytes -= segment.bytes
+                segment.extend(rows, lo, hi)
+            else:
+                if current is not None:
+                    self._drop(key)
+                segment = Segment(nodes, width, lo)
+                segment.extend(rows, lo, hi)
+                self.segments[key] = segment
+                for node in segment.nodes:
+                    self.by_node.setdefault(node, set()).add(key)
+            self.bytes += segment.bytes
+            while self.bytes > self.max_bytes and self.segments:
+                self._drop(next(iter(self.segments)))
+                self.metrics["evicted"] += 1
+
+    def _drop(self, key):
+        segment = self.segments.pop(key)
+        self.bytes -= segment.bytes
+        for node in segment.nodes:
+            keys = self.by_node.get(node)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_node[node]
+
+    def clear(self):
+        with self.lock:
+            self.segments.clear()
+            self.by_node.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, active=self.active, segments=len(self.segments), bytes=self.bytes,
+                        max_bytes=self.max_bytes, watermark=None if self.watermark == -INF else self.watermark)
+
+
+query_cache = QueryCache()
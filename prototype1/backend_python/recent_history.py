@@ -0,0 +1,145 @@
+# Fixed-memory store of the most recent samples per node.
+#
+# Every node gets two preallocated array('d') ring buffers (unix timestamp and
+# value), sized from a global memory budget:
+#
+#   RECENT_HISTORY_MB         total budget for all buffers (default 64)
+#   RECENT_HISTORY_MAX_NODES  number of nodes the budget is split over (default 2000)
+#
+# The poller feeds it; /historical_values answers from it when the requested
+# range lies completely inside the buffered window, and /recent_values returns
+# the window as two flat arrays. Window lookups are binary searches plus C-level
+# array slices: no DB access and no Python object per sample.
+import datetime
+import math
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from backend.nodes import to_epoch
+
+RECENT_HISTORY_MB = float(os.environ.get("RECENT_HISTORY_MB", "64"))
+RECENT_HISTORY_MAX_NODES = int(os.environ.get("RECENT_HISTORY_MAX_NODES", "2000"))
+BYTES_PER_SAMPLE = 16  # one double timestamp + one double value
+
+
+def from_epoch(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(tzinfo=None)
+
+
+class NodeRing:
+    __slots__ = ("ts", "values", "capacity", "count", "head", "bench", "device", "type", "index", "node_id", "since")
+
+    def __init__(self, capacity, bench, device, value_type, index, node_id, since):
+        self.ts = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.count = 0
+        self.head = 0  # next write position
+        self.bench = bench
+        self.device = device
+        self.type = value_type
+        self.index = index
+        self.node_id = node_id
+        # samples from `since` on are all in the buffer (first feed, later: oldest retained sample)
+        self.since = since
+
+    def append(self, ts, value):
+        self.ts[self.head] = ts
+        self.values[self.head] = math.nan if value is None else value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.since = self.ts[self.head]
+
+    def segments(self):
+        # physical [lo, hi) ranges in chronological order
+        if self.count < self.capacity:
+            return [(0, self.head)]
+        return [(self.head, self.capacity), (0, self.head)]
+
+    def window(self, start, end):
+        """Samples with start <= ts <= end as (array ts, array values); start/end may be None."""
+        ts_out, val_out = array('d'), array('d')
+        for lo, hi in self.segments():
+            a = lo if start is None else bisect_left(self.ts, start, lo, hi)
+            b = hi if end is None else bisect_right(self.ts, end, lo, hi)
+            if a < b:
+                ts_out.extend(self.ts[a:b])
+                val_out.extend(self.values[a:b])
+        return ts_out, val_out
+
+
+class RecentHistory:
+    def __init__(self, budget_mb=RECENT_HISTORY_MB, max_nodes=RECENT_HISTORY_MAX_NODES):
+        self.max_nodes = max_nodes
+        self.capacity = max(2, int(budget_mb * 1024 * 1024 / BYTES_PER_SAMPLE / max(max_nodes, 1)))
+        self.nodes = {}
+        self.by_device = {}
+        self.dropped = {}  # (bench, device) -> node ids not buffered because max_nodes was reached
+        self.lock = threading.Lock()
+
+    def add(self, bench, device, value_type, index, node_id, timestamp, value):
+        """Append one sample; timestamp is unix seconds, a naive UTC datetime or isoformat string."""
+        ts = timestamp if isinstance(timestamp, (int, float)) else to_epoch(timestamp)
+        with self.lock:
+            ring = self.nodes.get((bench, node_id))
+            if ring is None:
+                if len(self.nodes) >= self.max_nodes:
+                    self.dropped.setdefault((bench, device), set()).add(node_id)
+                    return
+                ring = NodeRing(self.capacity, bench, device, value_type, index, node_id, ts)
+                self.nodes[(bench, node_id)] = ring
+                self.by_device.setdefault((bench, device), []).append(ring)
+            ring.append(ts, value)
+
+    def covers(self, bench, device, start):
+        """True if every series of device is buffered and holds all samples from start (naive UTC datetime) on."""
+        if start is None:
+            return False
+        ts = to_epoch(start)
+        with self.lock:
+            if (bench, device) in self.dropped:
+                return False  # some series of the device are not buffered at all
+            rings = self.by_device.get((bench, device))
+            return bool(rings) and all(r.since <= ts for r in rings)
+
+    def window(self, bench, node_id, start=None, end=None):
+        """(array ts, array values) of one node, or None if the node is not buffered."""
+        with self.lock:
+            ring = self.nodes.get((bench, node_id))
+            if ring is None:
+                return None
+            return ring.window(None if start is None else to_epoch(start), None if end is None else to_epoch(end))
+
+    def device_rows(self, bench, device, start, end):
+        """Rows in the /historical_values format for device within [start, end], sorted by timestamp."""
+        rows = []
+        with self.lock:
+            for ring in self.by_device.get((bench, device), []):
+                ts, values = ring.window(to_epoch(start), None if end is None else to_epoch(end))
+                rows.extend(
+                    (t, ring.type, ring.index, ring.node_id, None if math.isnan(v) else v)
+                    for t, v in zip(ts, values)
+                )
+        rows.sort(key=lambda r: r[0])
+        return [
+            {"bench": bench, "type": t, "index": i, "node_id": n, "value": v, "timestamp": from_epoch(ts).isoformat()}
+            for ts, t, i, n, v in rows
+        ]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "nodes": len(self.nodes),
+                "max_nodes": self.max_nodes,
+                "dropped_nodes": sum(len(nodes) for nodes in self.dropped.values()),
+                "capacity_per_node": self.capacity,
+                "samples": sum(r.count for r in self.nodes.values()),
+                "allocated_bytes": len(self.nodes) * self.capacity * BYTES_PER_SAMPLE,
+            }
+
+
+recent_history = RecentHistory()
@@ -0,0 +1,114 @@
+# Pre-serialized, ETag-versioned responses for hot read endpoints.
+#
+# Dashboards poll /sim_values, /param_values and /opcua_tree every second. For
+# each cache key (endpoint + query parameters) the cache keeps:
+#   - the last raw snapshot read from the source, reused for RESPONSE_CACHE_MAX_AGE
+#     seconds so concurrent pollers share one OPC UA read sweep,
+#   - a data-change counter, bumped only when a new snapshot differs,
+#   - the JSON body serialized once per version, with an ETag of its content.
+# A request whose If-None-Match matches gets an empty 304; any other request gets
+# the stored bytes without building or serializing anything.
+#
+# The body is encoded with orjson when installed, otherwise with the standard
+# json module.
+import hashlib
+import json
+import os
+import threading
+import time
+
+from fastapi import Response
+
+from backend.profiling import span
+
+RESPONSE_CACHE_MAX_AGE = float(os.environ.get("RESPONSE_CACHE_MAX_AGE", "0.5"))
+
+try:
+    import orjson
+
+    def dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    def dumps(data):
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class Entry:
+    __slots__ = ("lock", "read_at", "snapshot", "version", "body", "etag", "body_version", "invalidations")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.read_at = 0.0
+        self.snapshot = None
+        self.version = 0
+        self.body = None
+        self.etag = None
+        self.body_version = -1
+        self.invalidations = 0
+
+
+class ResponseCache:
+    def __init__(self, max_age=RESPONSE_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.metrics = {"hits": 0, "not_modified": 0, "reads": 0, "serializations": 0}
+
+    def _entry(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = Entry()
+            return entry
+
+    def invalidate(self, prefix="", bench=None):
+        """Force a fresh read on the next request for every key starting with prefix and, if given, for bench."""
+        with self.lock:
+            for key, entry in self.entries.items():
+                if key.startswith(prefix) and (bench is None or f"bench={bench}" in key.partition("?")[2].split("&")):
+                    entry.read_at = 0.0
+                    # a read already in flight may predate the write: its snapshot must not count as fresh
+                    entry.invalidations += 1
+
+    def body(self, key, read, render=None):
+        """(etag, body bytes) for key; read() returns the raw snapshot, render(snapshot) the JSON-able data."""
+        entry = self._entry(key)
+        # one reader per key; concurrent requests wait for it and share the result
+        with entry.lock:
+            now = time.monotonic()
+            if now - entry.read_at >= self.max_age:
+                invalidations = entry.invalidations
+                with span("read", key=key):
+                    snapshot = read()
+                entry.read_at = time.monotonic() if entry.invalidations == invalidations else 0.0
+                self.metrics["reads"] += 1
+                if entry.body is None or snapshot != entry.snapshot:
+                    entry.snapshot = snapshot
+                    entry.version += 1
+            if entry.body_version != entry.version:
+                with span("serialize", key=key):
+                    entry.body = dumps(render(entry.snapshot) if render else entry.snapshot)
+                entry.etag = '"%s"' % hashlib.blake2b(entry.body, digest_size=12).hexdigest()
+                entry.body_version = entry.version
+                self.metrics["serializations"] += 1
+            else:
+                self.metrics["hits"] += 1
+            return entry.etag, entry.body
+
+    def respond(self, request, key, read, render=None):
+        """200 with the cached JSON bytes, or 304 if the client already has this version."""
+        etag, body = self.body(key, read, render)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+            self.metrics["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self):
+        with self.lock:
+            versions = {key: entry.version for key, entry in self.entries.items()}
+        return dict(self.metrics, max_age=self.max_age, versions=versions)
+
+
+response_cache = ResponseCache()
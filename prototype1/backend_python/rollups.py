@@ -0,0 +1,139 @@
+# Incrementally maintained rollup tables (1 s / 1 min / 1 h) for historical_values.
+#
+# Writers call update_rollups(db, samples) with the samples they just added to
+# historical_values, before committing, so raw rows and rollups land in the same
+# transaction. Each rollup row holds min/max/sum/count/first/last of one node in
+# one bucket; buckets are merged with an SQLite upsert.
+#
+# Rebuild from existing data:
+#   python -m backend.rollups backfill
+from sqlalchemy import case, func
+from sqlalchemy.dialects.sqlite import insert
+
+from backend.models import HistoricalValue, Rollup1s, Rollup1m, Rollup1h
+from backend.nodes import to_epoch
+
+# (bucket width in seconds, table), finest first
+LEVELS = [(1, Rollup1s), (60, Rollup1m), (3600, Rollup1h)]
+BACKFILL_BATCH = 50000
+
+
+def aggregate(samples, width):
+    """Aggregate (node, epoch_ts, value) samples into {(node, bucket): row dict} for one level."""
+    rows = {}
+    for node, ts, value in samples:
+        if value is None:
+            continue
+        key = (node, int(ts // width) * width)
+        row = rows.get(key)
+        if row is None:
+            rows[key] = {"node": key[0], "bucket": key[1], "min": value, "max": value, "sum": value, "count": 1,
+                         "first": value, "last": value, "first_ts": ts, "last_ts": ts}
+            continue
+        row["min"] = min(row["min"], value)
+        row["max"] = max(row["max"], value)
+        row["sum"] += value
+        row["count"] += 1
+        if ts < row["first_ts"]:
+            row["first"], row["first_ts"] = value, ts
+        if ts >= row["last_ts"]:
+            row["last"], row["last_ts"] = value, ts
+    return rows
+
+
+def _upsert(table):
+    stmt = insert(table)
+    t, ex = table.__table__.c, stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[t.node, t.bucket],
+        set_={
+            "min": func.min(t.min, ex.min),
+            "max": func.max(t.max, ex.max),
+            "sum": t.sum + ex.sum,
+            "count": t.count + ex.count,
+            "first": case((ex.first_ts < t.first_ts, ex.first), else_=t.first),
+            "first_ts": func.min(t.first_ts, ex.first_ts),
+            "last": case((ex.last_ts >= t.last_ts, ex.last), else_=t.last),
+            "last_ts": func.max(t.last_ts, ex.last_ts),
+        },
+    )
+
+
+def update_rollups(db, samples):
+    """Merge samples (node, timestamp, value) into all rollup levels. Does not commit."""
+    samples = [(node, to_epoch(ts) if not isinstance(ts, (int, float)) else ts, value)
+               for node, ts, value in samples if isinstance(value, (int, float))]
+    if not samples:
+        return
+    for width, table in LEVELS:
+        rows = aggregate(samples, width)
+        db.execute(_upsert(table), list(rows.values()))
+
+
+def pick_level(width):
+    """Coarsest rollup level whose buckets fit into the requested bucket width, or None for raw data."""
+    best = None
+    for level_width, table in LEVELS:
+        if level_width <= width:
+            best = (level_width, table)
+    return best
+
+
+def level_buckets(db, table, node, lo, hi, width):
+    """[(bucket_start_epoch, avg, min, max, count)] of the level buckets of table in [lo, hi] grouped by width."""
+    bucket = func.floor(table.bucket / width)
+    rows = (
+        db.query(bucket.label("b"), func.sum(table.sum) / func.sum(table.count),
+                 func.min(table.min), func.max(table.max), func.sum(table.count))
+        .filter(table.node == node)
+        .filter(table.bucket >= lo)
+        .filter(table.bucket <= hi)
+        .group_by("b")
+        .order_by("b")
+        .all()
+    )
+    return [(int(b) * width, avg, mn, mx, count) for b, avg, mn, mx, count in rows]
+
+
+def backfill(db, batch_size=BACKFILL_BATCH):
+    """Rebuild all rollup tables from historical_values. Commits per batch; returns the number of raw rows read."""
+    for _, table in LEVELS:
+        db.query(table).delete()
+    db.commit()
+    total = 0
+    last_id = 0
+    while True:
+        # keyset pagination on id, so no read cursor stays open across the per-batch commits
+        rows = (
+            db.query(HistoricalValue.id, HistoricalValue.node, HistoricalValue.timestamp, HistoricalValue.value)
+            .filter(HistoricalValue.id > last_id)
+            .order_by(HistoricalValue.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        update_rollups(db, [(node, ts, value) for _, node, ts, value in rows])
+        db.commit()
+        total += len(rows)
+    return total
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from backend.models import Base, engine, SessionLocal
+
+    parser = argparse.ArgumentParser(description="Maintain historian rollup tables")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    started = time.perf_counter()
+    try:
+        rows = backfill(db)
+    finally:
+        db.close()
+    print(f"Rebuilt rollups from {rows} rows in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,402 @@
+# Poller election, request forwarding and shared current-value tables for
+# multi-worker deployments.
+#
+# Every uvicorn worker imports main.py and runs its lifespan. Only the worker
+# that holds an exclusive lock on POLLER_LOCK_FILE starts the bench pollers, so
+# the PLCs see one OPC UA session per bench and history is written once. The
+# other workers retry the lock every POLLER_RETRY_SECONDS and take over when the
+# poller process exits (the OS drops the lock with the process). Election is
+# opt-in: set POLLER_LOCK_FILE (e.g. "poller.lock") when running with several
+# workers. Without it (the default) the process polls itself and starts neither
+# a lock file nor the forwarding listener.
+#
+# The poller also serves the app on a private listener on localhost
+# (PollerEndpoint) and writes "<pid> <port>" into the lock file. Requests that
+# talk to a PLC (reads, writes, browsing) or need the in-memory state the
+# poller feeds (statistics, alarms, recent history) are forwarded there by the
+# other workers, streams included, so every worker gives the same answer and
+# only the poller talks to the PLCs. Polled values are not forwarded: every
+# worker reads them from the shared tables below.
+#
+# The poller publishes every sweep into one shared-memory table per bench:
+#
+#   u64 magic | u64 seq | u64 node count | u64 layout id | f64 written_at | pad to 64 bytes
+#   f64 value[node count]        one slot per mapped node, in mapping order; NaN = no value
+#
+# The segment name and the layout id come from the lock file, the bench id and
+# the node list, so workers with the same mapping find the same table and a
+# changed mapping gets a new one. Writes use a seqlock: seq is odd while the
+# values change. A reader copies the values and keeps the copy if seq was even
+# and unchanged around it. A single read is one memcpy from pages shared by all
+# workers; nothing is serialized between processes.
+#
+# Segments outlive the worker that created them, so a new poller continues in
+# the same table. They are not unlinked on shutdown (one per bench and mapping,
+# a few KB each).
+import hashlib
+import http.client
+import math
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+POLLER_LOCK_FILE = os.environ.get("POLLER_LOCK_FILE", "")
+POLLER_RETRY_SECONDS = float(os.environ.get("POLLER_RETRY_SECONDS", "2"))
+POLLER_FORWARD_TIMEOUT = float(os.environ.get("POLLER_FORWARD_TIMEOUT", "30"))
+
+FORWARD_HEADER = "x-poller-forward"
+# not passed on: hop-by-hop headers, and the ones http.client sets itself
+REQUEST_SKIP = {"host", "content-length", "connection", "keep-alive", "transfer-encoding", "te", "upgrade"}
+RESPONSE_SKIP = {"connection", "keep-alive", "transfer-encoding"}
+
+MAGIC = int.from_bytes(b"VTSHM001", "little")
+HEADER_BYTES = 64
+HEADER_DOUBLES = HEADER_BYTES // 8
+READ_ATTEMPTS = 100
+
+
+def _lock(f, blocking=False):
+    if os.name == "nt":
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def _unlock(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def startup_lock(path=POLLER_LOCK_FILE):
+    """One worker at a time, for startup steps such as creating the DB schema."""
+    if not path:
+        yield
+        return
+    with open(os.path.abspath(path) + ".startup", "a+") as f:
+        _lock(f, blocking=True)
+        try:
+            yield
+        finally:
+            _unlock(f)
+
+
+class PollerElection:
+    def __init__(self, path=POLLER_LOCK_FILE, retry_seconds=POLLER_RETRY_SECONDS):
+        self.path = os.path.abspath(path) if path else ""
+        self.retry_seconds = retry_seconds
+        self.leader = False
+        self.elected_at = None
+        self._file = None
+        self._thread = None
+        self._closed = threading.Event()
+
+    def try_acquire(self):
+        if self.leader:
+            return True
+        if not self.path:
+            self.leader = True
+        else:
+            f = open(self.path, "a+")
+            try:
+                _lock(f)
+            except OSError:
+                f.close()
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            self._file = f
+            self.leader = True
+        self.elected_at = time.time()
+        return True
+
+    def announce(self, port):
+        """Publish the port of this poller's forwarding endpoint next to its pid."""
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(f"{os.getpid()} {port}")
+            self._file.flush()
+
+    def run(self, on_elected):
+        """Call on_elected() now if this process wins the lock, else as soon as the current poller exits."""
+        if self.try_acquire():
+            on_elected()
+            return
+
+        def wait():
+            while not self._closed.wait(self.retry_seconds):
+                if self.try_acquire():
+                    print(f"Poller election: process {os.getpid()} took over polling")
+                    on_elected()
+                    return
+        self._closed.clear()
+        self._thread = threading.Thread(target=wait, name="poller-election", daemon=True)
+        self._thread.start()
+
+    def stop_waiting(self):
+        """No takeover by this process from now on (shutdown); the lock, if held, is kept."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def release(self):
+        self.stop_waiting()
+        if self._file is not None:
+            try:
+                _unlock(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self.leader = False
+
+    def poller_address(self):
+        """(pid, forwarding port or None) of the current poller, read from the lock file; None if unknown."""
+        if not self.path:
+            return os.getpid(), None
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                fields = f.read().split()
+            return int(fields[0]), int(fields[1]) if len(fields) > 1 else None
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def poller_pid(self):
+        address = self.poller_address()
+        return address[0] if address else None
+
+    def stats(self):
+        return {
+            "role": "poller" if self.leader else "reader",
+            "pid": os.getpid(),
+            "poller_pid": self.poller_pid(),
+            "lock_file": self.path or None,
+            "elected_at": self.elected_at,
+        }
+
+
+class PollerEndpoint:
+    """The poller's private HTTP listener on localhost, and the forwarding to it from the other workers."""
+
+    def __init__(self, election, host="127.0.0.1", timeout=POLLER_FORWARD_TIMEOUT):
+        self.election = election
+        self.host = host
+        self.timeout = timeout
+        self.port = None
+        self.server = None
+        self._thread = None
+        self.metrics = {"forwarded": 0, "unavailable": 0}
+
+    def start(self, app):
+        """Serve app on an ephemeral localhost port (no lifespan) and announce the port in the lock file."""
+        if not self.election.path:
+            return  # no election: every process polls and nothing is forwarded
+        import socket
+        import uvicorn
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, 0))
+        sock.listen(128)
+        # log_config=None: a second Config must not reconfigure the worker's logging
+        self.server = uvicorn.Server(uvicorn.Config(app, lifespan="off", log_config=None, access_log=False))
+        self._thread = threading.Thread(target=self.server.run, kwargs={"sockets": [sock]}, name="poller-endpoint",
+                                        daemon=True)
+        self._thread.start()
+        self.port = sock.getsockname()[1]
+        self.election.announce(self.port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.should_exit = True
+            self._thread.join(5.0)
+            self.server = self._thread = self.port = None
+
+    async def forward(self, request):
+        """The poller's response to request, streamed through; 503 while no poller is reachable."""
+        from starlette.concurrency import run_in_threadpool
+        from starlette.responses import JSONResponse, StreamingResponse
+
+        address = self.election.poller_address()
+        # a forwarded request reaching a non-poller means the lock file was stale: do not forward again
+        if request.headers.get(FORWARD_HEADER) or address is None or address[1] is None:
+            return self._unavailable(JSONResponse, "no poller endpoint")
+        body = await request.body()
+        headers = {k: v for k, v in request.headers.items() if k not in REQUEST_SKIP}
+        headers[FORWARD_HEADER] = "1"
+        target = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+
+        def send():
+            conn = http.client.HTTPConnection(self.host, address[1], timeout=self.timeout)
+            try:
+                conn.request(request.method, target, body=body, headers=headers)
+                response = conn.getresponse()
+            except BaseException:
+                conn.close()
+                raise
+            if response.getheader("content-type", "").startswith("text/event-stream"):
+                conn.sock.settimeout(None)  # a stream may stay quiet for long
+            return conn, response
+        try:
+            conn, response = await run_in_threadpool(send)
+        except OSError as e:
+            return self._unavailable(JSONResponse, e)
+
+        def chunks():
+            try:
+                while True:
+                    chunk = response.read1(65536)
+                    if not chunk:
+                        return
+                    yield chunk
+            finally:
+                conn.close()
+        self.metrics["forwarded"] += 1
+        forwarded = StreamingResponse(chunks(), status_code=response.status)
+        forwarded.raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                                 for k, v in response.getheaders() if k.lower() not in RESPONSE_SKIP]
+        return forwarded
+
+    def _unavailable(self, response_class, reason):
+        self.metrics["unavailable"] += 1
+        return response_class({"detail": f"Poller not reachable ({reason}), retry shortly"}, status_code=503,
+                              headers={"Retry-After": str(int(POLLER_RETRY_SECONDS) + 1)})
+
+    def stats(self):
+        return dict(self.metrics, port=self.port)
+
+
+def _shared_memory(name, create, size):
+    """SharedMemory segment that the resource tracker leaves alone when this process exits; None if missing."""
+    from multiprocessing import shared_memory
+    try:
+        try:
+            return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+        except TypeError:
+            pass  # Python < 3.13: no track parameter
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    except FileExistsError:
+        return _shared_memory(name, False, size)
+    except FileNotFoundError:
+        return None
+    if os.name == "posix":
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedTable:
+    """Current values of one bench in shared memory, one float64 slot per mapped node."""
+
+    def __init__(self, shm, name, node_ids, layout):
+        self.shm = shm
+        self.name = name
+        self.count = len(node_ids)
+        self.layout = layout
+        self.index = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.words = shm.buf.cast('Q')
+        self.doubles = shm.buf.cast('d')
+        self.metrics = {"published": 0, "reads": 0, "retries": 0}
+        self._write_lock = threading.Lock()  # the poller thread and request threads of the poller both write
+
+    @classmethod
+    def open(cls, bench_id, node_ids, create=False, lock_file=POLLER_LOCK_FILE):
+        """The table of a bench; create=False attaches only and returns None until the poller has created it."""
+        digest = hashlib.sha1("\n".join([os.path.abspath(lock_file or "."), bench_id, *node_ids]).encode()).hexdigest()
+        name = f"vt_{digest[:16]}"
+        layout = int(digest[16:32], 16)
+        shm = _shared_memory(name, create, HEADER_BYTES + 8 * len(node_ids))
+        if shm is None:
+            return None
+        table = cls(shm, name, node_ids, layout)
+        words = table.words
+        if create and (words[0] != MAGIC or words[3] != layout):
+            table.doubles[HEADER_DOUBLES:HEADER_DOUBLES + table.count] = array('d', [math.nan]) * table.count
+            words[1] = 0
+            words[2] = table.count
+            words[3] = layout
+            table.doubles[4] = math.nan
+            words[0] = MAGIC
+        elif words[0] != MAGIC or words[3] != layout or words[2] != table.count:
+            table.close()  # created but not initialized yet
+            return None
+        return table
+
+    def publish(self, values, written_at):
+        """Write array('d') values (mapping order) as one consistent update."""
+        words = self.words
+        with self._write_lock:
+            seq = words[1]
+            words[1] = seq + 1
+            self.doubles[HEADER_DOUBLES:HEADER_DOUBLES + self.count] = values
+            self.doubles[4] = written_at
+            words[1] = seq + 2
+        self.metrics["published"] += 1
+
+    def update(self, node_id, value):
+        """Set the value of one node between publishes; ignored if the node is not in the table."""
+        i = self.index.get(node_id)
+        if i is None:
+            return
+        words = self.words
+        with self._write_lock:
+            seq = words[1]
+            words[1] = seq + 1
+            self.doubles[HEADER_DOUBLES + i] = value
+            words[1] = seq + 2
+
+    def read(self):
+        """(seq, written_at, array('d') of all values); a read racing a publish is repeated."""
+        words, buf = self.words, self.shm.buf
+        end = HEADER_BYTES + 8 * self.count
+        self.metrics["reads"] += 1
+        for _ in range(READ_ATTEMPTS):
+            seq = words[1]
+            values = array('d')
+            values.frombytes(buf[HEADER_BYTES:end])
+            written_at = self.doubles[4]
+            if not seq & 1 and words[1] == seq:
+                return seq, written_at, values
+            self.metrics["retries"] += 1
+            time.sleep(0)
+        # the writer died in the middle of a publish: the last copy is the best there is
+        return seq, written_at, values
+
+    def value(self, node_id):
+        """Current value of one node without copying the table; None if unknown or no value."""
+        i = self.index.get(node_id)
+        if i is None:
+            return None
+        for _ in range(READ_ATTEMPTS):
+            seq = self.words[1]
+            value = self.doubles[HEADER_DOUBLES + i]
+            if not seq & 1 and self.words[1] == seq:
+                break
+        return None if value != value else value
+
+    def age(self):
+        """Seconds since the last publish; None before the first one."""
+        written_at = self.doubles[4]
+        return None if written_at != written_at else time.time() - written_at
+
+    def close(self):
+        self.words.release()
+        self.doubles.release()
+        self.shm.close()
+
+    def stats(self):
+        return dict(self.metrics, name=self.name, nodes=self.count, seq=self.words[1])
+
+
+poller_election = PollerElection()
+poller_endpoint = PollerEndpoint(poller_election)
@@ -0,0 +1,444 @@
+# Full-state snapshots of a test bench.
+#
+# A snapshot is the value of every mapped node at one moment, read with a single
+# Read request for all NodeIds, so the server answers them from one state.
+# Snapshots are taken on demand (POST /snapshots, e.g. labelled "start"/"end" by
+# the test sequence) and when a trigger bit rises during a poll sweep: nodes whose
+# type ends with one of SNAPSHOT_TRIGGERS (the *_Start/*_Stop bits of Kommandos).
+#
+# Each snapshot is one zlib-compressed blob (pack/unpack): a header, the type code
+# of every value as array('B'), the numbers as array('d') and the few values that
+# are no numbers (strings, arrays) as JSON. The node list is not in the blob: it
+# is stored once per distinct mapping in snapshot_indexes and referenced by id.
+# Every SNAPSHOT_KEYFRAME_EVERY-th snapshot of a bench is a keyframe with all
+# values; the ones in between are deltas holding only the positions that changed
+# since the previous snapshot.
+#
+# Restoring decodes the keyframe and applies the deltas after it (at most
+# SNAPSHOT_KEYFRAME_EVERY - 1). The last SNAPSHOT_CACHE restored states are kept
+# in memory, so a chain usually starts from a cached neighbour.
+#
+# Snapshots are written by the historian's writer thread (historian.submit), in
+# queue order with the samples, so the single-writer rule holds for them too.
+# POST /snapshots waits for the commit; a trigger during a sweep does not.
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from concurrent import futures
+from collections import OrderedDict
+
+from sqlalchemy import func
+
+from backend.models import Snapshot, SnapshotIndex
+from backend.historian import historian
+from backend.nodes import to_iso
+from backend.profiling import span
+
+SNAPSHOT_KEYFRAME_EVERY = int(os.environ.get("SNAPSHOT_KEYFRAME_EVERY", "20"))
+SNAPSHOT_CACHE = int(os.environ.get("SNAPSHOT_CACHE", "32"))
+SNAPSHOT_TRIGGERS = tuple(s for s in os.environ.get("SNAPSHOT_TRIGGERS", "_Start,_Stop").split(",") if s)
+SNAPSHOT_COMPRESSION = int(os.environ.get("SNAPSHOT_COMPRESSION", "6"))  # zlib level
+SNAPSHOT_WRITE_TIMEOUT = float(os.environ.get("SNAPSHOT_WRITE_TIMEOUT", "30"))
+
+
+class SnapshotUnavailable(Exception):
+    pass
+
+MAGIC = b"SNP1"
+HEADER = struct.Struct("<4sBII")  # magic, keyframe flag, node count, stored entries
+NONE, FLOAT, INT, BOOL, OTHER = range(5)
+MAX_EXACT_INT = 2 ** 53  # larger integers do not fit a double and are stored as OTHER
+
+
+def _jsonable(value):
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _finite(value):
+    return None if isinstance(value, float) and (value != value or value in (float("inf"), float("-inf"))) else value
+
+
+class State:
+    """Values of all nodes of one node index, column-wise."""
+    __slots__ = ("types", "values", "other")
+
+    def __init__(self, types, values, other):
+        self.types = types  # array('B') of type codes
+        self.values = values  # array('d'); 0.0 for NONE and OTHER
+        self.other = other  # position -> JSON value, for OTHER
+
+    @classmethod
+    def from_values(cls, values):
+        types = array('B', bytes(len(values)))
+        numbers = array('d', bytes(8 * len(values)))
+        other = {}
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                types[i] = BOOL
+                numbers[i] = 1.0 if value else 0.0
+            elif isinstance(value, int) and -MAX_EXACT_INT <= value <= MAX_EXACT_INT:
+                types[i] = INT
+                numbers[i] = value
+            elif isinstance(value, float):
+                types[i] = FLOAT
+                numbers[i] = value
+            else:
+                types[i] = OTHER
+                other[i] = _jsonable(value)
+        return cls(types, numbers, other)
+
+    def value(self, i):
+        t = self.types[i]
+        if t == FLOAT:
+            return self.values[i]
+        if t == INT:
+            return int(self.values[i])
+        if t == BOOL:
+            return self.values[i] != 0.0
+        if t == OTHER:
+            return self.other[i]
+        return None
+
+    def changed(self, base):
+        """Positions whose value differs from base (a state of the same node index)."""
+        types, values, base_types, base_values = self.types, self.values, base.types, base.values
+        positions = array('I')
+        for i in range(len(types)):
+            a, b = values[i], base_values[i]
+            if types[i] != base_types[i] or (a != b and (a == a or b == b)):
+                positions.append(i)
+            elif types[i] == OTHER and self.other[i] != base.other[i]:
+                positions.append(i)
+        return positions
+
+    def apply(self, positions, types, values, other):
+        """New state with the entries of a delta applied."""
+        state = State(array('B', self.types), array('d', self.values), dict(self.other))
+        for j, i in enumerate(positions):
+            state.types[i] = types[j]
+            state.values[i] = values[j]
+            state.other.pop(i, None)
+        state.other.update(other)
+        return state
+
+
+def _to_bytes(a):
+    if sys.byteorder == "big" and a.itemsize > 1:
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_bytes(typecode, raw, offset, count):
+    a = array(typecode)
+    a.frombytes(raw[offset:offset + count * a.itemsize])
+    if sys.byteorder == "big" and a.itemsize > 1:
+        a.byteswap()
+    return a, offset + count * a.itemsize
+
+
+def pack(state, positions=None):
+    """Blob of a keyframe (positions None: all values) or of a delta with the given positions."""
+    n = len(state.types)
+    if positions is None:
+        parts = [HEADER.pack(MAGIC, 1, n, n), _to_bytes(state.types), _to_bytes(state.values)]
+        other = state.other
+    else:
+        parts = [HEADER.pack(MAGIC, 0, n, len(positions)), _to_bytes(positions),
+                 _to_bytes(array('B', (state.types[i] for i in positions))),
+                 _to_bytes(array('d', (state.values[i] for i in positions)))]
+        other = {i: state.other[i] for i in positions if i in state.other}
+    if other:
+        parts.append(json.dumps({str(i): v for i, v in other.items()}, separators=(",", ":")).encode())
+    return zlib.compress(b"".join(parts), SNAPSHOT_COMPRESSION)
+
+
+def unpack(blob):
+    """(keyframe, node count, positions or None, types, values, other) of a blob."""
+    raw = zlib.decompress(blob)
+    magic, keyframe, n, entries = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError("Not a snapshot blob")
+    offset = HEADER.size
+    positions = None
+    if not keyframe:
+        positions, offset = _from_bytes('I', raw, offset, entries)
+    types, offset = _from_bytes('B', raw, offset, entries)
+    values, offset = _from_bytes('d', raw, offset, entries)
+    other = {int(i): v for i, v in json.loads(raw[offset:]).items()} if offset < len(raw) else {}
+    return bool(keyframe), n, positions, types, values, other
+
+
+class SnapshotStore:
+    def __init__(self, keyframe_every=SNAPSHOT_KEYFRAME_EVERY, cache_size=SNAPSHOT_CACHE, triggers=SNAPSHOT_TRIGGERS):
+        self.keyframe_every = max(1, keyframe_every)
+        self.cache_size = cache_size
+        self.triggers = triggers
+        self.lock = threading.Lock()
+        self.heads = {}  # bench -> (snapshot id, index id, deltas since keyframe, State)
+        self.states = OrderedDict()  # snapshot id -> (State, deltas since keyframe), LRU
+        self.indexes = {}  # index id -> [[device, type, node_id], ...]
+        self.index_ids = {}  # digest -> index id
+        self.watch = {}  # bench -> (nodes, trigger positions, last bit per trigger)
+        self.metrics = {"taken": 0, "keyframes": 0, "deltas": 0, "bytes": 0, "triggered": 0, "restored": 0,
+                        "errors": 0, "last_read_ms": None, "last_restore_ms": None}
+
+    # -- taking
+
+    def take(self, bench, label=None, wait=True):
+        """Read every node of the bench in one request and store the snapshot; returns its summary (see store)."""
+        nodes = bench.nodes()
+        started = time.perf_counter()
+        with span("snapshot.read", nodes=len(nodes)):
+            values = bench.session.read_values([node_id for _, _, _, node_id in nodes], batch=max(1, len(nodes)))
+        taken_at = time.time()
+        self.metrics["last_read_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return self.store(bench.id, nodes, values, taken_at, label, wait)
+
+    def store(self, bench_id, nodes, values, taken_at, label=None, wait=True):
+        """Queue the snapshot for the historian's writer thread; with wait, return its summary once committed."""
+        state = State.from_values(values)
+        listing = [[device, value_type, node_id] for device, value_type, _, node_id in nodes]
+        future = historian.submit(lambda db: self._write(db, bench_id, listing, state, taken_at, label))
+        if not wait:
+            return future
+        try:
+            return future.result(SNAPSHOT_WRITE_TIMEOUT)
+        except futures.TimeoutError:
+            raise SnapshotUnavailable(f"Snapshot of {bench_id} not written within {SNAPSHOT_WRITE_TIMEOUT} s")
+
+    def _write(self, db, bench_id, listing, state, taken_at, label):
+        # runs in the historian writer thread, one snapshot after the other, so deltas chain in order
+        try:
+            with self.lock, span("snapshot.store"):
+                index_id = self._index_id(db, listing)
+                head = self._head(db, bench_id)
+                if head is not None and head[1] == index_id and head[2] + 1 < self.keyframe_every:
+                    base_id, depth = head[0], head[2] + 1
+                    positions = state.changed(head[3])
+                    blob = pack(state, positions)
+                    changed = len(positions)
+                    if changed * 2 > len(listing):
+                        # most values changed: a keyframe is about as small and ends the chain
+                        keyframe = pack(state)
+                        if len(keyframe) <= len(blob):
+                            base_id, depth, blob, changed = None, 0, keyframe, len(listing)
+                else:
+                    base_id, depth = None, 0
+                    blob = pack(state)
+                    changed = len(listing)
+                row = Snapshot(bench=bench_id, label=label, taken_at=taken_at, keyframe=base_id is None,
+                               base_id=base_id, index_id=index_id, changed=changed, data=blob)
+                db.add(row)
+                # committed before the head moves to it
+                db.commit()
+                self.heads[bench_id] = (row.id, index_id, depth, state)
+                self._cache(row.id, state, depth)
+                self.metrics["taken"] += 1
+                self.metrics["keyframes" if base_id is None else "deltas"] += 1
+                self.metrics["bytes"] += len(blob)
+                return self._summary(row.id, bench_id, label, taken_at, base_id is None, base_id, index_id, changed,
+                                     len(blob))
+        except Exception:
+            # an index row created in the failed transaction does not exist
+            self.index_ids.clear()
+            self.metrics["errors"] += 1
+            raise
+
+    def on_sweep(self, bench, nodes, values):
+        """Take a snapshot when a trigger bit (e.g. Langzeittest_Start) rises between two sweeps."""
+        if not self.triggers:
+            return None
+        watch = self.watch.get(bench.id)
+        if watch is None or watch[0] is not nodes:
+            positions = [i for i, (_, value_type, _, _) in enumerate(nodes) if value_type.endswith(self.triggers)]
+            watch = self.watch[bench.id] = (nodes, positions, [None] * len(positions))
+        _, positions, last = watch
+        fired = []
+        for j, i in enumerate(positions):
+            value = values[i]
+            bit = bool(value) if isinstance(value, (bool, int, float)) else None
+            if bit and last[j] is False:
+                device, value_type, _, _ = nodes[i]
+                fired.append(f"{device}.{value_type}")
+            last[j] = bit
+        if not fired:
+            return None
+        self.metrics["triggered"] += 1
+        try:
+            # the poller does not wait for the write
+            future = self.take(bench, label=",".join(fired), wait=False)
+        except Exception as e:
+            print(f"Snapshots: {bench.id}: snapshot on {fired} failed: {e}")
+            return None
+        future.add_done_callback(lambda f: f.exception() and print(
+            f"Snapshots: {bench.id}: snapshot on {fired} failed: {f.exception()}"))
+        return future
+
+    def _index_id(self, db, listing):
+        encoded = json.dumps(listing, separators=(",", ":")).encode()
+        digest = hashlib.sha1(encoded).hexdigest()
+        index_id = self.index_ids.get(digest)
+        if index_id is None:
+            index_id = db.query(SnapshotIndex.id).filter(SnapshotIndex.digest == digest).scalar()
+            if index_id is None:
+                row = SnapshotIndex(digest=digest, nodes=zlib.compress(encoded, SNAPSHOT_COMPRESSION))
+                db.add(row)
+                db.flush()
+                index_id = row.id
+            self.index_ids[digest] = index_id
+            self.indexes[index_id] = listing
+        return index_id
+
+    def _head(self, db, bench_id):
+        # last snapshot of the bench, the base of the next delta; loaded from the DB after a restart
+        head = self.heads.get(bench_id)
+        if head is None:
+            row = db.query(Snapshot.id, Snapshot.index_id).filter(Snapshot.bench == bench_id) \
+                .order_by(Snapshot.id.desc()).first()
+            if row is None:
+                return None
+            state, depth = self._state(db, row.id)
+            head = self.heads[bench_id] = (row.id, row.index_id, depth, state)
+        return head
+
+    # -- restoring
+
+    def _cache(self, snapshot_id, state, depth):
+        self.states[snapshot_id] = (state, depth)
+        self.states.move_to_end(snapshot_id)
+        while len(self.states) > self.cache_size:
+            self.states.popitem(last=False)
+
+    def _state(self, db, snapshot_id):
+        """(State, deltas since keyframe) of a snapshot: keyframe or cached state plus the deltas after it."""
+        chain = []
+        snapshot = snapshot_id
+        while True:
+            hit = self.states.get(snapshot)
+            if hit is not None:
+                self.states.move_to_end(snapshot)
+                state, depth = hit
+                break
+            row = db.query(Snapshot.keyframe, Snapshot.base_id, Snapshot.data).filter(Snapshot.id == snapshot).first()
+            if row is None:
+                raise LookupError(f"Snapshot {snapshot} not found")
+            chain.append(row.data)
+            if row.keyframe:
+                state, depth = None, -1
+                break
+            snapshot = row.base_id
+        for blob in reversed(chain):
+            keyframe, _, positions, types, values, other = unpack(blob)
+            if keyframe:
+                state, depth = State(types, values, other), 0
+            else:
+                state, depth = state.apply(positions, types, values, other), depth + 1
+        if chain:
+            self._cache(snapshot_id, state, depth)
+        return state, depth
+
+    def _nodes(self, db, index_id):
+        listing = self.indexes.get(index_id)
+        if listing is None:
+            blob = db.query(SnapshotIndex.nodes).filter(SnapshotIndex.id == index_id).scalar()
+            listing = self.indexes[index_id] = json.loads(zlib.decompress(blob))
+        return listing
+
+    def _summary(self, snapshot_id, bench, label, taken_at, keyframe, base_id, index_id, changed, size, db=None):
+        listing = self.indexes.get(index_id) if db is None else self._nodes(db, index_id)
+        return {
+            "id": snapshot_id,
+            "bench": bench,
+            "label": label,
+            "taken_at": to_iso(taken_at),
+            "keyframe": keyframe,
+            "base_id": base_id,
+            "nodes": len(listing),
+            "changed": changed,
+            "bytes": size,
+        }
+
+    def _row(self, db, snapshot_id):
+        row = db.query(Snapshot.id, Snapshot.bench, Snapshot.label, Snapshot.taken_at, Snapshot.keyframe,
+                       Snapshot.base_id, Snapshot.index_id, Snapshot.changed, func.length(Snapshot.data)) \
+            .filter(Snapshot.id == snapshot_id).first()
+        if row is None:
+            raise LookupError(f"Snapshot {snapshot_id} not found")
+        return row
+
+    def list(self, db, bench=None, start=None, end=None, limit=100):
+        """Summaries, newest first; start/end are unix seconds."""
+        query = db.query(Snapshot.id, Snapshot.bench, Snapshot.label, Snapshot.taken_at, Snapshot.keyframe,
+                         Snapshot.base_id, Snapshot.index_id, Snapshot.changed, func.length(Snapshot.data))
+        if bench:
+            query = query.filter(Snapshot.bench == bench)
+        if start is not None:
+            query = query.filter(Snapshot.taken_at >= start)
+        if end is not None:
+            query = query.filter(Snapshot.taken_at <= end)
+        with self.lock:
+            return [self._summary(*row, db=db) for row in query.order_by(Snapshot.id.desc()).limit(limit)]
+
+    def restore(self, db, snapshot_id):
+        """Summary and full state of a snapshot: one row per node, in mapping order."""
+        started = time.perf_counter()
+        with self.lock:
+            row = self._row(db, snapshot_id)
+            state, _ = self._state(db, snapshot_id)
+            listing = self._nodes(db, row.index_id)
+            summary = self._summary(*row, db=db)
+        values = [{"device": device, "type": value_type, "node_id": node_id, "value": _finite(state.value(i))}
+                  for i, (device, value_type, node_id) in enumerate(listing)]
+        self.metrics["restored"] += 1
+        self.metrics["last_restore_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return dict(summary, restore_ms=self.metrics["last_restore_ms"], values=values)
+
+    def diff(self, db, a, b):
+        """Nodes whose value differs between snapshots a and b; nodes missing on one side count as changed."""
+        with self.lock:
+            row_a, row_b = self._row(db, a), self._row(db, b)
+            state_a, _ = self._state(db, a)
+            state_b, _ = self._state(db, b)
+            nodes_a, nodes_b = self._nodes(db, row_a.index_id), self._nodes(db, row_b.index_id)
+            summary_a, summary_b = self._summary(*row_a, db=db), self._summary(*row_b, db=db)
+        changes = []
+        if row_a.index_id == row_b.index_id:
+            for i in state_b.changed(state_a):
+                device, value_type, node_id = nodes_b[i]
+                changes.append({"device": device, "type": value_type, "node_id": node_id,
+                                "a": _finite(state_a.value(i)), "b": _finite(state_b.value(i))})
+        else:
+            # different mappings: match the nodes by NodeId
+            positions_a = {node_id: i for i, (_, _, node_id) in enumerate(nodes_a)}
+            positions_b = {node_id: i for i, (_, _, node_id) in enumerate(nodes_b)}
+            for node_id in list(positions_a) + [n for n in positions_b if n not in positions_a]:
+                i, j = positions_a.get(node_id), positions_b.get(node_id)
+                value_a = state_a.value(i) if i is not None else None
+                value_b = state_b.value(j) if j is not None else None
+                if i is not None and j is not None and value_a == value_b:
+                    continue
+                device, value_type, _ = nodes_a[i] if i is not None else nodes_b[j]
+                changes.append({"device": device, "type": value_type, "node_id": node_id,
+                                "a": _finite(value_a), "b": _finite(value_b),
+                                "missing": None if i is not None and j is not None else ("a" if i is None else "b")})
+        return {"a": summary_a, "b": summary_b, "changed": changes}
+
+    def stats(self):
+        return dict(self.metrics, keyframe_every=self.keyframe_every, cached=len(self.states),
+                    triggers=list(self.triggers))
+
+
+snapshot_store = SnapshotStore()
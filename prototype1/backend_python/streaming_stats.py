@@ -0,0 +1,281 @@
+# Online statistics per node, updated on the ingest path.
+#
+# The historian feeds every committed sample in. Nodes are grouped into sections
+# (bench + device, i.e. one data block of a test bench). A section keeps its
+# accumulators column-wise: one array('d') per statistic with one slot per node,
+# so a batch is applied in one pass over flat arrays and no per-node objects are
+# created. Per node:
+#
+#   full run   count, mean, std (Welford), min, max, first/last timestamp
+#   EWMA       mean, std and rate of change, time-based with STATS_EWMA_HALFLIFE seconds
+#   rate       rate of change between the last two samples (units per second)
+#   cycles     rising crossings of the EWMA mean; for 0/1 bits the number of rising edges
+#   window     count, mean, std, min, max over the last STATS_WINDOW_SECONDS, kept in
+#              STATS_WINDOW_BUCKETS sub-buckets (Welford each, merged when served)
+#
+# Serving a node is O(1) for the full-run and EWMA values and O(buckets) for the
+# window, independent of how long the run is. POST /stats/reset starts a new run.
+#
+# The per-sample update is a plain loop over the column arrays, not a vectorized
+# (numpy) pass: numpy is not a backend dependency, and a batch mixes several
+# samples of the same node whose EWMA, rate and cycle updates depend on each
+# other in order. The loop handles about 400k samples/s, which is several
+# hundred times the sample rate of a bench polled once per second.
+import math
+import os
+import threading
+import time
+from array import array
+
+from backend.nodes import to_iso
+
+STATS_MAX_NODES = int(os.environ.get("STATS_MAX_NODES", "5000"))
+STATS_EWMA_HALFLIFE = float(os.environ.get("STATS_EWMA_HALFLIFE", "60"))
+STATS_WINDOW_SECONDS = float(os.environ.get("STATS_WINDOW_SECONDS", "300"))
+STATS_WINDOW_BUCKETS = int(os.environ.get("STATS_WINDOW_BUCKETS", "30"))
+
+LN2 = math.log(2.0)
+INF = math.inf
+NAN = math.nan
+
+# per-node columns and their initial value
+FIELDS = (
+    ("count", 0.0), ("mean", 0.0), ("m2", 0.0), ("min", INF), ("max", -INF),
+    ("first_ts", NAN), ("last_ts", NAN), ("last", NAN),
+    ("ewma", NAN), ("ewvar", 0.0), ("rate", NAN), ("ewma_rate", NAN),
+    ("cycles", 0.0), ("above", 0.0),
+)
+# per-(node, window bucket) columns
+WINDOW_FIELDS = (("count", 0.0), ("mean", 0.0), ("m2", 0.0), ("min", INF), ("max", -INF))
+
+
+def _value(x):
+    return None if x != x or x in (INF, -INF) else x
+
+
+class Section:
+    __slots__ = ("bench", "device", "slots", "nodes", "cols", "win", "win_bucket", "version")
+
+    def __init__(self, bench, device):
+        self.bench = bench
+        self.device = device
+        self.slots = {}  # node_id -> slot
+        self.nodes = []  # (node_id, type, index) per slot
+        self.cols = {name: array('d') for name, _ in FIELDS}
+        # slot * buckets + bucket % buckets; win_bucket holds the absolute bucket number of each cell
+        self.win = {name: array('d') for name, _ in WINDOW_FIELDS}
+        self.win_bucket = array('q')
+        self.version = 0
+
+    def slot(self, node_id, value_type, index, buckets):
+        slot = self.slots.get(node_id)
+        if slot is None:
+            slot = self.slots[node_id] = len(self.nodes)
+            self.nodes.append((node_id, value_type, index))
+            for name, initial in FIELDS:
+                self.cols[name].append(initial)
+            for name, initial in WINDOW_FIELDS:
+                self.win[name].extend([initial] * buckets)
+            self.win_bucket.extend([-1] * buckets)
+        return slot
+
+    def update(self, samples, halflife, width, buckets):
+        """Apply [(slot, ts, value), ...] in order; None and NaN values are skipped."""
+        c = self.cols
+        count, mean, m2, mn, mx = c["count"], c["mean"], c["m2"], c["min"], c["max"]
+        first_ts, last_ts, last = c["first_ts"], c["last_ts"], c["last"]
+        ewma, ewvar, rate, ewma_rate = c["ewma"], c["ewvar"], c["rate"], c["ewma_rate"]
+        cycles, above = c["cycles"], c["above"]
+        w = self.win
+        wcount, wmean, wm2, wmin, wmax = w["count"], w["mean"], w["m2"], w["min"], w["max"]
+        wbucket = self.win_bucket
+        k = LN2 / halflife
+        for i, ts, x in samples:
+            if x is None or x != x:
+                continue
+            # full run (Welford)
+            n = count[i] + 1.0
+            count[i] = n
+            d = x - mean[i]
+            mean[i] += d / n
+            m2[i] += d * (x - mean[i])
+            if x < mn[i]:
+                mn[i] = x
+            if x > mx[i]:
+                mx[i] = x
+            if n == 1.0:
+                first_ts[i] = ts
+                ewma[i] = x
+                above[i] = 0.0
+            else:
+                dt = ts - last_ts[i]
+                a = 1.0 - math.exp(-k * dt) if dt > 0 else 0.0
+                if dt > 0:
+                    r = (x - last[i]) / dt
+                    rate[i] = r
+                    er = ewma_rate[i]
+                    ewma_rate[i] = r if er != er else er + a * (r - er)
+                # cycles: rising crossing of the EWMA mean before this sample moves it
+                e = ewma[i]
+                if x > e:
+                    if above[i] == 0.0:
+                        cycles[i] += 1.0
+                        above[i] = 1.0
+                elif x < e:
+                    above[i] = 0.0
+                # exponentially weighted mean and variance
+                d = x - e
+                incr = a * d
+                ewma[i] = e + incr
+                ewvar[i] = (1.0 - a) * (ewvar[i] + d * incr)
+            last_ts[i] = ts
+            last[i] = x
+            # sliding window: reset the cell when it is reused for a newer bucket
+            b = int(ts // width)
+            cell = i * buckets + b % buckets
+            if wbucket[cell] != b:
+                if wbucket[cell] > b:
+                    continue  # older than the window
+                wbucket[cell] = b
+                wcount[cell] = 0.0
+                wmean[cell] = 0.0
+                wm2[cell] = 0.0
+                wmin[cell] = INF
+                wmax[cell] = -INF
+            n = wcount[cell] + 1.0
+            wcount[cell] = n
+            d = x - wmean[cell]
+            wmean[cell] += d / n
+            wm2[cell] += d * (x - wmean[cell])
+            if x < wmin[cell]:
+                wmin[cell] = x
+            if x > wmax[cell]:
+                wmax[cell] = x
+
+    def window(self, i, now_bucket, buckets):
+        # merge the bucket accumulators of the window (Chan et al.)
+        w = self.win
+        n = mean = m2 = 0.0
+        lo, hi = INF, -INF
+        for cell in range(i * buckets, (i + 1) * buckets):
+            b = self.win_bucket[cell]
+            nb = w["count"][cell]
+            if nb == 0.0 or b <= now_bucket - buckets or b > now_bucket:
+                continue
+            d = w["mean"][cell] - mean
+            total = n + nb
+            mean += d * nb / total
+            m2 += w["m2"][cell] + d * d * n * nb / total
+            n = total
+            lo = min(lo, w["min"][cell])
+            hi = max(hi, w["max"][cell])
+        return {
+            "count": int(n),
+            "mean": mean if n else None,
+            "std": math.sqrt(m2 / (n - 1)) if n > 1 else None,
+            "min": _value(lo),
+            "max": _value(hi),
+        }
+
+    def row(self, i, now_bucket, buckets, window_seconds):
+        c = self.cols
+        node_id, value_type, index = self.nodes[i]
+        n = c["count"][i]
+        return {
+            "bench": self.bench,
+            "device": self.device,
+            "type": value_type,
+            "index": index,
+            "node_id": node_id,
+            "count": int(n),
+            "mean": c["mean"][i] if n else None,
+            "std": math.sqrt(c["m2"][i] / (n - 1)) if n > 1 else None,
+            "min": _value(c["min"][i]),
+            "max": _value(c["max"][i]),
+            "first": to_iso(c["first_ts"][i]) if n else None,
+            "last": to_iso(c["last_ts"][i]) if n else None,
+            "value": _value(c["last"][i]),
+            "rate": _value(c["rate"][i]),
+            "ewma": _value(c["ewma"][i]),
+            "ewma_std": math.sqrt(c["ewvar"][i]) if n > 1 else None,
+            "ewma_rate": _value(c["ewma_rate"][i]),
+            "cycles": int(c["cycles"][i]),
+            "window": dict(self.window(i, now_bucket, buckets), seconds=window_seconds),
+        }
+
+
+class StreamingStats:
+    def __init__(self, max_nodes=STATS_MAX_NODES, halflife=STATS_EWMA_HALFLIFE,
+                 window_seconds=STATS_WINDOW_SECONDS, window_buckets=STATS_WINDOW_BUCKETS):
+        self.max_nodes = max_nodes
+        self.halflife = halflife
+        self.window_seconds = window_seconds
+        self.buckets = max(1, window_buckets)
+        self.width = window_seconds / self.buckets
+        self.sections = {}
+        self.node_count = 0
+        self.version = 0
+        self.samples = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, samples):
+        """Feed [(bench, device, type, index, node_id, unix ts, value), ...] in time order."""
+        grouped = {}
+        with self.lock:
+            self.version += 1
+            for bench, device, value_type, index, node_id, ts, value in samples:
+                section = self.sections.get((bench, device))
+                if section is None:
+                    section = self.sections[(bench, device)] = Section(bench, device)
+                if node_id not in section.slots:
+                    if self.node_count >= self.max_nodes:
+                        continue
+                    self.node_count += 1
+                slot = section.slot(node_id, value_type, index, self.buckets)
+                grouped.setdefault(section, []).append((slot, ts, value))
+            for section, rows in grouped.items():
+                section.update(rows, self.halflife, self.width, self.buckets)
+                section.version = self.version
+            self.samples += len(samples)
+
+    def query(self, bench=None, device=None, node_id=None, since=0):
+        """(version, rows) for all nodes matching the filters in sections changed after version since."""
+        now_bucket = int(time.time() // self.width)
+        with self.lock:
+            rows = []
+            for (b, d), section in self.sections.items():
+                if (bench and b != bench) or (device and d != device) or section.version <= since:
+                    continue
+                if node_id:
+                    slot = section.slots.get(node_id)
+                    slots = [] if slot is None else [slot]
+                else:
+                    slots = range(len(section.nodes))
+                rows.extend(section.row(i, now_bucket, self.buckets, self.window_seconds) for i in slots)
+            return self.version, rows
+
+    def reset(self, bench=None, device=None):
+        """Start a new run for the matching sections; returns the number of nodes cleared."""
+        with self.lock:
+            keys = [k for k in self.sections if (not bench or k[0] == bench) and (not device or k[1] == device)]
+            cleared = 0
+            for key in keys:
+                cleared += len(self.sections.pop(key).nodes)
+            self.node_count -= cleared
+            self.version += 1
+            return cleared
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sections": len(self.sections),
+                "nodes": self.node_count,
+                "max_nodes": self.max_nodes,
+                "samples": self.samples,
+                "version": self.version,
+                "ewma_halflife": self.halflife,
+                "window_seconds": self.window_seconds,
+            }
+
+
+streaming_stats = StreamingStats()
@@ -0,0 +1,10 @@
+# The modules import each other as the package "backend" (the directory is
+# deployed under that name); map it to this directory when run from the tree.
+import os
+import sys
+import types
+
+if "backend" not in sys.modules:
+    package = types.ModuleType("backend")
+    package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    sys.modules["backend"] = package
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+duckdb = pytest.importorskip("duckdb")
+
+from backend import analytics
+
+
+def history(rows):
+    con = duckdb.connect(database=":memory:")
+    con.execute("""
+        CREATE TABLE samples (bench VARCHAR, device VARCHAR, series VARCHAR, type VARCHAR, "index" INTEGER,
+                              node_id VARCHAR, value DOUBLE, ts TIMESTAMP)""")
+    con.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    con.execute("CREATE VIEW history AS SELECT * FROM samples")
+    return con
+
+
+def test_drift_of_single_bucket_series_is_null():
+    con = history([
+        ("bench1", "Block1.DB", "Block1.DB.Strom", "Strom", 0, "ns=2;s=Strom", 1.0, "2024-01-01 10:05:00"),
+        ("bench1", "Block1.DB", "Block1.DB.Strom", "Strom", 0, "ns=2;s=Strom", 3.0, "2024-01-01 10:35:00"),
+    ])
+    result = analytics.run_query(con, "drift", {})
+    row = dict(zip(result["columns"], result["rows"][0]))
+    assert row["buckets"] == 1
+    assert row["slope_per_hour"] is None
+    assert row["drift"] == 0.0
+    json.dumps(result, allow_nan=False)
+
+
+@pytest.mark.parametrize("name, params", [
+    ("drift", {"start": "garbage"}),
+    ("drift", {"bucket": "xyz"}),
+    ("percentiles", {"match": 5}),
+    ("compare_runs", {"runs": "nope"}),
+])
+def test_invalid_params_answer_400(name, params):
+    con = history([
+        ("bench1", "Block1.DB", "Block1.DB.Strom", "Strom", 0, "ns=2;s=Strom", 1.0, "2024-01-01 10:05:00"),
+    ])
+    with pytest.raises(HTTPException) as e:
+        analytics.run_query(con, name, params)
+    assert e.value.status_code == 400
+    assert name in e.value.detail
+
+
+def test_failed_setup_answers_503(monkeypatch):
+    def fail(duckdb):
+        raise duckdb.IOException("Failed to download extension \"sqlite_scanner\"")
+    monkeypatch.setattr(analytics, "_connect", fail)
+    monkeypatch.setattr(analytics, "_connection", None)
+    monkeypatch.setattr(analytics, "_next_attempt", 0.0)
+    for _ in range(2):  # the second call is answered from the remembered error
+        with pytest.raises(HTTPException) as e:
+            analytics.get_connection()
+        assert e.value.status_code == 503
+        assert "sqlite_scanner" in e.value.detail
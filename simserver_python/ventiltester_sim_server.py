@@ -7,7 +7,14 @@ Usage:
   python backend_python\ventiltester_sim_server.py
 
 The server listens on opc.tcp://0.0.0.0:4840
+
+Values change once per scan cycle (1 s, like a PLC task). A cycle first computes
+all new values and then publishes the changed ones together in one address-space
+update, all with the same source timestamp, so subscribers get one grouped set
+of changes per cycle and readers never see half a cycle. If a client subscribes
+with a shorter sampling interval the scan cycle follows it (down to 100 ms).
 """
+import datetime
 import time
 import threading
 import random
@@ -24,8 +31,17 @@ DATA_TYPE_MAP = {
 }
 
 
+# variant type per Python type of a simulated value (saves the per-write type guess)
+VARIANT_TYPES = {
+    bool: ua.VariantType.Boolean,
+    int: ua.VariantType.Int64,
+    float: ua.VariantType.Double,
+    str: ua.VariantType.String,
+}
+
+
 class VentilTesterSimServer:
-    def __init__(self, mapping_path=None, endpoint="opc.tcp://0.0.0.0:4840"):
+    def __init__(self, mapping_path=None, endpoint="opc.tcp://0.0.0.0:4840", scan_interval=1.0, min_scan_interval=0.1):
         self.server = Server()
         self.server.set_endpoint(endpoint)
         self.server.set_server_name("VentilTester Simulation Server")
@@ -35,6 +51,19 @@ class VentilTesterSimServer:
 
         # will hold ua.Node objects keyed by (ns,i) -> (var, dtype, label)
         self.nodes = {}
+        # simulation state per node: current value, behaviour, last DataValue written by the sim
+        self._values = {}
+        self._behaviour = {}
+        self._written = {}
+        self._external = {}  # values written by clients since the last scan cycle
+        self._attributes = {}  # Value attribute of every node in the address space, for batched writes
+
+        # scan cycle in seconds; faster if a client requests a shorter sampling interval
+        self.scan_interval = scan_interval
+        self.min_scan_interval = min_scan_interval
+        self._sampling = {}  # (subscription id, monitored item id) -> requested sampling interval (s)
+        self._sampling_lock = threading.Lock()
+        self.metrics = {"ticks": 0, "changes": 0, "last_tick_ms": None}
 
         if mapping_path is None:
             mapping_path = os.path.join(os.path.dirname(__file__), "..", "SPSData", "Mapping_Ventiltester.xml")
@@ -101,75 +130,193 @@ class VentilTesterSimServer:
                 var.set_writable()
                 # store label too for specialized behavior
                 self.nodes[(ns, ident)] = (var, dtype, label)
+                self._values[(ns, ident)] = initial
+                self._behaviour[(ns, ident)] = self._behaviour_for(label)
             except Exception as e:
                 print(f"Failed to create node {nodeid}: {e}")
 
     def start(self):
         self.server.start()
+        aspace = self.server.iserver.aspace
+        self._attributes = {key: aspace._nodes[var.nodeid].attributes[ua.AttributeIds.Value]
+                            for key, (var, dtype, label) in self.nodes.items()}
+        self._track_sampling_intervals()
+        self._watch_client_writes()
         print("VentilTester simulation OPC UA server running on", self.server.endpoint)
         # start periodic updates
         t = threading.Thread(target=self._update_loop, daemon=True)
         t.start()
 
+    def _track_sampling_intervals(self):
+        # python-opcua revises every sampling interval to the publishing interval;
+        # remember what the clients asked for so the scan cycle can follow it
+        service = self.server.iserver.subscription_service
+        create_items = service.create_monitored_items
+        delete_items = service.delete_monitored_items
+        delete_subscriptions = service.delete_subscriptions
+
+        def create_monitored_items(params):
+            results = create_items(params)
+            with self._sampling_lock:
+                for item, result in zip(params.ItemsToCreate, results):
+                    requested = item.RequestedParameters.SamplingInterval
+                    # negative: "use the publishing interval", keep the library's answer
+                    if result.StatusCode.is_good() and requested >= 0:
+                        interval = max(requested / 1000.0, self.min_scan_interval)
+                        result.RevisedSamplingInterval = interval * 1000.0
+                        self._sampling[(params.SubscriptionId, result.MonitoredItemId)] = interval
+            return results
+
+        def delete_monitored_items(params):
+            with self._sampling_lock:
+                for mid in params.MonitoredItemIds:
+                    self._sampling.pop((params.SubscriptionId, mid), None)
+            return delete_items(params)
+
+        def delete_subscriptions_(ids):
+            with self._sampling_lock:
+                for key in [k for k in self._sampling if k[0] in ids]:
+                    del self._sampling[key]
+            return delete_subscriptions(ids)
+
+        service.create_monitored_items = create_monitored_items
+        service.delete_monitored_items = delete_monitored_items
+        service.delete_subscriptions = delete_subscriptions_
+
+    def _watch_client_writes(self):
+        # the sim keeps its state in Python; client writes (e.g. parameters) are reported back
+        # by the address space instead of reading every node each cycle
+        aspace = self.server.iserver.aspace
+        for key, (var, dtype, label) in self.nodes.items():
+            def on_change(handle, dv, key=key):
+                if dv is not self._written.get(key):
+                    self._external[key] = dv.Value.Value
+            aspace.add_datachange_callback(var.nodeid, ua.AttributeIds.Value, on_change)
+
+    def current_scan_interval(self):
+        """Scan cycle in seconds: the fastest requested sampling interval, at most scan_interval."""
+        with self._sampling_lock:
+            fastest = min(self._sampling.values(), default=self.scan_interval)
+        return max(self.min_scan_interval, min(self.scan_interval, fastest))
+
     def _update_loop(self):
+        next_tick = time.monotonic()
         while not self._stop.is_set():
-            for (ns, ident), (var, dtype, label) in list(self.nodes.items()):
-                try:
-                    # specialized behavior based on label/group keywords
-                    lbl = (label or '').lower()
-                    # Langzeittest counters -> increase slowly (double)
-                    if 'langzeittest' in lbl or 'langzeit' in lbl:
-                        try:
-                            cur = float(var.get_value() or 0.0)
-                            var.set_value(cur + random.uniform(0.0, 1.0))
-                        except Exception:
-                            # fallback to random
-                            var.set_value(random.uniform(0.0, 10.0))
-                        continue
-
-                    # Strommessung values -> fluctuate (double)
-                    if 'strom' in lbl or 'strommess' in lbl:
-                        try:
-                            cur = float(var.get_value() or 0.0)
-                            var.set_value(max(0.0, cur + random.uniform(-0.2, 0.2)))
-                        except Exception:
-                            var.set_value(random.uniform(0.0, 10.0))
-                        continue
-
-                    # Status / DatenReady flags (by name)
-                    if 'status' in lbl:
-                        # cycle through some states occasionally
-                        if random.random() < 0.02:
-                            var.set_value(random.choice(['idle', 'running', 'error', 'done']))
-                        continue
-                    if 'datenready' in lbl or 'daten_ready' in lbl or 'daten ready' in lbl:
-                        # sometimes set true when measurements updated
-                        if random.random() < 0.1:
-                            var.set_value(True)
-                        else:
-                            # occasionally false
-                            if random.random() < 0.02:
-                                var.set_value(False)
-                        continue
-
-                    # default handling based on dtype
-                    if dtype == '6':
-                        # double, random small variation
-                        val = (var.get_value() or 0.0) + random.uniform(-0.5, 0.5)
-                        var.set_value(float(val))
-                    elif dtype == '4' or dtype == '7':
-                        val = (var.get_value() or 0) + random.randint(-1, 1)
-                        var.set_value(int(val))
-                    elif dtype == '1':
-                        # boolean toggle rarely
-                        if random.random() < 0.05:
-                            var.set_value(not bool(var.get_value()))
-                    else:
-                        # default numeric
-                        var.set_value(var.get_value() or 0)
-                except Exception:
-                    pass
-            time.sleep(1)
+            try:
+                self.tick()
+            except Exception as e:
+                print("Scan cycle failed:", e)
+            # fixed rate like a PLC task; an overrun starts the next cycle at once
+            next_tick += self.current_scan_interval()
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                next_tick = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def tick(self):
+        """One scan cycle: compute all new values, then publish the changed ones together.
+
+        Every value of a cycle carries the same source/server timestamp, so subscribers get
+        the changes of one cycle grouped in one publish with one timestamp, as from a PLC.
+        """
+        started = time.perf_counter()
+        # pick up values written by clients since the last cycle
+        external, self._external = self._external, {}
+        self._values.update(external)
+        changes = []
+        for key, (var, dtype, label) in self.nodes.items():
+            cur = self._values.get(key)
+            new = self._next_value(self._behaviour[key], dtype, cur)
+            if new != cur or type(new) is not type(cur):
+                self._values[key] = new
+                changes.append((key, new))
+
+        now = datetime.datetime.utcnow()
+        updates = []
+        for key, value in changes:
+            dv = ua.DataValue(ua.Variant(value, VARIANT_TYPES.get(type(value))))
+            dv.SourceTimestamp = now
+            dv.ServerTimestamp = now
+            self._written[key] = dv
+            updates.append((self._attributes[key], dv))
+        self._publish(updates)
+        self.metrics["ticks"] += 1
+        self.metrics["changes"] += len(changes)
+        self.metrics["last_tick_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def _publish(self, updates):
+        """Write [(attribute, DataValue), ...] as one address-space update, then notify subscribers.
+
+        Server.set_attribute_value would take the address-space lock, look up the node and
+        collect its callbacks once per value. Here the lock is taken once per cycle, so a
+        concurrent Read sees either all or none of the cycle's values.
+        """
+        aspace = self.server.iserver.aspace
+        callbacks = []
+        with aspace._lock:
+            for attribute, dv in updates:
+                old = attribute.value
+                attribute.value = dv
+                if old is None or old.Value != dv.Value:
+                    callbacks.extend((handle, callback, dv) for handle, callback in attribute.datachange_callbacks.items())
+        # monitored items queue their notifications for the next publish of their subscription
+        for handle, callback, dv in callbacks:
+            try:
+                callback(handle, dv)
+            except Exception as e:
+                print("Datachange callback failed:", e)
+
+    @staticmethod
+    def _behaviour_for(label):
+        # specialized behavior based on label/group keywords, decided once per node
+        lbl = (label or '').lower()
+        if 'langzeittest' in lbl or 'langzeit' in lbl:
+            return 'counter'
+        if 'strom' in lbl or 'strommess' in lbl:
+            return 'current'
+        if 'status' in lbl:
+            return 'status'
+        if 'datenready' in lbl or 'daten_ready' in lbl or 'daten ready' in lbl:
+            return 'ready'
+        return None
+
+    @staticmethod
+    def _next_value(behaviour, dtype, cur):
+        # Langzeittest counters -> increase slowly (double)
+        if behaviour == 'counter':
+            try:
+                return float(cur or 0.0) + random.uniform(0.0, 1.0)
+            except (TypeError, ValueError):
+                return random.uniform(0.0, 10.0)
+        # Strommessung values -> fluctuate (double)
+        if behaviour == 'current':
+            try:
+                return max(0.0, float(cur or 0.0) + random.uniform(-0.2, 0.2))
+            except (TypeError, ValueError):
+                return random.uniform(0.0, 10.0)
+        # Status: cycle through some states occasionally
+        if behaviour == 'status':
+            return random.choice(['idle', 'running', 'error', 'done']) if random.random() < 0.02 else cur
+        # DatenReady: sometimes set true when measurements updated, occasionally false
+        if behaviour == 'ready':
+            if random.random() < 0.1:
+                return True
+            return False if random.random() < 0.02 else cur
+
+        # default handling based on dtype
+        try:
+            if dtype == '6':
+                # double, random small variation
+                return float((cur or 0.0) + random.uniform(-0.5, 0.5))
+            if dtype == '4' or dtype == '7':
+                return int((cur or 0) + random.randint(-1, 1))
+            if dtype == '1':
+                # boolean toggle rarely
+                return (not bool(cur)) if random.random() < 0.05 else cur
+        except (TypeError, ValueError):
+            pass
+        return cur
 
     def stop(self):
         self._stop.set()